@@ -1,6 +1,6 @@
 {
     'name': 'Rail Measurement Management',
-    'version': '1.0',
+    'version': '1.1',
     'category': 'Services',
     'summary': 'Gestion des prestations de mesure de voie ferrée',
     'description': """
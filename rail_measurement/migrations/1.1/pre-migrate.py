@@ -0,0 +1,63 @@
+"""Préparation de la contrainte unique(measurement_id, file_checksum).
+
+Les fichiers journaliers importés deux fois pour une même mesure sont
+fusionnés : on garde le plus ancien, les copies (même contenu) et leurs
+pièces jointes sont supprimées, chacune journalisée avec son planning, son
+jour et le fichier conservé. L'empreinte est reprise de ir_attachment,
+qui l'a déjà calculée, pour éviter de relire tous les fichiers à la mise
+à jour.
+"""
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+
+    cr.execute("ALTER TABLE rail_measurement_day_file ADD COLUMN IF NOT EXISTS file_checksum varchar")
+    cr.execute("""
+        UPDATE rail_measurement_day_file f
+           SET file_checksum = a.checksum
+          FROM ir_attachment a
+         WHERE a.res_model = 'rail.measurement.day.file'
+           AND a.res_field = 'file'
+           AND a.res_id = f.id
+           AND f.file_checksum IS NULL
+    """)
+
+    cr.execute("""
+        SELECT id, kept_id, planning_id, day
+          FROM (SELECT id, planning_id, day,
+                       FIRST_VALUE(id) OVER w AS kept_id,
+                       ROW_NUMBER() OVER w AS rank
+                  FROM rail_measurement_day_file
+                 WHERE measurement_id IS NOT NULL
+                   AND file_checksum IS NOT NULL
+                WINDOW w AS (PARTITION BY measurement_id, file_checksum ORDER BY id)) d
+         WHERE d.rank > 1
+         ORDER BY kept_id, id
+    """)
+    duplicates = cr.fetchall()
+    if not duplicates:
+        return
+
+    # Trace de chaque jour de planning qui perd son fichier
+    for day_file_id, kept_id, planning_id, day in duplicates:
+        _logger.info(
+            "Fichier journalier %s (planning %s, jour %s) supprimé : doublon du fichier %s",
+            day_file_id, planning_id, day, kept_id,
+        )
+    duplicate_ids = [row[0] for row in duplicates]
+
+    # Les fichiers du filestore orphelins sont ramassés par le nettoyage d'Odoo
+    cr.execute("""
+        DELETE FROM ir_attachment
+         WHERE res_model = 'rail.measurement.day.file'
+           AND res_id = ANY(%s)
+    """, [duplicate_ids])
+    cr.execute("DELETE FROM rail_measurement_day_file WHERE id = ANY(%s)", [duplicate_ids])
+    _logger.info("%d fichier(s) journalier(s) en double supprimé(s) avant la contrainte d'unicité",
+                 len(duplicate_ids))
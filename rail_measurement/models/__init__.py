@@ -10,3 +10,6 @@ from . import equipe_terrain
 from . import leyfa_sig
 from . import res_config_settings
 from . import wizard_new_contact
+from . import resource_availability
+from . import resource_booking
+from . import code_affaire
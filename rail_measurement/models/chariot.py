@@ -1,6 +1,8 @@
 from odoo import models, fields, api
 import logging
 
+from .resource_availability import CHARIOT
+
 class Chariot(models.Model):
     _name = 'chariot'
     _description = 'Chariot physique'
@@ -69,17 +71,11 @@ class Chariot(models.Model):
         current_measure_id = self.env.context.get('check_avail_id')
 
         # 2. Pré-calcul des chariots occupés (Performance)
-        booked_cart_ids = []
+        booked_cart_ids = {}
         if start_date and end_date:
-            # On cherche toutes les mesures confirmées/planifiées qui chevauchent
-            conflicts = self.env['rail.measurement'].search([
-                ('id', '!=', current_measure_id),             # Pas celle-ci
-                ('prod_substate', '=', ['assigned']),  # Mesures actives
-                ('date_start', '<', end_date),                # Chevauchement
-                ('date_end', '>', start_date),
-            ])
-            # On récupère tous les IDs de chariots utilisés dans ces mesures
-            booked_cart_ids = conflicts.mapped('chariot_type_lines.assigned_chariot_ids').ids
+            booked_cart_ids = self.env['rail.resource.availability'].busy_labels(
+                CHARIOT, start_date, end_date, exclude_id=current_measure_id or None,
+            )
 
         for record in self:
             name = record.name
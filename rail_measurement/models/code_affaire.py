@@ -0,0 +1,250 @@
+"""Numérotation des codes affaire.
+
+Un code affaire s'écrit ELLLTT[N]XXX : le numéro XXX est unique par
+exercice (première lettre du code), toutes lignes et tous types confondus.
+
+``rail_code_affaire_counter`` garde, par exercice, le dernier numéro
+attribué. Lire le prochain numéro est une recherche sur index ; le réserver
+est un seul ``INSERT ... ON CONFLICT DO UPDATE ... RETURNING`` qui verrouille
+la ligne du compteur jusqu'à la fin de la transaction : deux planificateurs
+qui enregistrent en même temps ne peuvent pas obtenir le même numéro.
+"""
+
+import re
+
+from odoo import api, fields, models, tools
+
+CODE_INDEX_DIGITS = 3
+CODE_INDEX_MAX = 10 ** CODE_INDEX_DIGITS - 1
+_CODE_INDEX_RE = re.compile(r'^(.+?)(\d{%d})$' % CODE_INDEX_DIGITS)
+
+
+def split_code(code):
+    """(préfixe, numéro) d'un code affaire, numéro None s'il n'est pas numéroté."""
+    code = (code or '').strip().upper()
+    match = _CODE_INDEX_RE.match(code)
+    if not match:
+        return code, None
+    return match.group(1), int(match.group(2))
+
+
+def format_code(prefix, index):
+    return f"{prefix}{str(index).zfill(CODE_INDEX_DIGITS)}"
+
+
+def counter_scope(prefix):
+    """Portée de numérotation d'un préfixe : la lettre d'exercice."""
+    return (prefix or '')[:1].upper()
+
+
+class RailCodeAffaireCounter(models.Model):
+    _name = 'rail.code.affaire.counter'
+    _description = 'Compteur de codes affaire par exercice'
+    _log_access = False
+
+    scope = fields.Char(string="Exercice", required=True)
+    last_index = fields.Integer(string="Dernier numéro attribué", required=True, default=0)
+
+    _scope_unique = models.Constraint(
+        'unique(scope)',
+        "Un seul compteur par exercice !"
+    )
+
+    def init(self):
+        cr = self.env.cr
+        if not tools.sql.table_exists(cr, 'rail_measurement'):
+            return
+        # Amorçage depuis les codes existants ; ne fait jamais reculer un compteur.
+        # Pas d'ON CONFLICT ici : la contrainte unique peut ne pas encore exister.
+        seed = """
+            SELECT UPPER(LEFT(code_affaire, 1)) AS scope,
+                   MAX(RIGHT(code_affaire, %(digits)s)::integer) AS last_index
+              FROM rail_measurement
+             WHERE code_affaire ~ %(pattern)s
+             GROUP BY 1
+        """
+        params = {'digits': CODE_INDEX_DIGITS, 'pattern': r'^.+\d{%d}$' % CODE_INDEX_DIGITS}
+        cr.execute(f"""
+            UPDATE {self._table} c
+               SET last_index = s.last_index
+              FROM ({seed}) s
+             WHERE c.scope = s.scope AND c.last_index < s.last_index
+        """, params)
+        cr.execute(f"""
+            INSERT INTO {self._table} (scope, last_index)
+            SELECT s.scope, s.last_index
+              FROM ({seed}) s
+             WHERE NOT EXISTS (SELECT 1 FROM {self._table} c WHERE c.scope = s.scope)
+        """, params)
+
+    @api.model
+    def _peek(self, scope):
+        """Prochain numéro libre de ``scope``, sans le réserver (onchanges)."""
+        self.env.cr.execute(
+            f"SELECT last_index FROM {self._table} WHERE scope = %s", [scope])
+        row = self.env.cr.fetchone()
+        return (row[0] if row else 0) + 1
+
+    @api.model
+    def _reserve(self, scope, count=1):
+        """Réserve ``count`` numéros consécutifs de ``scope`` ; retourne le premier."""
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} AS c (scope, last_index) VALUES (%s, %s)
+            ON CONFLICT (scope) DO UPDATE SET last_index = c.last_index + EXCLUDED.last_index
+            RETURNING last_index
+        """, [scope, count])
+        return self.env.cr.fetchone()[0] - count + 1
+
+    @api.model
+    def _claim(self, scope, index):
+        """Enregistre l'usage de ``index`` (code saisi à la main ou généré).
+
+        Verrouille le compteur de ``scope`` et retourne le dernier numéro
+        attribué *avant* cet appel : ``index`` était déjà distribué s'il ne le
+        dépasse pas.
+        """
+        cr = self.env.cr
+        cr.execute(f"""
+            INSERT INTO {self._table} (scope, last_index) VALUES (%s, 0)
+            ON CONFLICT (scope) DO NOTHING
+        """, [scope])
+        cr.execute(f"SELECT last_index FROM {self._table} WHERE scope = %s FOR UPDATE", [scope])
+        previous = cr.fetchone()[0]
+        if index > previous:
+            cr.execute(f"UPDATE {self._table} SET last_index = %s WHERE scope = %s", [index, scope])
+        return previous
+
+    @api.model
+    def _data_last_index(self, scopes):
+        """{scope: plus grand numéro présent dans les codes des affaires}."""
+        self.env['rail.measurement'].flush_model(['code_affaire'])
+        self.env.cr.execute("""
+            SELECT UPPER(LEFT(code_affaire, 1)), MAX(RIGHT(code_affaire, %s)::integer)
+              FROM rail_measurement
+             WHERE code_affaire ~ %s
+               AND UPPER(LEFT(code_affaire, 1)) = ANY(%s)
+             GROUP BY 1
+        """, [CODE_INDEX_DIGITS, r'^.+\d{%d}$' % CODE_INDEX_DIGITS, list(scopes)])
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _next_code(self, prefix):
+        return format_code(prefix, self._peek(counter_scope(prefix)))
+
+
+# ----------------------------------------------------------------------
+# Analyse des codes
+# ----------------------------------------------------------------------
+
+NATURES = ('R', 'E')
+
+
+def _trie_insert(trie, key, value):
+    node = trie
+    for char in key:
+        node = node.setdefault(char, {})
+    # Première valeur insérée prioritaire (ordre des référentiels)
+    node.setdefault(None, value)
+
+
+def _trie_prefixes(trie, text):
+    """(longueur, valeur) de chaque clé préfixe de ``text``, de la plus longue à la plus courte."""
+    found = []
+    node = trie
+    for length, char in enumerate(text, 1):
+        node = node.get(char)
+        if node is None:
+            break
+        if None in node:
+            found.append((length, node[None]))
+    found.reverse()
+    return found
+
+
+def _resolve_type(types, tail):
+    """(type_id, nature) pour la fin de code ``tail`` = code type [+ nature]."""
+    if not tail:
+        return None
+    matches = dict(_trie_prefixes(types, tail))
+    exact = matches.get(len(tail))
+    with_nature = matches.get(len(tail) - 1) if tail[-1] in NATURES else None
+    # Un type à nature obligatoire attend sa lettre ; les autres se lisent tels quels
+    if exact and not exact[1]:
+        return exact[0], False
+    if with_nature and with_nature[1]:
+        return with_nature[0], tail[-1]
+    if exact:
+        return exact[0], False
+    if with_nature:
+        return with_nature[0], tail[-1]
+    return None
+
+
+class RailCodeAffaireParser(models.AbstractModel):
+    _name = 'rail.code.affaire.parser'
+    _description = 'Analyse des codes affaire'
+
+    @api.model
+    @tools.ormcache()
+    def _code_tries(self):
+        """Arbres préfixes (exercices, surnoms de ligne, codes type), mis en
+        cache jusqu'à la prochaine modification d'un de ces référentiels."""
+        exercices, lignes, types = {}, {}, {}
+        for row in self.env['leyfa.exercice.comptable'].sudo().search_read([], ['name']):
+            if row['name']:
+                _trie_insert(exercices, row['name'].strip().upper(), row['id'])
+        for row in self.env['leyfa.ligne'].sudo().search_read([], ['surnom'], order='id'):
+            if row['surnom']:
+                _trie_insert(lignes, row['surnom'].strip().upper(), row['id'])
+        for row in self.env['leyfa.affaire.type'].sudo().search_read([], ['code', 'requires_nature']):
+            if row['code']:
+                _trie_insert(types, row['code'].strip().upper(), (row['id'], row['requires_nature']))
+        return exercices, lignes, types
+
+    @api.model
+    def parse_code(self, code):
+        """Décompose un code affaire ELLLTT[N]XXX.
+
+        Retourne un dict directement utilisable en valeurs de rail.measurement :
+        ``exercice_id``, ``ligne_id``, ``type_affaire_id``, ``nature_mission``
+        (False si non reconnus), ainsi que ``prefix`` et ``index`` (numéro,
+        None si le code n'est pas numéroté). Sans référentiel complet, les
+        premiers éléments reconnus sont tout de même renseignés.
+        """
+        prefix, index = split_code(code)
+        exercices, lignes, types = self._code_tries()
+        result = {
+            'exercice_id': False,
+            'ligne_id': False,
+            'type_affaire_id': False,
+            'nature_mission': False,
+            'prefix': prefix,
+            'index': index,
+        }
+        for ex_len, exercice_id in _trie_prefixes(exercices, prefix):
+            rest = prefix[ex_len:]
+            for li_len, ligne_id in _trie_prefixes(lignes, rest):
+                resolved = _resolve_type(types, rest[li_len:])
+                if resolved:
+                    result.update(
+                        exercice_id=exercice_id,
+                        ligne_id=ligne_id,
+                        type_affaire_id=resolved[0],
+                        nature_mission=resolved[1],
+                    )
+                    return result
+            if not result['exercice_id']:
+                result['exercice_id'] = exercice_id
+                lignes_found = _trie_prefixes(lignes, rest)
+                if lignes_found:
+                    result['ligne_id'] = lignes_found[0][1]
+        return result
+
+    @api.model
+    def parse_codes(self, codes):
+        """{code: parse_code(code)} pour un import en masse."""
+        return {code: self.parse_code(code) for code in codes}
+
+    @api.model
+    def _invalidate_code_tries(self):
+        self.env.registry.clear_cache()
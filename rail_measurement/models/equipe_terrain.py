@@ -2,6 +2,8 @@ from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
 from datetime import datetime, timedelta
 
+from .resource_availability import EQUIPE, EXCLUDED_STATES
+
 class EquipeCompositionHebdo(models.Model):
     _name = 'equipe.composition.hebdo'
     _description = 'Composition hebdomadaire de l\'équipe'
@@ -148,7 +150,7 @@ class EquipeCompositionHebdo(models.Model):
                     ('equipe_id_2', '=', record.equipe_id.id),
                     ('date_start', '<=', record.week_end),
                     ('date_end', '>=', record.week_start),
-                    ('state', '!=', 'cancel')
+                    ('state', 'not in', EXCLUDED_STATES[EQUIPE])
                 ])
                 record.measurement_ids = measurements
             else:
@@ -428,20 +430,9 @@ class EquipeTerrain(models.Model):
         booked_teams_info = {}
 
         if start_date and end_date:
-            conflicts = self.env['rail.measurement'].search([
-                ('id', '!=', current_id),
-                ('date_start', '<', end_date),
-                ('date_end', '>', start_date),
-                ('state', '!=', 'cancel'),
-            ])
-            
-            for conflict in conflicts:
-                label = conflict.code_affaire or conflict.name or "Inconnue"
-                
-                if conflict.equipe_id_1:
-                    booked_teams_info[conflict.equipe_id_1.id] = label
-                if conflict.equipe_id_2:
-                    booked_teams_info[conflict.equipe_id_2.id] = label
+            booked_teams_info = self.env['rail.resource.availability'].busy_labels(
+                EQUIPE, start_date, end_date, exclude_id=current_id or None,
+            )
 
         for record in self:
             prefix = "🟢"
@@ -1,4 +1,4 @@
-from odoo import models, fields
+from odoo import api, models, fields
 
 class ExerciceComptable(models.Model):
     _name = 'leyfa.exercice.comptable'
@@ -14,6 +14,24 @@ class ExerciceComptable(models.Model):
     date_end = fields.Date(string='Date de fin', required=True)
     active = fields.Boolean(default=True)
 
+    # Référentiel du code affaire : voir rail.code.affaire.parser
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if not vals.keys().isdisjoint(('name', 'active', 'date_start')):
+            self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
+
     def name_get(self):
         result = []
         for record in self:
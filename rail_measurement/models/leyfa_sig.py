@@ -17,9 +17,25 @@ Changes vs previous version
   keep the existing info-bar behaviour).
 """
 
+import array
+import base64
+import functools
 import json
 import logging
 import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+REGIONS_GEOJSON_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    "static", "src", "geoJSON", "regions.geojson",
+)
+
+REGIONS_GEOJSON_URL = "/rail_measurement/static/src/geoJSON/regions.geojson"
 
 LAYER_COLORS = [
     "#1a56db",
@@ -29,6 +45,322 @@ LAYER_COLORS = [
 ]
 
 
+def _dumps(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+# ----------------------------------------------------------------------
+# Chemin vectorisé (NumPy, optionnel)
+#
+# Les coordonnées sont converties en tableaux float64 (n, 2) ; projection,
+# arrondi et simplification se font alors par tableau entier. Sans NumPy, ou
+# pour de petites listes où la conversion coûte plus qu'elle ne rapporte, les
+# boucles Python d'origine sont utilisées.
+# ----------------------------------------------------------------------
+
+NUMPY_MIN_POINTS = 256
+
+
+def _xy_array(coords):
+    """Tableau (n, 2) des deux premières composantes, ou None."""
+    if np is None or len(coords) < NUMPY_MIN_POINTS:
+        return None
+    try:
+        arr = np.asarray(coords, dtype=np.float64)
+    except (TypeError, ValueError):
+        # Points de dimensions hétérogènes (x, y[, z])
+        return None
+    if arr.ndim != 2 or arr.shape[1] < 2:
+        return None
+    return arr[:, :2]
+
+
+# ----------------------------------------------------------------------
+# Sérialisation des couches
+#
+# Les blocs produits ici sont du JSON compact (donc aussi du JS valide) :
+# ils sont mis en cache par ligne (leyfa.ligne.sig_*_js) et simplement
+# concaténés au moment du rendu.
+# ----------------------------------------------------------------------
+
+def track_segments_from_geo_shape(geo_shape: str) -> list:
+    """Segments [[lon, lat], ...] d'un geo_shape LineString / MultiLineString."""
+    if not geo_shape:
+        return []
+    try:
+        geo = json.loads(geo_shape)
+    except ValueError:
+        return []
+    if geo.get("type") == "LineString":
+        return [geo["coordinates"]]
+    if geo.get("type") == "MultiLineString":
+        return list(geo["coordinates"])
+    return []
+
+
+def track_coords_from_geo_shape(geo_shape: str) -> list:
+    """Liste [lon, lat] à plat depuis un geo_shape LineString / MultiLineString."""
+    coords = []
+    for seg in track_segments_from_geo_shape(geo_shape):
+        coords.extend(seg)
+    return coords
+
+
+# ----------------------------------------------------------------------
+# Niveaux de détail (LOD) du tracé
+#
+# (zoom max, tolérance en degrés) du plus grossier au plus fin ; au-delà du
+# dernier zoom, le tracé complet est utilisé. Une tolérance d'environ un
+# demi-pixel au zoom correspondant rend la simplification invisible.
+# ----------------------------------------------------------------------
+
+TRACK_LOD_LEVELS = [
+    (7, 0.005),
+    (10, 0.0008),
+    (13, 0.0001),
+]
+
+
+def lod_for_zoom(zoom) -> int:
+    """Indice du niveau à utiliser pour ``zoom`` (len(TRACK_LOD_LEVELS) = complet)."""
+    for idx, (max_zoom, _tol) in enumerate(TRACK_LOD_LEVELS):
+        if zoom is not None and zoom <= max_zoom:
+            return idx
+    return len(TRACK_LOD_LEVELS)
+
+
+def simplify_polyline(coords: list, tolerance: float) -> list:
+    """Douglas–Peucker (itératif) sur des points [x, y].
+
+    ``tolerance`` est une distance perpendiculaire dans l'unité des
+    coordonnées. Les extrémités sont toujours conservées.
+    """
+    n = len(coords)
+    if n < 3 or tolerance <= 0:
+        return list(coords)
+    arr = _xy_array(coords)
+    if arr is not None:
+        return [coords[i] for i in _simplify_mask_np(arr, tolerance)]
+    tol2 = tolerance * tolerance
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coords[first][0], coords[first][1]
+        dx = coords[last][0] - x1
+        dy = coords[last][1] - y1
+        seg2 = dx * dx + dy * dy
+        max_d2, index = 0.0, 0
+        for i in range(first + 1, last):
+            px = coords[i][0] - x1
+            py = coords[i][1] - y1
+            if seg2:
+                cross = dx * py - dy * px
+                d2 = cross * cross / seg2
+            else:
+                d2 = px * px + py * py
+            if d2 > max_d2:
+                max_d2, index = d2, i
+        if max_d2 > tol2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [c for c, k in zip(coords, keep) if k]
+
+
+def _simplify_mask_np(arr, tolerance: float) -> list:
+    """Douglas–Peucker vectorisé : indices des points conservés."""
+    n = len(arr)
+    tol2 = tolerance * tolerance
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        origin = arr[first]
+        dx, dy = arr[last] - origin
+        rel = arr[first + 1:last] - origin
+        seg2 = dx * dx + dy * dy
+        if seg2:
+            d2 = (dx * rel[:, 1] - dy * rel[:, 0]) ** 2 / seg2
+        else:
+            d2 = (rel * rel).sum(axis=1)
+        i = int(d2.argmax())
+        if d2[i] > tol2:
+            index = first + 1 + i
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep).tolist()
+
+
+def track_lod_levels(segments: list) -> list:
+    """Tracés aplatis [lon, lat] pour chaque niveau de TRACK_LOD_LEVELS.
+
+    Chaque segment est simplifié séparément ; chaque niveau part du niveau
+    plus fin déjà calculé pour limiter le coût.
+    """
+    levels = []
+    current = [list(seg) for seg in segments]
+    for _max_zoom, tol in reversed(TRACK_LOD_LEVELS):
+        current = [simplify_polyline(seg, tol) for seg in current]
+        flat = []
+        for seg in current:
+            flat.extend(seg)
+        levels.append(flat)
+    levels.reverse()
+    return levels
+
+
+def serialize_track(track_coords: list) -> str:
+    """[lon, lat] -> bloc JS [[lat, lon], ...]"""
+    track_coords = track_coords or []
+    arr = _xy_array(track_coords)
+    if arr is not None:
+        return _dumps(arr[:, ::-1].tolist())
+    return _dumps([[c[1], c[0]] for c in track_coords])
+
+
+def serialize_gares(gares: list) -> tuple:
+    """Retourne (bloc JS, nombre de gares retenues)."""
+    data = []
+    for g in (gares or []):
+        lat = g.get("latitude") or g.get("lat")
+        lon = g.get("longitude") or g.get("lon")
+        if not lat or not lon:
+            continue
+        data.append({
+            "lat": lat,
+            "lon": lon,
+            "name": g.get("name") or "",
+            "pk": g.get("pk") or "",
+            "isV": bool(g.get("isV")),
+            "isF": bool(g.get("isF")),
+        })
+    return _dumps(data), len(data)
+
+
+# ----------------------------------------------------------------------
+# Format compact des PKs
+#
+# Colonnes lat / lon / pk quantifiées en entiers (1e-6 degré ≈ 0,1 m, le
+# mètre pour le PK), codées en delta puis en int32 little-endian base64 :
+#   {"n": 1234, "lat": "<b64>", "lon": "<b64>", "pk": "<b64>"}
+# Le client les relit en Int32Array ; nom ("012+300") et PK entier sont
+# dérivés de pk côté navigateur (même règle que leyfa.pk._compute_name).
+# ----------------------------------------------------------------------
+
+PK_COORD_SCALE = 1000000
+PK_VALUE_SCALE = 1000
+
+
+def _delta_int32_b64(values: list) -> str:
+    deltas = [b - a for a, b in zip([0] + values, values)]
+    buf = array.array("i", deltas)
+    if sys.byteorder != "little":
+        buf.byteswap()
+    return base64.b64encode(buf.tobytes()).decode("ascii")
+
+
+def serialize_pk_columns(pk_values, lats, lons) -> str:
+    """Encode les PKs (colonnes parallèles) ; les points sans coordonnées sont ignorés."""
+    if np is not None and len(pk_values) >= NUMPY_MIN_POINTS:
+        lat_arr = np.asarray(lats, dtype=np.float64)
+        lon_arr = np.asarray(lons, dtype=np.float64)
+        valid = (lat_arr != 0) & (lon_arr != 0)
+        cols = {
+            "lat": lat_arr[valid] * PK_COORD_SCALE,
+            "lon": lon_arr[valid] * PK_COORD_SCALE,
+            "pk": np.asarray(pk_values, dtype=np.float64)[valid] * PK_VALUE_SCALE,
+        }
+        encoded = {"n": int(valid.sum())}
+        for key, col in cols.items():
+            q = np.rint(col).astype(np.int64)
+            deltas = np.diff(q, prepend=0).astype("<i4")
+            encoded[key] = base64.b64encode(deltas.tobytes()).decode("ascii")
+        return _dumps(encoded)
+
+    q_lat, q_lon, q_pk = [], [], []
+    for pk, lat, lon in zip(pk_values, lats, lons):
+        if not lat or not lon:
+            continue
+        q_lat.append(round(lat * PK_COORD_SCALE))
+        q_lon.append(round(lon * PK_COORD_SCALE))
+        q_pk.append(round((pk or 0.0) * PK_VALUE_SCALE))
+    return _dumps({
+        "n": len(q_pk),
+        "lat": _delta_int32_b64(q_lat),
+        "lon": _delta_int32_b64(q_lon),
+        "pk": _delta_int32_b64(q_pk),
+    })
+
+
+def serialize_pks(pks: list) -> str:
+    pks = pks or []
+    return serialize_pk_columns(
+        [pk.get("pk", 0) for pk in pks],
+        [pk.get("lat") for pk in pks],
+        [pk.get("lon") for pk in pks],
+    )
+
+
+# ----------------------------------------------------------------------
+# Fond de carte (régions)
+#
+# Cache process-wide : le geojson parsé (et sa sérialisation) par fichier.
+# La clé inclut le mtime du fichier pour suivre une mise à jour du module.
+# Les objets renvoyés sont partagés : ne pas les modifier.
+# ----------------------------------------------------------------------
+
+# Tolérance (degrés) de la variante simplifiée du fond de carte (~1 km)
+REGIONS_SIMPLIFY_TOLERANCE = 0.01
+
+
+def _simplify_regions(geojson: dict, tolerance: float) -> dict:
+    features = []
+    for feature in geojson.get("features", []):
+        geom = feature.get("geometry") or {}
+        if geom.get("type") == "Polygon":
+            polygons = [geom["coordinates"]]
+        elif geom.get("type") == "MultiPolygon":
+            polygons = geom["coordinates"]
+        else:
+            features.append(feature)
+            continue
+        simplified = []
+        for polygon in polygons:
+            rings = [simplify_polyline(ring, tolerance) for ring in polygon]
+            # Un anneau réduit à moins de 4 points (îlot) disparaît à cette échelle ;
+            # sans contour extérieur, ses trous n'ont plus de sens
+            if not rings or len(rings[0]) < 4:
+                continue
+            simplified.append([ring for ring in rings if len(ring) >= 4])
+        features.append(dict(feature, geometry={
+            "type": "MultiPolygon",
+            "coordinates": simplified,
+        }))
+    return dict(geojson, features=features)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_regions(path: str, mtime: float, simplified: bool) -> tuple:
+    with open(path, "r", encoding="utf-8") as f:
+        geojson = json.load(f)
+    if simplified:
+        geojson = _simplify_regions(geojson, REGIONS_SIMPLIFY_TOLERANCE)
+    return geojson, json.dumps(geojson)
+
+
+def load_regions(path: str, simplified: bool = False) -> tuple:
+    """(geojson, geojson sérialisé) depuis le cache, (None, "null") si absent."""
+    if not path or not os.path.exists(path):
+        return None, "null"
+    return _load_regions(path, os.path.getmtime(path), simplified)
+
+
 class LeyfaSIG:
     LON_MIN_FR, LON_MAX_FR = -5.2, 9.7
     LAT_MIN_FR, LAT_MAX_FR = 41.2, 51.2
@@ -39,6 +371,7 @@ class LeyfaSIG:
         lon_bounds: tuple = None,
         lat_bounds: tuple = None,
         svg_size: int = 600,
+        simplified_basemap: bool = False,
     ):
         self.svg_size = svg_size
         self.lon_min = lon_bounds[0] if lon_bounds else self.LON_MIN_FR
@@ -46,10 +379,11 @@ class LeyfaSIG:
         self.lat_min = lat_bounds[0] if lat_bounds else self.LAT_MIN_FR
         self.lat_max = lat_bounds[1] if lat_bounds else self.LAT_MAX_FR
 
-        self.regions_geojson = None
-        if regions_geojson_path and os.path.exists(regions_geojson_path):
-            with open(regions_geojson_path, "r", encoding="utf-8") as f:
-                self.regions_geojson = json.load(f)
+        # Fond de carte partagé via le cache du module (voir load_regions)
+        self.regions_geojson_path = regions_geojson_path
+        self.simplified_basemap = simplified_basemap
+        self.regions_geojson, self._regions_js = load_regions(
+            regions_geojson_path, simplified_basemap)
 
         self._layers = []
 
@@ -66,53 +400,34 @@ class LeyfaSIG:
         colour: str = None,
         odoo_id: int = None,
         ranges: list = None,
+        payload: dict = None,
     ):
+        """Ajoute une couche.
+
+        ``payload`` permet de fournir des blocs déjà sérialisés (voir
+        ``leyfa.ligne._sig_payload``) : track_coords / gares / pks sont alors
+        ignorés et le rendu se limite à une concaténation de chaînes.
+        """
         idx = len(self._layers)
         col = colour or LAYER_COLORS[idx % len(LAYER_COLORS)]
 
-        gares_data = []
-        for g in (gares or []):
-            lat = g.get("latitude") or g.get("lat")
-            lon = g.get("longitude") or g.get("lon")
-            if not lat or not lon:
-                continue
-            name = (g.get("name") or "").replace("\\", "\\\\").replace("'", "\\'")
-            pk   = (g.get("pk") or "").replace("'", "\\'")
-            is_v = "true" if g.get("isV") else "false"
-            is_f = "true" if g.get("isF") else "false"
-            gares_data.append(
-                f"{{lat:{lat},lon:{lon},name:'{name}',pk:'{pk}',isV:{is_v},isF:{is_f},col:'{col}'}}"
-            )
-
-        pks_data = []
-        for pk in (pks or []):
-            lat = pk.get("lat")
-            lon = pk.get("lon")
-            if not lat or not lon:
-                continue
-            pk_name = (pk.get("name") or "").replace("'", "\\'")
-            pk_val  = pk.get("pk", 0)
-            is_int  = "true" if pk_val == int(pk_val) else "false"
-            pk_col  = pk.get("color") or col
-            pks_data.append(
-                f"{{lat:{lat},lon:{lon},name:'{pk_name}',pk:{pk_val},isInt:{is_int},col:'{pk_col}'}}"
-            )
-
-        coords = track_coords or []
-        coords_js = (
-            "[" + ",".join(f"[{c[1]},{c[0]}]" for c in coords) + "]"
-        )
-
-        ranges_js = json.dumps(ranges or [])
+        if payload is None:
+            gares_js, n_gares = serialize_gares(gares)
+            payload = {
+                'coords_js': serialize_track(track_coords),
+                'gares_js':  gares_js,
+                'pks_js':    serialize_pks(pks),
+                'n_gares':   n_gares,
+            }
 
         self._layers.append(dict(
             label=label,
             colour=col,
-            coords_js=coords_js,
-            gares_js="[" + ",".join(gares_data) + "]",
-            pks_js="[" + ",".join(pks_data) + "]",
-            ranges_js=ranges_js,
-            n_gares=len(gares_data),
+            coords_js=payload['coords_js'],
+            gares_js=payload['gares_js'],
+            pks_js=payload['pks_js'],
+            ranges_js=json.dumps(ranges or []),
+            n_gares=payload['n_gares'],
             odoo_id=odoo_id,
         ))
 
@@ -131,8 +446,15 @@ class LeyfaSIG:
                 show_consistance_labels: bool = True,
                 show_safety_color: bool = False,
                 pk_legend_label: str = '',
-                sig_controller_id=None) -> str:
-        """Return the raw HTML page (no iframe wrapper) for use in a direct HTTP route."""
+                sig_controller_id=None,
+                data_url: str = None,
+                regions_url: str = None) -> str:
+        """Return the raw HTML page (no iframe wrapper) for use in a direct HTTP route.
+
+        With ``data_url`` the page is only a shell: layer geometries are
+        fetched from that URL (see ``layers_data_json``) and the basemap from
+        ``regions_url`` instead of being inlined.
+        """
         return self._build_inner_html(
             title=title,
             initial_zoom=initial_zoom,
@@ -150,8 +472,41 @@ class LeyfaSIG:
             show_safety_color=show_safety_color,
             show_consistance_labels=show_consistance_labels,
             pk_legend_label=pk_legend_label,
+            data_url=data_url,
+            regions_url=regions_url,
         )
 
+    @staticmethod
+    def render_frame(src: str, width: str = "100%", aspect_ratio: str = "1/1") -> str:
+        """Iframe pointing to a map shell served over HTTP (``/leyfa/sig/map``)."""
+        return LeyfaSIG._frame(f'src="{src}"', width, aspect_ratio)
+
+    @staticmethod
+    def _frame(src_attr: str, width: str, aspect_ratio: str) -> str:
+        return (
+            f'<div style="width:{width};aspect-ratio:{aspect_ratio};'
+            f'font-family:sans-serif;background:#fff;border-radius:8px;overflow:hidden;">'
+            f'<iframe {src_attr} '
+            f'style="width:100%;height:100%;min-height:250px;border:none;border-radius:6px;" '
+            f'sandbox="allow-scripts allow-downloads allow-same-origin allow-popups">'
+            f'</iframe></div>'
+        )
+
+    def layers_data_json(self, coords_only: bool = False) -> str:
+        """Géométries des couches, dans l'ordre, pour la route /leyfa/sig/data.
+
+        ``coords_only`` : seul le tracé est renvoyé (changement de niveau de
+        détail côté client).
+        """
+        if coords_only:
+            parts = [f'{{"coords":{l["coords_js"]}}}' for l in self._layers]
+        else:
+            parts = [
+                f'{{"gares":{l["gares_js"]},"pks":{l["pks_js"]},"coords":{l["coords_js"]}}}'
+                for l in self._layers
+            ]
+        return '{"layers":[' + ",".join(parts) + ']}'
+
     def render(self, title: str = "", width: str = "100%", aspect_ratio: str = "1/1",
             initial_zoom: float = 5,
             initial_lat: float = None,
@@ -187,14 +542,7 @@ class LeyfaSIG:
             show_safety_color=show_safety_color,
         )
         srcdoc = inner_html.replace('"', '&quot;')
-        return (
-            f'<div style="width:{width};aspect-ratio:{aspect_ratio};'
-            f'font-family:sans-serif;background:#fff;border-radius:8px;overflow:hidden;">'
-            f'<iframe srcdoc="{srcdoc}" '
-            f'style="width:100%;height:100%;min-height:250px;border:none;border-radius:6px;" '
-            f'sandbox="allow-scripts allow-downloads allow-same-origin allow-popups">'
-            f'</iframe></div>'
-        )
+        return self._frame(f'srcdoc="{srcdoc}"', width, aspect_ratio)
 
     def _build_inner_html(self, title: str = "", 
                         initial_zoom: float = 5,
@@ -212,8 +560,17 @@ class LeyfaSIG:
                         show_consistance_labels: bool = True,
                         show_safety_color: bool = False,
                         pk_legend_label: str = '',
-                        sig_controller_id=None) -> str:
-        regions_geojson_js = json.dumps(self.regions_geojson) if self.regions_geojson else "null"
+                        sig_controller_id=None,
+                        data_url: str = None,
+                        regions_url: str = None) -> str:
+        if data_url and regions_url:
+            regions_geojson_js = "null"
+        else:
+            regions_geojson_js = self._regions_js
+            regions_url = None
+        _data_url_js = _dumps(data_url)
+        _lod_zooms_js = _dumps([z for z, _tol in TRACK_LOD_LEVELS])
+        _regions_url_js = _dumps(regions_url)
         all_layers_js = self._build_layers_js()
 
         multi_layer = len(self._layers) >= 2
@@ -472,7 +829,10 @@ body {{ background:#cfe2f3; overflow:hidden; font-family:sans-serif; }}
 <script>
 // ── Data ─────────────────────────────────────────────────────────────────
 const LAYERS        = {all_layers_js};
-const REGIONS_DATA  = {regions_geojson_js};
+let   REGIONS_DATA  = {regions_geojson_js};
+const DATA_URL      = {_data_url_js};
+const REGIONS_URL   = {_regions_url_js};
+const LOD_MAX_ZOOMS = {_lod_zooms_js};
 const CENTER_LAT    = {center_lat};
 const CENTER_LON    = {center_lon};
 const MULTI_LAYER   = {'true' if multi_layer else 'false'};
@@ -482,9 +842,83 @@ const EXPORT_H = {_export_h};
 let SHOW_SAFETY_COLOR = {_show_safety_color};
 const PK_LEGEND_LABEL = '{_pk_legend_label}';
 
+// ── Compact PK columns (see serialize_pk_columns) ─────────────────────────
+function decodeDeltaInt32(b64) {{
+    const bin = atob(b64 || '');
+    const bytes = new Uint8Array(bin.length);
+    for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+    const out = new Int32Array(bytes.buffer);
+    for (let i = 1; i < out.length; i++) out[i] += out[i - 1];
+    return out;
+}}
+function pad3(v) {{
+    const a = String(Math.abs(v));
+    return v < 0 ? '-' + a.padStart(2, '0') : a.padStart(3, '0');
+}}
+function decodePks(enc) {{
+    const lat = decodeDeltaInt32(enc.lat);
+    const lon = decodeDeltaInt32(enc.lon);
+    const pkm = decodeDeltaInt32(enc.pk);
+    const pks = new Array(enc.n || 0);
+    for (let i = 0; i < pks.length; i++) {{
+        const m     = pkm[i];
+        const pkInt = Math.trunc(m / {PK_VALUE_SCALE});
+        const dec   = m - pkInt * {PK_VALUE_SCALE};
+        pks[i] = {{
+            lat:   lat[i] / {PK_COORD_SCALE},
+            lon:   lon[i] / {PK_COORD_SCALE},
+            pk:    m / {PK_VALUE_SCALE},
+            isInt: dec === 0,
+            name:  pad3(pkInt) + (m >= 0 ? '+' : '-') + pad3(Math.abs(dec)),
+        }};
+    }}
+    return pks;
+}}
+function normalizeLayer(layer) {{
+    if (layer.pks && !Array.isArray(layer.pks)) layer.pks = decodePks(layer.pks);
+}}
+LAYERS.forEach(normalizeLayer);
+
 // Per-layer visibility state (all visible by default)
 const layerVisible = LAYERS.map(() => true);
 
+// Lazy data: when DATA_URL is set, LAYERS only carries metadata (label,
+// colour, ranges) and the geometries are merged in once fetched. The data
+// route answers with an ETag, so unchanged geometry comes from browser cache.
+// The track is served at the level of detail matching the zoom (LOD_MAX_ZOOMS)
+// and only the coordinates are refetched when that level changes.
+let _dataReadyResolve;
+const DATA_READY = new Promise(resolve => {{ _dataReadyResolve = resolve; }});
+let loadedLod    = null;
+let requestedLod = null;
+
+function lodForZoom(z) {{
+    const i = LOD_MAX_ZOOMS.findIndex(m => z <= m);
+    return i < 0 ? LOD_MAX_ZOOMS.length : i;
+}}
+
+function loadLayerData(lod, coordsOnly) {{
+    requestedLod = lod;
+    const url = DATA_URL + '?lod=' + lod + (coordsOnly ? '&coords_only=1' : '');
+    return fetch(url, {{credentials: 'same-origin'}})
+        .then(r => r.ok ? r.json() : {{layers: []}})
+        .then(data => {{
+            if (lod !== requestedLod) return;   // stale answer, a newer one is on its way
+            (data.layers || []).forEach((l, i) => {{
+                if (!LAYERS[i]) return;
+                Object.assign(LAYERS[i], l);
+                normalizeLayer(LAYERS[i]);
+            }});
+            loadedLod = lod;
+        }});
+}}
+
+function loadRegions() {{
+    return fetch(REGIONS_URL)
+        .then(r => r.ok ? r.json() : null)
+        .then(geo => {{ REGIONS_DATA = geo; }});
+}}
+
 // ── Tile catalogue ────────────────────────────────────────────────────────
 const TILE_PROVIDERS = {{
     osmfr:              {{ url:'https://{{s}}.tile.openstreetmap.fr/osmfr/{{z}}/{{x}}/{{y}}.png',     sub:'abc', attr:'© OSM France / ODbL' }},
@@ -1489,8 +1923,8 @@ async function autoSavePng() {{
     }}
 }}
 
-// Auto-save 3s after map loads (tiles need time to load)
-setTimeout(autoSavePng, 3000);
+// Auto-save 3s after map data loads (tiles need time to load)
+DATA_READY.then(() => setTimeout(autoSavePng, 3000));
 
 // ── INIT ──────────────────────────────────────────────────────────────────
 const CTRL_ID      = {sig_controller_id if sig_controller_id else 'null'};
@@ -1644,6 +2078,26 @@ if ({str(initial_tiles_enabled).lower()}) {{
 
 redrawAll();
 
+if (DATA_URL || REGIONS_URL) {{
+    Promise.all([
+        DATA_URL ? loadLayerData(lodForZoom(leafletMap.getZoom()), false) : null,
+        (!REGIONS_DATA && REGIONS_URL) ? loadRegions() : null,
+    ])
+        .catch(e => console.warn('SIG data load failed:', e))
+        .finally(() => {{ _dataReadyResolve(); redrawAll(); }});
+
+    leafletMap.on('zoomend', () => {{
+        if (!DATA_URL || loadedLod === null) return;
+        const lod = lodForZoom(leafletMap.getZoom());
+        if (lod === loadedLod || lod === requestedLod) return;
+        loadLayerData(lod, true)
+            .then(redrawAll)
+            .catch(e => console.warn('SIG LOD load failed:', e));
+    }});
+}} else {{
+    _dataReadyResolve();
+}}
+
 // Lift the flag AND cancel any timers queued during init
 setTimeout(() => {{
     clearTimeout(_persistTimer);
@@ -1659,56 +2113,23 @@ setTimeout(() => {{
     # Private helpers
     # ------------------------------------------------------------------
 
-    def _render_regions(self) -> str:
-        if not self.regions_geojson:
-            return ""
-        W = H = self.svg_size
-        paths = []
-        for feature in self.regions_geojson.get("features", []):
-            geom      = feature.get("geometry", {})
-            geom_type = geom.get("type")
-
-            def ring_to_d(ring):
-                pts = []
-                for lon, lat in ring:
-                    x = (lon - self.lon_min) / (self.lon_max - self.lon_min) * W
-                    y = (self.lat_max - lat) / (self.lat_max - self.lat_min) * H
-                    pts.append(f"{round(x,1)},{round(y,1)}")
-                return "M " + " L ".join(pts) + " Z "
-
-            d = ""
-            if geom_type == "Polygon":
-                for ring in geom["coordinates"]:
-                    d += ring_to_d(ring)
-            elif geom_type == "MultiPolygon":
-                for polygon in geom["coordinates"]:
-                    for ring in polygon:
-                        d += ring_to_d(ring)
-            if d:
-                paths.append(
-                    f'<path d="{d}" fill="#e8ede8" stroke="#e8ede8" stroke-width="0.5"/>'
-                )
-        return "\n".join(paths)
-
     def _build_layers_js(self) -> str:
         parts = []
         for l in self._layers:
-            col = l["colour"].replace("'", "\\'")
             parts.append(
                 f'{{'
-                f'label:\'{l["label"]}\','
-                f'colour:\'{col}\','
-                f'gares:{l["gares_js"]},'
-                f'pks:{l["pks_js"]},'
-                f'coords:{l["coords_js"]},'
-                f'ranges:{l.get("ranges_js", "[]")}'
+                f'"label":{_dumps(l["label"] or "")},'
+                f'"colour":{_dumps(l["colour"])},'
+                f'"gares":{l["gares_js"]},'
+                f'"pks":{l["pks_js"]},'
+                f'"coords":{l["coords_js"]},'
+                f'"ranges":{l.get("ranges_js", "[]")}'
                 f'}}'
             )
         return "[" + ",".join(parts) + "]"
     
 from odoo import models, fields, api
-import json
-import os
+import hashlib
 
 class LeyfaSigController(models.Model):
     _name = 'leyfa.sig.controller'
@@ -1778,11 +2199,10 @@ class LeyfaSigController(models.Model):
         # but changes to state alone do NOT retrigger a recompute.
         'layer_ids',
         'layer_ids.ligne_id',
-        'layer_ids.ligne_id.geo_shape',
-        'layer_ids.ligne_id.gare_ids',
-        'layer_ids.ligne_id.pk_ids',
+        'layer_ids.ligne_id.sig_payload_version',
         'layer_ids.highlight_pk_from',
         'layer_ids.highlight_pk_to',
+        'layer_ids.ranges_json',
         'layer_ids.colour',
         'layer_ids.label',
         'layer_ids.visible',
@@ -1791,94 +2211,86 @@ class LeyfaSigController(models.Model):
         'name',
     )
     def _compute_map_html(self):
-        from .leyfa_sig import LeyfaSIG
-        GEOJSON_PATH = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)),
-            'static', 'src', 'geoJSON', 'regions.geojson'
-        )
+        # La carte n'est plus embarquée dans le champ : simple iframe vers la
+        # coquille /leyfa/sig/map, qui charge ensuite /leyfa/sig/data. Le jeton
+        # ``v`` force le rechargement de l'iframe quand les données changent.
         for rec in self:
-            sig = LeyfaSIG(regions_geojson_path=GEOJSON_PATH)
-
-            for layer in rec.layer_ids:
-                track_coords, gares, pks = [], [], []
-
-                # ── Resolve data source ───────────────────────────────────
-                if layer.ligne_id:
-                    ligne = layer.ligne_id
-
-                    # Track geometry — read directly from the line record
-                    if ligne.geo_shape:
-                        try:
-                            geo = json.loads(ligne.geo_shape)
-                            if geo.get('type') == 'LineString':
-                                track_coords = geo['coordinates']
-                            elif geo.get('type') == 'MultiLineString':
-                                for seg in geo['coordinates']:
-                                    track_coords.extend(seg)
-                        except Exception:
-                            pass
-
-                    # Stations — read directly from the line's gare_ids
-                    for g in ligne.gare_ids:
-                        if not g.latitude or not g.longitude:
-                            continue
-                        gares.append({
-                            'name': g.name or '',
-                            'latitude': g.latitude,
-                            'longitude': g.longitude,
-                            'isV': g.is_voyageurs,
-                            'isF': g.is_fret,
-                        })
-
-                    pks = []
-                    for pk_point in ligne.pk_ids:
-                        if not pk_point.lat or not pk_point.lon:
-                            continue
-                        pks.append({
-                            'pk':   pk_point.pk,
-                            'name': pk_point.name or str(pk_point.pk),
-                            'lat':  pk_point.lat,
-                            'lon':  pk_point.lon,
-                            # no color here
-                        })
-
-                    # Parse ranges from layer
-                    try:
-                        ranges = json.loads(layer.ranges_json or '[]')
-                    except Exception:
-                        ranges = []
-
-                    sig.add_ligne_layer(
-                        label=layer.label,
-                        track_coords=track_coords,
-                        gares=gares,
-                        pks=pks,
-                        colour=layer.colour,
-                        odoo_id=layer.id,
-                        ranges=ranges,
-                    )
-
-            rec.map_html = sig.render(
-                title=f"<strong>{rec.name}</strong>",
+            if not rec.id:
+                rec.map_html = False
+                continue
+            token = hashlib.sha1(json.dumps([
+                rec.name, rec.show_consistance_labels, rec.show_safety_color,
+                [(l.id, l.label, l.colour, l.visible, l.ranges_json,
+                  l.ligne_id.sig_payload_version) for l in rec.layer_ids],
+            ], default=str).encode()).hexdigest()[:12]
+            rec.map_html = LeyfaSIG.render_frame(
+                f"/leyfa/sig/map/{rec.id}?v={token}",
                 width="100%",
                 aspect_ratio="1/1",
-                initial_zoom=rec.zoom,
-                initial_lat=rec.center_lat,
-                initial_lon=rec.center_lon,
-                initial_layers_visible=[l.visible for l in rec.layer_ids],
-                initial_tiles_enabled=rec.tiles_enabled,
-                initial_tile_type=rec.tile_type,
-                initial_tile_opacity=rec.tile_opacity,
-                initial_station_filter=rec.station_filter,
-                initial_pk_filter=rec.pk_filter,
-                initial_show_grid=rec.show_grid,
-                initial_labels_on=rec.labels_on,
-                sig_controller_id=rec.id,
-                show_consistance_labels=rec.show_consistance_labels,
-                show_safety_color=rec.show_safety_color,
-                pk_legend_label=rec.pk_legend_label or '',
             )
 
+    def _build_sig(self, with_data=True, lod=None):
+        """LeyfaSIG alimenté avec les blocs pré-sérialisés de chaque ligne.
+
+        Partagé entre la coquille ``/leyfa/sig/map`` (``with_data=False`` :
+        métadonnées seules) et la route ``/leyfa/sig/data`` : aucune relecture
+        des PKs / gares ici, seulement le cache ``leyfa.ligne.sig_*_js``.
+        ``lod`` choisit le niveau de détail du tracé (voir TRACK_LOD_LEVELS),
+        par défaut celui du zoom enregistré.
+        """
+        self.ensure_one()
+        sig = LeyfaSIG(regions_geojson_path=REGIONS_GEOJSON_PATH)
+
+        layers = self.layer_ids.filtered('ligne_id')
+        if with_data:
+            layers.ligne_id.fetch(layers.ligne_id._SIG_PAYLOAD_FIELDS)
+        for layer in layers:
+            try:
+                ranges = json.loads(layer.ranges_json or '[]')
+            except ValueError:
+                ranges = []
+
+            sig.add_ligne_layer(
+                label=layer.label,
+                colour=layer.colour,
+                odoo_id=layer.id,
+                ranges=ranges,
+                payload=layer.ligne_id._sig_payload(
+                    with_data=with_data,
+                    lod=lod_for_zoom(self.zoom) if lod is None else lod,
+                ),
+            )
+        return sig
+
+    def _sig_data_etag(self, lod=None, coords_only=False):
+        """Empreinte des géométries servies par /leyfa/sig/data."""
+        self.ensure_one()
+        layers = self.layer_ids.filtered('ligne_id')
+        key = f"{lod}:{int(coords_only)}|" + ','.join(
+            f"{l.id}:{l.ligne_id.sig_payload_version}" for l in layers)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _render_options(self):
+        self.ensure_one()
+        return dict(
+            title=f"<strong>{self.name}</strong>",
+            initial_zoom=self.zoom,
+            initial_lat=self.center_lat,
+            initial_lon=self.center_lon,
+            initial_layers_visible=[l.visible for l in self.layer_ids.filtered('ligne_id')],
+            initial_tiles_enabled=self.tiles_enabled,
+            initial_tile_type=self.tile_type,
+            initial_tile_opacity=self.tile_opacity,
+            initial_station_filter=self.station_filter,
+            initial_pk_filter=self.pk_filter,
+            initial_show_grid=self.show_grid,
+            initial_labels_on=self.labels_on,
+            sig_controller_id=self.id,
+            show_consistance_labels=self.show_consistance_labels,
+            show_safety_color=self.show_safety_color,
+            pk_legend_label=self.pk_legend_label or '',
+        )
+
     def save_state(self, state: dict):
         self.ensure_one()
         vals = {
@@ -1913,7 +2325,19 @@ class LeyfaSigController(models.Model):
     map_png_filename = fields.Char(default="carte_sig.png")
 
     def save_png(self, b64_data: str):
+        """Enregistre la capture de la carte, sauf si elle est identique à
+        la précédente (cas de l'enregistrement automatique à chaque
+        ouverture). Retourne True si la capture a été écrite."""
         self.ensure_one()
+        if b64_data:
+            current = self.env['ir.attachment'].sudo().search([
+                ('res_model', '=', self._name),
+                ('res_id', '=', self.id),
+                ('res_field', '=', 'map_png'),
+            ], limit=1)
+            checksum = current._compute_checksum(base64.b64decode(b64_data))
+            if current and current.checksum == checksum:
+                return False
         self.map_png = b64_data
         return True
 
@@ -5,15 +5,123 @@ import base64
 import csv
 import io
 from odoo.exceptions import UserError
+import hashlib
 import json
 import os
-from .leyfa_sig import LeyfaSIG
+import re
+from .leyfa_sig import (
+    REGIONS_GEOJSON_PATH, TRACK_LOD_LEVELS, LeyfaSIG, lod_for_zoom,
+    serialize_gares, serialize_pk_columns, serialize_track,
+    simplify_polyline, track_lod_levels, track_segments_from_geo_shape,
+)
 
 try:
     import openpyxl
 except ImportError:
     openpyxl = None
 
+_logger = logging.getLogger(__name__)
+
+
+def _sql_pad3(expr):
+    """Équivalent SQL de f"{n:03d}" pour une expression entière."""
+    return (f"CASE WHEN ({expr}) < 0 "
+            f"THEN '-' || lpad(abs({expr})::text, greatest(2, length(abs({expr})::text)), '0') "
+            f"ELSE lpad(({expr})::text, greatest(3, length(({expr})::text)), '0') END")
+
+
+def _pk_name_sql(col):
+    """Nom d'un PK calculé en SQL, même règle que PK._compute_name."""
+    return (
+        _sql_pad3(f"trunc({col})::int")
+        + f" || CASE WHEN {col} >= 0 THEN '+' ELSE '-' END || "
+        + _sql_pad3(f"abs(round((({col} - trunc({col})) * 1000)::numeric)::int)")
+    )
+
+
+class _ChunkStream:
+    """Objet fichier minimal au-dessus d'un itérateur de blocs ``bytes``,
+    lu par ``COPY ... FROM STDIN`` sans jamais tout matérialiser."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buf):
+            self._buf = next(self._chunks, b'')
+            self._pos = 0
+            if not self._buf:
+                return b''
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        data = self._buf[self._pos:end]
+        self._pos += len(data)
+        return data
+
+
+def _char_or_false(value):
+    return str(value) if value not in (None, False, '') else False
+
+
+_FEATURES_RE = re.compile(r'"features"\s*:\s*\[')
+
+
+def iter_geojson_features(stream, chunk_size=1 << 16):
+    """Features d'une FeatureCollection, décodées une à une depuis un flux texte.
+
+    Seule la feature en cours (et un bloc de lecture) est en mémoire : le
+    tableau ``features`` est parcouru avec ``JSONDecoder.raw_decode``.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+
+    def fill(size=chunk_size):
+        nonlocal buf, eof
+        data = stream.read(size)
+        if not data:
+            eof = True
+        buf += data
+
+    # Recherche de l'ouverture du tableau "features"
+    while True:
+        match = _FEATURES_RE.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        if eof:
+            raise UserError("Le fichier doit être une FeatureCollection GeoJSON.")
+        buf = buf[-64:]     # garder de quoi recoller une clé coupée entre deux blocs
+        fill()
+
+    read_size = chunk_size
+    while True:
+        pos = 0
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        buf = buf[pos:]
+        if not buf:
+            if eof:
+                raise UserError("Fichier GeoJSON invalide : tableau features non terminé.")
+            fill()
+            continue
+        if buf[0] == ']':
+            return
+        try:
+            feature, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise UserError(f"Fichier GeoJSON invalide : {e}")
+            # Feature incomplète : lire davantage (taille doublée pour les
+            # très longues géométries, afin de ne pas re-parser à chaque bloc)
+            fill(read_size)
+            read_size *= 2
+            continue
+        read_size = chunk_size
+        buf = buf[end:]
+        yield feature
+
 
 class PK(models.Model):
     _name = 'leyfa.pk'
@@ -29,6 +137,9 @@ class PK(models.Model):
     lat = fields.Float(string="Latitude")
     lon = fields.Float(string="Longitude")
 
+    # Recherche par (ligne, PK) : upsert de l'import, tranches de PK
+    _ligne_pk_idx = models.Index('(ligne_id, pk)')
+
     @api.depends('pk')
     def _compute_name(self):
         for record in self:
@@ -67,8 +178,28 @@ class Ligne(models.Model):
         for record in self:
             surnom = record.surnom or ''
             record.display_name = f"[{surnom}] {record.name}" if surnom else record.name
+
+    # Référentiel du code affaire : voir rail.code.affaire.parser
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if not vals.keys().isdisjoint(('surnom', 'active')):
+            self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
     
     geo_shape = fields.Text(string="Tracé Géométrique (JSON)", translate=False)
+    geo_shape_hash = fields.Char(compute='_compute_geo_shape_hash', store=True,
+                                 help="Empreinte du tracé, pour ignorer les imports inchangés")
     pk_debut = fields.Char(string="PK Début ligne")
     pk_fin = fields.Char(string="PK Fin ligne")
     statut_ligne = fields.Char(string="Statut")
@@ -81,46 +212,157 @@ class Ligne(models.Model):
         store=False,
     )
 
+    # ── Cache SIG ─────────────────────────────────────────────────────────
+    # Blocs JSON prêts à être concaténés dans la carte. Recalculés uniquement
+    # quand le tracé, les PKs ou les gares changent ; sig_payload_version sert
+    # d'empreinte pour les dépendances et le cache HTTP.
+    sig_coords_js = fields.Text(compute='_compute_sig_payload', store=True, prefetch=False)
+    # Tracés simplifiés (Douglas–Peucker), un bloc JSON par ligne de texte,
+    # dans l'ordre de TRACK_LOD_LEVELS.
+    sig_coords_lod_js = fields.Text(compute='_compute_sig_payload', store=True, prefetch=False)
+    sig_gares_js = fields.Text(compute='_compute_sig_payload', store=True, prefetch=False)
+    sig_pks_js = fields.Text(compute='_compute_sig_payload', store=True, prefetch=False)
+    sig_gares_count = fields.Integer(compute='_compute_sig_payload', store=True)
+    sig_payload_version = fields.Char(compute='_compute_sig_payload', store=True)
+
+    _SIG_PAYLOAD_FIELDS = ['sig_coords_js', 'sig_coords_lod_js', 'sig_gares_js',
+                           'sig_pks_js', 'sig_gares_count']
+
+    @api.depends('geo_shape',
+                 'pk_ids', 'pk_ids.pk', 'pk_ids.lat', 'pk_ids.lon',
+                 'gare_ids', 'gare_ids.name', 'gare_ids.latitude', 'gare_ids.longitude',
+                 'gare_ids.is_voyageurs', 'gare_ids.is_fret')
+    def _compute_sig_payload(self):
+        for rec in self:
+            segments = track_segments_from_geo_shape(rec.geo_shape)
+            coords_js = serialize_track([c for seg in segments for c in seg])
+            coords_lod_js = '\n'.join(
+                serialize_track(level) for level in track_lod_levels(segments))
+            gares_js, n_gares = serialize_gares([{
+                'name': g.name or '',
+                'latitude': g.latitude,
+                'longitude': g.longitude,
+                'isV': g.is_voyageurs,
+                'isF': g.is_fret,
+            } for g in rec.gare_ids])
+            # Lecture colonne par colonne : pas de dict intermédiaire par PK
+            pk_points = rec.pk_ids.sorted('pk')
+            pks_js = serialize_pk_columns(
+                pk_points.mapped('pk'), pk_points.mapped('lat'), pk_points.mapped('lon'))
+
+            rec.sig_coords_js = coords_js
+            rec.sig_coords_lod_js = coords_lod_js
+            rec.sig_gares_js = gares_js
+            rec.sig_pks_js = pks_js
+            rec.sig_gares_count = n_gares
+            rec.sig_payload_version = hashlib.sha1(
+                '\x1f'.join((coords_js, gares_js, pks_js)).encode()
+            ).hexdigest()[:16]
+
+    def _sig_payload(self, with_data=True, lod=None):
+        """Blocs pré-sérialisés attendus par LeyfaSIG.add_ligne_layer(payload=...).
+
+        Sans ``with_data``, les géométries sont laissées vides (coquille de
+        carte chargée à la demande) et les gros champs ne sont pas lus.
+        ``lod`` : niveau de détail du tracé, None ou hors bornes = complet.
+        """
+        self.ensure_one()
+        if not with_data:
+            return {'coords_js': '[]', 'gares_js': '[]', 'pks_js': '[]',
+                    'n_gares': self.sig_gares_count}
+        return {
+            'coords_js': self._sig_track_js(lod),
+            'gares_js': self.sig_gares_js or '[]',
+            'pks_js': self.sig_pks_js or '[]',
+            'n_gares': self.sig_gares_count,
+        }
+
+    # ── Accès aux PKs par plage ───────────────────────────────────────────
+    # Requête de plage servie par l'index (ligne_id, pk) de leyfa.pk, au
+    # lieu de parcourir pk_ids en Python.
+
+    @api.model
+    def _pk_bounds(self, windows):
+        """Emprise (min_lat, max_lat, min_lon, max_lon) des PKs géolocalisés
+        dans une liste de fenêtres [(ligne_id, pk_from, pk_to)], en une requête.
+        None si aucun point."""
+        if not windows:
+            return None
+        self.env['leyfa.pk'].flush_model(['ligne_id', 'pk', 'lat', 'lon'])
+        ligne_ids, lows, highs = zip(*(
+            (lid, min(a, b), max(a, b)) for lid, a, b in windows
+        ))
+        self.env.cr.execute("""
+            SELECT min(p.lat), max(p.lat), min(p.lon), max(p.lon)
+              FROM unnest(%s::int[], %s::float8[], %s::float8[]) AS w(ligne_id, lo, hi)
+              JOIN leyfa_pk p ON p.ligne_id = w.ligne_id AND p.pk BETWEEN w.lo AND w.hi
+             WHERE p.lat != 0 AND p.lon != 0
+        """, [list(ligne_ids), list(lows), list(highs)])
+        bounds = self.env.cr.fetchone()
+        return bounds if bounds and bounds[0] is not None else None
+
+    def _sig_track_js(self, lod=None):
+        self.ensure_one()
+        if lod is not None and 0 <= lod < len(TRACK_LOD_LEVELS) and self.sig_coords_lod_js:
+            levels = self.sig_coords_lod_js.split('\n')
+            if lod < len(levels):
+                return levels[lod]
+        return self.sig_coords_js or '[]'
+
+    @api.depends('geo_shape')
+    def _compute_geo_shape_hash(self):
+        for rec in self:
+            rec.geo_shape_hash = rec._hash_geo_shape(rec.geo_shape)
+
+    @staticmethod
+    def _hash_geo_shape(geo_shape):
+        return hashlib.sha1(geo_shape.encode()).hexdigest() if geo_shape else False
+
     @api.depends('pk_ids', 'gare_ids', 'pk_ids.lat', 'pk_ids.lon',
-                'gare_ids.latitude', 'gare_ids.longitude')
+                'gare_ids.latitude', 'gare_ids.longitude', 'sig_coords_lod_js')
     def _compute_map_html(self):
-        import os, json
-        GEOJSON_PATH = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)),
-            'static', 'src', 'geoJSON', 'regions.geojson'
-        )
         for rec in self:
             if not rec.pk_ids:
                 rec.map_html = '<div style="color:#94a3b8;padding:16px;">Aucun PK disponible</div>'
                 continue
 
-            sig = LeyfaSIG(regions_geojson_path=GEOJSON_PATH)
+            # Aperçu réduit : le fond de carte simplifié suffit
+            sig = LeyfaSIG(regions_geojson_path=REGIONS_GEOJSON_PATH,
+                           simplified_basemap=True)
+
+            # Tracé simplifié au niveau du zoom initial ; à défaut de geo_shape,
+            # polyligne des PKs (triés) simplifiée de la même façon.
+            initial_zoom = 8
+            lod = lod_for_zoom(initial_zoom)
+            if rec.geo_shape:
+                coords_js = rec._sig_track_js(lod)
+            else:
+                pk_points = [[p.lon, p.lat] for p in rec.pk_ids.sorted('pk') if p.lat and p.lon]
+                coords_js = serialize_track(
+                    simplify_polyline(pk_points, TRACK_LOD_LEVELS[lod][1]))
 
-            track_coords = [(pk.lat, pk.lon) for pk in rec.pk_ids if pk.lat and pk.lon]
-            gares = [{
+            gares_js, n_gares = serialize_gares([{
                 'name': g.name,
                 'lat':  g.latitude,
                 'lon':  g.longitude,
                 'pk':   g.pk_text,
                 'isV':  True,
                 'isF':  False,
-            } for g in rec.gare_ids if g.latitude and g.longitude]
-            pks = [{
-                'pk':    pk.pk,
-                'name':  pk.name,
-                'lat':   pk.lat,
-                'lon':   pk.lon,
-                'isInt': (pk.pk == int(pk.pk)) if pk.pk else False,
-            } for pk in rec.pk_ids if pk.lat and pk.lon]
+            } for g in rec.gare_ids])
+            pks_js = serialize_pk_columns(
+                rec.pk_ids.mapped('pk'), rec.pk_ids.mapped('lat'), rec.pk_ids.mapped('lon'))
 
             sig.add_ligne_layer(
                 label=rec.name,
-                track_coords=track_coords,
-                gares=gares,
-                pks=pks,
                 colour='#1a56db',
                 odoo_id=None,
                 ranges=[],
+                payload={
+                    'coords_js': coords_js,
+                    'gares_js': gares_js,
+                    'pks_js': pks_js,
+                    'n_gares': n_gares,
+                },
             )
 
             # Use render() which wraps in an iframe with fixed dimensions
@@ -128,7 +370,7 @@ class Ligne(models.Model):
                 title=rec.name or '',
                 width='100%',
                 aspect_ratio='16/9',
-                initial_zoom=8,
+                initial_zoom=initial_zoom,
                 initial_station_filter='all',
                 initial_labels_on=True,
                 initial_pk_filter='km',
@@ -142,7 +384,7 @@ class Gare(models.Model):
     _order = 'pk_metrique asc'
 
     name = fields.Char(string="Nom de la Gare", required=True)
-    code_uic = fields.Char(string="Code UIC")
+    code_uic = fields.Char(string="Code UIC", index=True)
     pk_text = fields.Char(string="PK (Format 000+000)")
     pk_metrique = fields.Integer(string="PK (mètres)", help="Utilisé pour le tri")
     commune = fields.Char(string="Commune")
@@ -156,6 +398,9 @@ class Gare(models.Model):
     is_voyageurs = fields.Boolean(string="Gare Voyageurs", default=False)
     is_fret = fields.Boolean(string="Gare Fret", default=False)
 
+    # Recherche des gares encadrant une zone de PK (description consistance)
+    _ligne_pk_idx = models.Index('(ligne_id, pk_metrique)')
+
 class ImportGaresWizard(models.TransientModel):
     _name = 'import.gares.wizard' # On définit le nom une fois pour toutes
     _description = 'Importateur Excel SNCF'
@@ -163,113 +408,244 @@ class ImportGaresWizard(models.TransientModel):
     file = fields.Binary(string="Fichier Excel (.xlsx)", required=True)
     filename = fields.Char()
 
-    def action_import(self):
-        """ Import du référentiel des GARES (Excel 1) """
-        if not self.file: return
-        
-        file_data = base64.b64decode(self.file)
-        wb = openpyxl.load_workbook(io.BytesIO(file_data), data_only=True)
-        sheet = wb.active
+    # Champs comparés pour détecter une gare inchangée au ré-import
+    _GARE_IMPORT_FIELDS = [
+        'name', 'code_uic', 'pk_text', 'pk_metrique', 'commune', 'departement',
+        'longitude', 'latitude', 'ligne_id', 'is_voyageurs', 'is_fret',
+    ]
 
-        ligne_obj = self.env['leyfa.ligne']
-        gare_obj = self.env['leyfa.gare']
+    @staticmethod
+    def _parse_gare_row(row):
+        """Valeurs d'une ligne du référentiel (sans ligne_id), ou None."""
+        if not row[4]:
+            return None  # Si pas de code ligne, on passe
 
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            if not row[4]: continue  # Si pas de code ligne, on passe
-            
-            code_ligne = str(row[4]).strip()
-            
-            # Recherche ou création de la ligne
-            ligne = ligne_obj.search([('name', '=', code_ligne)], limit=1)
-            if not ligne:
-                ligne = ligne_obj.create({
-                    'name': code_ligne, 
-                    'surnom': code_ligne[:3]
-                })
-
-            # Calcul du PK métrique pour le tri
-            pk_m = 0
-            pk_str = str(row[6])
-            if '+' in pk_str:
-                try:
-                    parts = pk_str.split('+')
-                    pk_m = int(parts[0]) * 1000 + int(parts[1])
-                except: pk_m = 0
-
-            # Création de la gare avec coordonnées
-            gare_obj.create({
-                'name': str(row[1]).strip(),
-                'code_uic': str(row[0]).strip(),
-                'pk_text': pk_str,
-                'pk_metrique': pk_m,
-                'commune': str(row[7]),
-                'departement': str(row[8]),
-                'longitude': float(row[13]) if row[13] else 0.0,
-                'latitude': float(row[14]) if row[14] else 0.0,
-                'ligne_id': ligne.id,
-                'is_voyageurs': True if str(row[3]) == "O" else False,
-                'is_fret': True if str(row[2]) == "O" else False,
-            })
-        return {'type': 'ir.actions.client', 'tag': 'reload'}
+        # Calcul du PK métrique pour le tri
+        pk_m = 0
+        pk_str = str(row[6])
+        if '+' in pk_str:
+            try:
+                parts = pk_str.split('+')
+                pk_m = int(parts[0]) * 1000 + int(parts[1])
+            except ValueError:
+                pk_m = 0
 
-    def action_import_geometry(self):
-        """Import des TRACÉS et PK depuis un fichier GeoJSON"""
-        if not self.file:
-            return
+        return {
+            'name': str(row[1]).strip(),
+            'code_uic': str(row[0]).strip() if row[0] is not None else False,
+            'pk_text': pk_str,
+            'pk_metrique': pk_m,
+            'commune': str(row[7]),
+            'departement': str(row[8]),
+            'longitude': round(float(row[13]), 7) if row[13] else 0.0,
+            'latitude': round(float(row[14]), 7) if row[14] else 0.0,
+            'is_voyageurs': str(row[3]) == "O",
+            'is_fret': str(row[2]) == "O",
+        }
 
-        import json
+    @staticmethod
+    def _gare_key(vals):
+        """Clé de rapprochement d'une gare : (ligne, UIC), ou (ligne, nom, PK)
+        pour les gares sans code UIC."""
+        if vals['code_uic']:
+            return (vals['ligne_id'], vals['code_uic'])
+        return (vals['ligne_id'], False, vals['name'], vals['pk_text'])
 
-        file_data = base64.b64decode(self.file)
-        try:
-            geojson = json.loads(file_data.decode('utf-8'))
-        except Exception as e:
-            raise UserError(f"Fichier GeoJSON invalide : {e}")
+    def action_import(self):
+        """ Import du référentiel des GARES (Excel 1)
 
-        if geojson.get('type') != 'FeatureCollection':
-            raise UserError("Le fichier doit être une FeatureCollection GeoJSON.")
+        Feuille lue en flux (read_only), lignes résolues ou créées en une
+        passe, gares fusionnées sur (ligne, code UIC) : un ré-import ne crée
+        pas de doublons et n'écrit que les gares modifiées.
+        """
+        if not self.file: return
+        if openpyxl is None:
+            raise UserError("La librairie openpyxl est requise pour l'import Excel.")
 
-        ligne_obj = self.env['leyfa.ligne']
+        rows = []
+        with self._open_file_stream() as raw:
+            wb = openpyxl.load_workbook(raw, read_only=True, data_only=True)
+            try:
+                for row in wb.active.iter_rows(min_row=2, values_only=True):
+                    vals = self._parse_gare_row(row)
+                    if vals:
+                        rows.append((str(row[4]).strip(), vals))
+            finally:
+                wb.close()
 
-        for feature in geojson.get('features', []):
-            props = feature.get('properties', {})
-            geom = feature.get('geometry', {})
+        ligne_obj = self.env['leyfa.ligne']
+        gare_obj = self.env['leyfa.gare']
 
-            code_ligne = str(props.get('code_ligne', '')).strip()
-            if not code_ligne:
+        # Lignes : une recherche, une création groupée pour les manquantes
+        codes = {code for code, _vals in rows}
+        ligne_map = {l['name']: l['id'] for l in ligne_obj.search_read(
+            [('name', 'in', list(codes))], ['name'])}
+        missing = sorted(codes - ligne_map.keys())
+        if missing:
+            new_lignes = ligne_obj.create([
+                {'name': code, 'surnom': code[:3]} for code in missing
+            ])
+            ligne_map.update(zip(missing, new_lignes.ids))
+
+        # Gares existantes indexées par (ligne, UIC) : une gare de bifurcation
+        # figure une fois par ligne dans le fichier et garde un enregistrement par ligne
+        for code, vals in rows:
+            vals['ligne_id'] = ligne_map[code]
+        uics = list({vals['code_uic'] for _code, vals in rows if vals['code_uic']})
+        no_uic_lignes = list({vals['ligne_id'] for _code, vals in rows if not vals['code_uic']})
+        existing = {}
+        for gare in gare_obj.search_read([
+            '|', ('code_uic', 'in', uics),
+            '&', ('code_uic', '=', False), ('ligne_id', 'in', no_uic_lignes),
+        ], self._GARE_IMPORT_FIELDS, order='id'):
+            gare['ligne_id'] = gare['ligne_id'] and gare['ligne_id'][0]
+            existing.setdefault(self._gare_key(gare), gare)
+
+        to_create = {}
+        writes = {}     # vals figées -> ids, pour grouper les write identiques
+        unchanged = 0
+        for _code, vals in rows:
+            key = self._gare_key(vals)
+            current = existing.get(key)
+            if current is None:
+                to_create[key] = vals   # dernière occurrence gagne
+                continue
+            diff = {f: v for f, v in vals.items() if current[f] != v}
+            if not diff:
+                unchanged += 1
                 continue
+            writes.setdefault(tuple(sorted(diff.items())), []).append(current['id'])
+
+        gare_obj.create(list(to_create.values()))
+        updated = 0
+        for diff, ids in writes.items():
+            gare_obj.browse(ids).write(dict(diff))
+            updated += len(ids)
 
-            vals = {
-                'statut_ligne': props.get('statut', False),
-                'pk_debut': props.get('pkd', False),
-                'pk_fin': props.get('pkf', False),
-                'geo_shape': json.dumps(geom, ensure_ascii=False),
+        msg = (f"{len(to_create)} gare(s) créée(s), {updated} mise(s) à jour, "
+               f"{unchanged} inchangée(s), {len(missing)} ligne(s) créée(s).")
+        _logger.info("Import gares : %s", msg)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Import gares terminé',
+                'message': msg,
+                'type': 'success',
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
             }
+        }
 
-            ligne = ligne_obj.search([('name', '=', code_ligne)], limit=1)
-            if ligne:
-                ligne.write(vals)
-            else:
-                vals.update({'name': code_ligne, 'surnom': code_ligne[:3]})
-                ligne_obj.create(vals)
+    GEOMETRY_IMPORT_BATCH = 500
 
-        return {'type': 'ir.actions.client', 'tag': 'reload'}
+    def action_import_geometry(self):
+        """Import des TRACÉS et PK depuis un fichier GeoJSON
 
-    def action_import_pks(self):
-        """Import des PKs depuis un fichier CSV"""
+        Les features sont lues en flux et traitées par lots : une seule
+        lecture préalable des lignes existantes (nom + empreinte du tracé),
+        création groupée des nouvelles lignes, et aucune écriture quand le
+        tracé et les attributs sont inchangés.
+        """
         if not self.file:
-            raise UserError("Veuillez sélectionner un fichier CSV.")
-
-        import csv
-        import io
-
-        file_data = base64.b64decode(self.file)
-        text = file_data.decode('utf-8-sig')
-        reader = csv.DictReader(io.StringIO(text), delimiter=',')
+            return
 
-        # Preload all lignes into a dict {name: id} — one single query
-        lignes = self.env['leyfa.ligne'].search_read([], ['id', 'name'])
-        ligne_map = {l['name']: l['id'] for l in lignes}
+        ligne_obj = self.env['leyfa.ligne']
+        existing = {
+            l['name']: l for l in ligne_obj.with_context(active_test=False).search_read(
+                [], ['name', 'geo_shape_hash', 'statut_ligne', 'pk_debut', 'pk_fin'])
+        }
+        stats = {'created': 0, 'updated': 0, 'unchanged': 0}
+
+        with self._open_file_stream() as raw:
+            text = io.TextIOWrapper(raw, encoding='utf-8-sig')
+            batch = {}
+            for feature in iter_geojson_features(text):
+                props = feature.get('properties') or {}
+                code_ligne = str(props.get('code_ligne', '')).strip()
+                if not code_ligne:
+                    continue
+                geo_shape = json.dumps(feature.get('geometry') or {}, ensure_ascii=False)
+                # Champs Char : même forme que relue en base, pour la comparaison
+                batch[code_ligne] = {
+                    'statut_ligne': _char_or_false(props.get('statut')),
+                    'pk_debut': _char_or_false(props.get('pkd')),
+                    'pk_fin': _char_or_false(props.get('pkf')),
+                    'geo_shape': geo_shape,
+                }
+                if len(batch) >= self.GEOMETRY_IMPORT_BATCH:
+                    self._import_geometry_batch(batch, existing, stats)
+                    batch = {}
+            if batch:
+                self._import_geometry_batch(batch, existing, stats)
+
+        msg = (f"{stats['created']} ligne(s) créée(s), {stats['updated']} mise(s) à jour, "
+               f"{stats['unchanged']} inchangée(s).")
+        _logger.info("Import tracés : %s", msg)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Import tracés terminé',
+                'message': msg,
+                'type': 'success',
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+            }
+        }
 
+    def _import_geometry_batch(self, batch, existing, stats):
+        ligne_obj = self.env['leyfa.ligne']
+        to_create = []
+        for code_ligne, vals in batch.items():
+            current = existing.get(code_ligne)
+            if not current:
+                to_create.append(dict(vals, name=code_ligne, surnom=code_ligne[:3]))
+                continue
+            diff = {f: v for f, v in vals.items() if f != 'geo_shape' and current[f] != v}
+            new_hash = ligne_obj._hash_geo_shape(vals['geo_shape'])
+            if new_hash != current['geo_shape_hash']:
+                diff['geo_shape'] = vals['geo_shape']
+            if not diff:
+                stats['unchanged'] += 1
+                continue
+            ligne_obj.browse(current['id']).write(diff)
+            current.update(diff, geo_shape_hash=new_hash)
+            stats['updated'] += 1
+
+        for ligne, vals in zip(ligne_obj.create(to_create), to_create):
+            existing[vals['name']] = {
+                'id': ligne.id,
+                'name': vals['name'],
+                'geo_shape_hash': ligne_obj._hash_geo_shape(vals['geo_shape']),
+                'statut_ligne': vals['statut_ligne'],
+                'pk_debut': vals['pk_debut'],
+                'pk_fin': vals['pk_fin'],
+            }
+        stats['created'] += len(to_create)
+
+        # Recalculs (cache SIG…) par lot, puis on libère le cache ORM
+        self.env.flush_all()
+        self.env.invalidate_all()
+
+    def _open_file_stream(self):
+        """Flux binaire sur le fichier chargé.
+
+        Le champ étant stocké en pièce jointe, on lit directement le fichier
+        du filestore plutôt que de décoder tout le base64 en mémoire.
+        """
+        self.ensure_one()
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_id', '=', self.id),
+            ('res_field', '=', 'file'),
+        ], limit=1)
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), 'rb')
+        return io.BytesIO(base64.b64decode(self.file))
+
+    PK_IMPORT_CHUNK = 50000
+
+    def _iter_pk_copy_chunks(self, reader, stats):
+        """Lignes du CSV nettoyées, par blocs CSV prêts pour COPY."""
         def parse_float(val):
             v = str(val or '').strip().strip('"')
             if not v or v.upper() == 'NULL':
@@ -279,26 +655,16 @@ class ImportGaresWizard(models.TransientModel):
             except ValueError:
                 return 0.0
 
-        rows_to_insert = []
-        skipped = 0
-        not_found = set()
-
+        buf = io.StringIO()
+        writer = csv.writer(buf)
         for row in reader:
-            row = {k.strip().strip('"'): v for k, v in row.items()}
             code_ligne = str(row.get('code_ligne', '') or '').strip().strip('"').zfill(6)
-
             if not code_ligne or code_ligne == '000000':
-                skipped += 1
+                stats['skipped'] += 1
                 continue
 
-            ligne_id = ligne_map.get(code_ligne)
-            if not ligne_id:
-                not_found.add(code_ligne)
-                skipped += 1
-                continue
-
-            rows_to_insert.append((
-                ligne_id,
+            writer.writerow((
+                code_ligne,
                 parse_float(row.get('pk')),
                 parse_float(row.get('vitesse')),
                 parse_float(row.get('altitude')),
@@ -307,28 +673,127 @@ class ImportGaresWizard(models.TransientModel):
                 parse_float(row.get('lat')),
                 parse_float(row.get('lon')),
             ))
+            stats['read'] += 1
+            if stats['read'] % self.PK_IMPORT_CHUNK == 0:
+                yield buf.getvalue().encode()
+                buf.seek(0)
+                buf.truncate()
+                _logger.info("Import PKs : %s lignes lues", stats['read'])
+        if buf.tell():
+            yield buf.getvalue().encode()
 
-        # Bulk insert with raw SQL in chunks of 10k
-        created = 0
-        CHUNK = 10000
-        cr = self.env.cr
-        for i in range(0, len(rows_to_insert), CHUNK):
-            chunk = rows_to_insert[i:i+CHUNK]
-            args_str = ','.join(
-                cr.mogrify("(%s,%s,%s,%s,%s,%s,%s,%s)", r).decode('utf-8')
-                for r in chunk
-            )
-            cr.execute(f"""
-                INSERT INTO leyfa_pk
-                    (ligne_id, pk, vitesse, altitude, altitude_tunnels, altitude_declivites, lat, lon)
-                VALUES {args_str}
-            """)
-            created += len(chunk)
+    def action_import_pks(self):
+        """Import des PKs depuis un fichier CSV
 
-        # Recompute name field for all inserted records
-        self.env['leyfa.pk'].search([]).modified(['pk'])
+        Le fichier est lu en flux et envoyé par COPY dans une table temporaire,
+        puis fusionné dans leyfa_pk sur (ligne_id, pk) : un ré-import met à jour
+        les PKs existants au lieu de les dupliquer. Le nom n'est calculé (en SQL)
+        que pour les lignes touchées.
+        """
+        if not self.file:
+            raise UserError("Veuillez sélectionner un fichier CSV.")
 
-        msg = f'{created} PK(s) importé(s), {skipped} ignoré(s).'
+        self.env.flush_all()
+        cr = self.env.cr
+        stats = {'read': 0, 'skipped': 0}
+
+        cr.execute("DROP TABLE IF EXISTS leyfa_pk_import")
+        cr.execute("""
+            CREATE TEMP TABLE leyfa_pk_import (
+                seq bigserial,
+                code_ligne varchar,
+                pk float8,
+                vitesse float8,
+                altitude float8,
+                altitude_tunnels float8,
+                altitude_declivites float8,
+                lat float8,
+                lon float8
+            ) ON COMMIT DROP
+        """)
+
+        with self._open_file_stream() as raw:
+            text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+            reader = csv.DictReader(text, delimiter=',')
+            reader.fieldnames = [f.strip().strip('"') for f in (reader.fieldnames or [])]
+            cr.copy_expert("""
+                COPY leyfa_pk_import (code_ligne, pk, vitesse, altitude, altitude_tunnels,
+                                      altitude_declivites, lat, lon)
+                FROM STDIN WITH (FORMAT csv)
+            """, _ChunkStream(self._iter_pk_copy_chunks(reader, stats)))
+        _logger.info("Import PKs : %s lignes chargées en table temporaire", stats['read'])
+
+        cr.execute("""
+            SELECT DISTINCT s.code_ligne
+              FROM leyfa_pk_import s
+         LEFT JOIN leyfa_ligne l ON l.name = s.code_ligne AND l.active
+             WHERE l.id IS NULL
+        """)
+        not_found = {r[0] for r in cr.fetchall()}
+
+        # Un seul point par (ligne, pk) : la dernière occurrence du fichier gagne
+        cr.execute("""
+            CREATE TEMP TABLE leyfa_pk_import_dedup ON COMMIT DROP AS
+            SELECT DISTINCT ON (l.id, s.pk) l.id AS ligne_id, s.*
+              FROM leyfa_pk_import s
+              JOIN leyfa_ligne l ON l.name = s.code_ligne AND l.active
+          ORDER BY l.id, s.pk, s.seq DESC
+        """)
+        cr.execute("CREATE INDEX ON leyfa_pk_import_dedup (ligne_id, pk)")
+        cr.execute("ANALYZE leyfa_pk_import_dedup")
+
+        cr.execute(f"""
+            UPDATE leyfa_pk p
+               SET vitesse = d.vitesse,
+                   altitude = d.altitude,
+                   altitude_tunnels = d.altitude_tunnels,
+                   altitude_declivites = d.altitude_declivites,
+                   lat = d.lat,
+                   lon = d.lon,
+                   name = {_pk_name_sql('d.pk')},
+                   write_uid = %s,
+                   write_date = now() at time zone 'UTC'
+              FROM leyfa_pk_import_dedup d
+             WHERE p.ligne_id = d.ligne_id AND p.pk = d.pk
+        """, [self.env.uid])
+        updated = cr.rowcount
+
+        cr.execute(f"""
+            INSERT INTO leyfa_pk
+                (ligne_id, pk, vitesse, altitude, altitude_tunnels, altitude_declivites,
+                 lat, lon, name, create_uid, create_date, write_uid, write_date)
+            SELECT d.ligne_id, d.pk, d.vitesse, d.altitude, d.altitude_tunnels,
+                   d.altitude_declivites, d.lat, d.lon, {_pk_name_sql('d.pk')},
+                   %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+              FROM leyfa_pk_import_dedup d
+             WHERE NOT EXISTS (
+                   SELECT 1 FROM leyfa_pk p
+                    WHERE p.ligne_id = d.ligne_id AND p.pk = d.pk)
+        """, [self.env.uid, self.env.uid])
+        created = cr.rowcount
+
+        cr.execute("SELECT DISTINCT ligne_id FROM leyfa_pk_import_dedup")
+        lignes = self.env['leyfa.ligne'].browse([r[0] for r in cr.fetchall()])
+        cr.execute("""
+            SELECT count(*) FROM leyfa_pk_import s
+              JOIN leyfa_ligne l ON l.name = s.code_ligne AND l.active
+        """)
+        matched = cr.fetchone()[0]
+        skipped = stats['skipped'] + stats['read'] - matched
+        duplicates = matched - created - updated
+
+        # Le SQL a contourné l'ORM : on invalide le cache et on ne déclenche
+        # les recalculs (cache SIG…) que pour les lignes concernées.
+        self.env['leyfa.pk'].invalidate_model()
+        lignes.invalidate_recordset(['pk_ids'])
+        lignes.modified(['pk_ids'])
+        _logger.info("Import PKs : %s créés, %s mis à jour, %s ignorés (%s lignes)",
+                     created, updated, skipped, len(lignes))
+
+        msg = (f'{stats["read"]} ligne(s) lue(s) : {created} PK(s) importé(s), '
+               f'{updated} mis à jour, {skipped} ignoré(s).')
+        if duplicates:
+            msg += f' {duplicates} doublon(s) dans le fichier.'
         if not_found:
             msg += f' Lignes introuvables : {", ".join(sorted(not_found))}'
 
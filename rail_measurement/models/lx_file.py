@@ -0,0 +1,177 @@
+"""Lecture en flux des fichiers journaliers du lorry (.lx / .txt).
+
+Format :
+
+    LIGNE: 650000
+    DATE: 12/03/2025
+    VOIE: 1
+    LORRY: SN-0042
+    PK: 12.345
+    ...
+    N°	PK	Temps	...           <- en-tête du tableau (contient PK et Temps)
+    1	12.345	08:02:11	...
+    2	12.350	08:02:12	...
+
+Le fichier est lu ligne à ligne, sans jamais être chargé en mémoire : seules
+les statistiques de synthèse (plage de PK, nombre d'échantillons, trous,
+vitesse) sont accumulées.
+"""
+
+import base64
+import io
+import math
+from datetime import datetime
+
+# Saut de PK (km) au-delà duquel deux échantillons consécutifs forment un trou
+LX_GAP_KM = 0.05
+
+
+class LxParseError(ValueError):
+    """Fichier .lx illisible ; le message est destiné à l'utilisateur."""
+
+
+def open_binary_stream(record, field_name):
+    """Flux binaire sur un champ Binary stocké en pièce jointe.
+
+    On lit directement le fichier du filestore plutôt que de décoder tout le
+    base64 en mémoire ; repli sur la valeur en cache sinon (création en
+    cours, stockage en base).
+    """
+    record.ensure_one()
+    if not isinstance(record.id, int):
+        return io.BytesIO(base64.b64decode(record[field_name] or b''))
+    if record._name == 'ir.attachment':
+        attachment = record.sudo()
+    else:
+        attachment = record.env['ir.attachment'].sudo().search([
+            ('res_model', '=', record._name),
+            ('res_id', '=', record.id),
+            ('res_field', '=', field_name),
+        ], limit=1)
+    if attachment.store_fname:
+        return open(attachment._full_path(attachment.store_fname), 'rb')
+    return io.BytesIO(base64.b64decode(record[field_name] or b''))
+
+
+def _decode(raw):
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('iso-8859-1')
+
+
+def _parse_time(value):
+    """Temps d'un échantillon en secondes : « 08:02:11(.5) » ou secondes."""
+    value = value.strip()
+    if ':' in value:
+        parts = [float(p) for p in value.split(':')]
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + part
+        return seconds
+    return float(value)
+
+
+def _header_fields(header):
+    """Entête normalisé sur les conventions Odoo (surnoms L…, V…)."""
+    ligne = header.get('LIGNE', '').strip()
+    voie = header.get('VOIE', '').strip()
+    try:
+        date = datetime.strptime(header.get('DATE', '').strip(), '%d/%m/%Y').date()
+        pk_header = float(header.get('PK', 0) or 0)
+    except ValueError:
+        raise LxParseError("Entête de fichier invalide (Ligne, Date, Voie, Lorry ou PK manquants).")
+    if not ligne or not voie or not header.get('LORRY', '').strip():
+        raise LxParseError("Entête de fichier invalide (Ligne, Date, Voie, Lorry ou PK manquants).")
+    return {
+        'ligne': ligne if ligne.startswith('L') else 'L' + ligne,
+        'date': date,
+        'voie': voie if voie.startswith('V') else 'V' + voie,
+        'lorry': header['LORRY'].strip(),
+        'pk_header': pk_header,
+    }
+
+
+def parse_lx(stream, gap_km=LX_GAP_KM):
+    """Parcourt un fichier .lx ouvert en binaire et retourne sa synthèse.
+
+    Clés : ligne, date, voie, lorry, pk_header (entête) ; sample_count,
+    pk_start, pk_end, pk_min, pk_max, gap_count, gap_max (km),
+    duration (s), speed_avg (km/h) (tableau).
+    """
+    header = {}
+    pk_col = 1
+    time_col = None
+    in_table = False
+    stats = {
+        'sample_count': 0,
+        'pk_start': 0.0, 'pk_end': 0.0, 'pk_min': 0.0, 'pk_max': 0.0,
+        'gap_count': 0, 'gap_max': 0.0,
+        'duration': 0.0, 'speed_avg': 0.0,
+    }
+    distance = 0.0
+    prev_pk = None
+    first_time = last_time = None
+
+    for raw in stream:
+        line = _decode(raw).rstrip('\r\n')
+        if not in_table:
+            if 'PK' in line and 'Temps' in line:
+                columns = [c.strip() for c in line.split('\t')]
+                pk_col = columns.index('PK') if 'PK' in columns else 1
+                time_col = columns.index('Temps') if 'Temps' in columns else None
+                in_table = True
+            elif ':' in line:
+                key, val = line.split(':', 1)
+                header[key.strip().upper()] = val.strip()
+            continue
+
+        if not line.strip():
+            continue
+        cells = line.split('\t')
+        try:
+            pk = float(cells[pk_col].strip())
+        except (ValueError, IndexError):
+            raise LxParseError(
+                "Erreur lors de l'extraction des PK dans le tableau de mesures "
+                "(échantillon %d)." % (stats['sample_count'] + 1))
+        if not math.isfinite(pk):
+            continue
+
+        if prev_pk is None:
+            stats['pk_start'] = stats['pk_min'] = stats['pk_max'] = pk
+        else:
+            step = abs(pk - prev_pk)
+            distance += step
+            if step > gap_km:
+                stats['gap_count'] += 1
+                stats['gap_max'] = max(stats['gap_max'], step)
+            stats['pk_min'] = min(stats['pk_min'], pk)
+            stats['pk_max'] = max(stats['pk_max'], pk)
+        prev_pk = pk
+        stats['sample_count'] += 1
+
+        if time_col is not None:
+            try:
+                t = _parse_time(cells[time_col])
+            except (ValueError, IndexError):
+                t = None
+            if t is not None:
+                if first_time is None:
+                    first_time = t
+                last_time = t
+
+    result = _header_fields(header)
+    if not stats['sample_count']:
+        raise LxParseError("Le fichier ne contient aucune donnée de mesure après l'entête.")
+
+    stats['pk_end'] = prev_pk
+    if first_time is not None and last_time is not None:
+        duration = last_time - first_time
+        if duration < 0:  # Passage de minuit
+            duration += 24 * 3600
+        stats['duration'] = duration
+        if duration > 0:
+            stats['speed_avg'] = distance / (duration / 3600.0)
+    result.update(stats)
+    return result
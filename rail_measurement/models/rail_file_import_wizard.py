@@ -1,18 +1,27 @@
 import base64
+import hashlib
 import logging
+import zipfile
+from contextlib import ExitStack
 from datetime import datetime
 from odoo import models, fields, api, exceptions, _
 
+from .lx_file import LxParseError, open_binary_stream, parse_lx
+
 _logger = logging.getLogger(__name__)
 
 class RailFileImportWizard(models.TransientModel):
     _name = 'rail.file.import.wizard'
     _description = 'Wizard Import Fichier de Mesure'
 
-    file = fields.Binary(string="Fichier .lx / .txt", required=True)
+    file = fields.Binary(string="Fichier .lx / .txt")
     file_name = fields.Char()
+
+    # Import par lot : fichiers .lx / .txt ou archives .zip d'une semaine
+    batch_file_ids = fields.Many2many('ir.attachment', string="Fichiers du lot (.lx, .txt, .zip)")
+    batch_report = fields.Text(string="Rapport d'import", readonly=True)
     
-    state = fields.Selection([('upload', 'Import'), ('select', 'Sélection')], default='upload')
+    state = fields.Selection([('upload', 'Import'), ('select', 'Sélection'), ('report', 'Rapport')], default='upload')
     match_ids = fields.Many2many('rail.measurement', string="Mesures correspondantes")
     selected_measurement_id = fields.Many2one('rail.measurement', string="Choisir la mesure")
 
@@ -21,116 +30,65 @@ class RailFileImportWizard(models.TransientModel):
     parsed_first_pk = fields.Float()
     parsed_last_pk = fields.Float()
 
-    # def action_analyze(self):
-    #     self.ensure_one()
-        
-    #     # 1. Décodage et lecture
-    #     try:
-    #         file_binary = base64.b64decode(self.file)
-    #     except Exception:
-    #         raise exceptions.UserError("Erreur lors de la lecture du fichier binaire.")
-
-    #     content = False
-    #     for encoding in ['utf-8', 'iso-8859-1']:
-    #         try:
-    #             content = file_binary.decode(encoding)
-    #             break
-    #         except UnicodeDecodeError:
-    #             continue
-
-    #     if not content:
-    #         raise exceptions.UserError("Format de texte non reconnu (UTF-8 ou Latin-1 requis).")
-
-    #     # 2. Parsing du Header
-    #     header = {}
-    #     lines = content.splitlines()
-    #     for line in lines:
-    #         if ':' in line:
-    #             key, val = line.split(':', 1)
-    #             header[key.strip()] = val.strip()
-
-    #     try:
-    #         # Nettoyage des données pour correspondre aux surnoms/noms Odoo
-    #         h_ligne_raw = header.get('LIGNE', '').strip()
-    #         h_ligne = 'L' + h_ligne_raw if not h_ligne_raw.startswith('L') else h_ligne_raw
-            
-    #         h_date_raw = header.get('DATE', '')
-    #         h_date = datetime.strptime(h_date_raw, '%d/%m/%Y').date()
-            
-    #         h_voie_raw = header.get('VOIE', '').strip()
-    #         h_voie = 'V' + h_voie_raw if not h_voie_raw.startswith('V') else h_voie_raw
-            
-    #         h_lorry = header.get('LORRY', '').strip()
-    #         h_pk_header = float(header.get('PK', 0))
-    #     except (ValueError, TypeError):
-    #         raise exceptions.UserError("Entête de fichier invalide (Ligne, Date, Voie, Lorry ou PK manquants).")
-
-    #     # 3. Parsing du tableau (Extraction PK début et fin)
-    #     data_lines = []
-    #     table_started = False
-    #     for line in lines:
-    #         if "PK" in line and "Temps" in line:
-    #             table_started = True
-    #             continue
-    #         if table_started and line.strip():
-    #             data_lines.append(line)
-
-    #     if not data_lines:
-    #         raise exceptions.UserError("Le fichier ne contient aucune donnée de mesure après l'entête.")
-
-    #     try:
-    #         # On extrait les PK réels du tableau (Colonne 2, index 1)
-    #         first_pk = float(data_lines[0].split('\t')[1].strip())
-    #         last_pk = float(data_lines[-1].split('\t')[1].strip())
-    #     except (ValueError, IndexError):
-    #         raise exceptions.UserError("Erreur lors de l'extraction des PK dans le tableau de mesures.")
-
-    #     # Mémorisation technique dans le wizard
-    #     self.write({
-    #         'parsed_date': h_date,
-    #         'parsed_first_pk': first_pk,
-    #         'parsed_last_pk': last_pk
-    #     })
-
-    #     # 4. Recherche de la mesure
-    #     domain = [
-    #         ('ligne_id', '=', h_ligne),
-    #         ('date_start', '<=', h_date),
-    #         ('date_end', '>=', h_date),
-    #         # ('pk_initial', '<=', h_pk_header),
-    #         # ('pk_final', '>=', h_pk_header),
-    #         ('chariot_type_lines.assigned_chariot_ids.serial_number', '=', h_lorry),
-    #         ('voie_ids.name', '=', h_voie)
-    #     ]
+    def action_analyze(self):
+        self.ensure_one()
+        if not self.file:
+            raise exceptions.UserError("Veuillez sélectionner un fichier de mesure.")
+
+        # 1. Lecture en flux : entête + synthèse du tableau
+        try:
+            with open_binary_stream(self, 'file') as stream:
+                stats = parse_lx(stream)
+        except LxParseError as e:
+            raise exceptions.UserError(str(e))
+
+        h_ligne, h_date, h_voie = stats['ligne'], stats['date'], stats['voie']
+        h_lorry, h_pk_header = stats['lorry'], stats['pk_header']
+
+        # Mémorisation technique dans le wizard
+        self.write({
+            'parsed_date': h_date,
+            'parsed_first_pk': stats['pk_start'],
+            'parsed_last_pk': stats['pk_end'],
+        })
+
+        # 2. Recherche de la mesure
+        domain = [
+            ('ligne_id.name', '=', h_ligne),
+            ('date_start', '<=', h_date),
+            ('date_end', '>=', h_date),
+            ('chariot_type_lines.assigned_chariot_ids.serial_number', '=', h_lorry),
+            ('voie_ids.name', '=', h_voie)
+        ]
         
-    #     matches = self.env['rail.measurement'].search(domain)
-
-    #     if not matches:
-    #         # Aide au debug pour l'utilisateur
-    #         last = self.env['rail.measurement'].search([], order='create_date desc', limit=1)
-    #         error_msg = _("❌ Aucune mesure correspondante trouvée.\n\n")
-    #         error_msg += f"FICHIER : Ligne {h_ligne} | Date {h_date} | Voie {h_voie} | Lorry {h_lorry} | PK {h_pk_header:.3f}\n\n"
-    #         if last:
-    #             v = ", ".join(last.voie_ids.mapped('name'))
-    #             l = ", ".join(last.chariot_type_lines.mapped('assigned_chariot_ids.serial_number'))
-    #             error_msg += f"DERNIÈRE ODOO ({last.reference}) : Ligne {last.ligne_id.surnom} | Voies [{v}] | Lorrys [{l}] | PK {last.pk_initial:.3f} à {last.pk_final:.3f}"
-    #         raise exceptions.UserError(error_msg)
-
-    #     if len(matches) == 1:
-    #         return self._attach_to_measurement(matches[0])
-
-    #     # Cas multiples : on passe à l'étape de sélection
-    #     self.write({
-    #         'state': 'select',
-    #         'match_ids': [(6, 0, matches.ids)]
-    #     })
-    #     return {
-    #         'type': 'ir.actions.act_window',
-    #         'res_model': self._name,
-    #         'res_id': self.id,
-    #         'view_mode': 'form',
-    #         'target': 'new',
-    #     }
+        matches = self.env['rail.measurement'].search(domain)
+
+        if not matches:
+            # Aide au debug pour l'utilisateur
+            last = self.env['rail.measurement'].search([], order='create_date desc', limit=1)
+            error_msg = _("❌ Aucune mesure correspondante trouvée.\n\n")
+            error_msg += f"FICHIER : Ligne {h_ligne} | Date {h_date} | Voie {h_voie} | Lorry {h_lorry} | PK {h_pk_header:.3f}\n\n"
+            if last:
+                v = ", ".join(last.voie_ids.mapped('name'))
+                l = ", ".join(last.chariot_type_lines.mapped('assigned_chariot_ids.serial_number'))
+                error_msg += f"DERNIÈRE ODOO ({last.reference}) : Ligne {last.ligne_id.name} | Voies [{v}] | Lorrys [{l}]"
+            raise exceptions.UserError(error_msg)
+
+        if len(matches) == 1:
+            return self._attach_to_measurement(matches[0])
+
+        # Cas multiples : on passe à l'étape de sélection
+        self.write({
+            'state': 'select',
+            'match_ids': [(6, 0, matches.ids)]
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
 
     def action_confirm_selection(self):
         self.ensure_one()
@@ -154,8 +112,12 @@ class RailFileImportWizard(models.TransientModel):
             # Si le planning n'est pas généré, on l'annule ou on crée le fichier sur la mesure
             raise exceptions.UserError(f"Le planning de la mesure {measurement.reference} n'est pas généré pour la date du {self.parsed_date}.")
 
-        # 3. Créer l'enregistrement du fichier journalier
-        self.env['rail.measurement.day.file'].create({
+        # 3. Créer l'enregistrement du fichier journalier (sauf doublon)
+        DayFile = self.env['rail.measurement.day.file']
+        checksum = self.env['ir.attachment']._compute_checksum(base64.b64decode(self.file))
+        if DayFile._existing_checksums({(measurement.id, checksum)}):
+            raise exceptions.UserError(f"Ce fichier a déjà été importé pour la mesure {measurement.reference}.")
+        DayFile.create({
             'planning_id': planning_line[0].id,
             'day': day_key,
             'file': self.file,
@@ -180,4 +142,215 @@ class RailFileImportWizard(models.TransientModel):
                 'sticky': False,
                 'next': {'type': 'ir.actions.client', 'tag': 'reload'},
             }
-        }
\ No newline at end of file
+        }
+
+    # ------------------------------------------------------------------
+    # Import par lot
+    # ------------------------------------------------------------------
+
+    LX_EXTENSIONS = ('.lx', '.txt')
+    BATCH_CREATE_SIZE = 50
+
+    def _iter_batch_entries(self, stack):
+        """(nom, ouvreur) de chaque fichier de mesure du lot, archives
+        .zip dépliées. L'ouvreur rend un flux binaire à la demande : le
+        contenu n'est lu qu'au moment du parsing puis de l'attachement.
+
+        Les archives sont lues directement sur leur flux (fichier du
+        filestore) et restent ouvertes jusqu'à la fermeture de ``stack``.
+        """
+        for attachment in self.batch_file_ids:
+            name = attachment.name or ''
+            if name.lower().endswith('.zip'):
+                raw = stack.enter_context(open_binary_stream(attachment, 'datas'))
+                archive = stack.enter_context(zipfile.ZipFile(raw))
+                for member in archive.infolist():
+                    base = member.filename.rsplit('/', 1)[-1]
+                    if member.is_dir() or not base.lower().endswith(self.LX_EXTENSIONS):
+                        continue
+                    yield base, (lambda archive=archive, member=member: archive.open(member))
+            elif name.lower().endswith(self.LX_EXTENSIONS):
+                yield name, (lambda attachment=attachment: open_binary_stream(attachment, 'datas'))
+            else:
+                yield name, None
+
+    @staticmethod
+    def _stream_checksum(opener):
+        """sha1 du fichier (même empreinte que ir.attachment), lu par blocs."""
+        sha = hashlib.sha1()
+        with opener() as stream:
+            for chunk in iter(lambda: stream.read(1 << 16), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _read_content(opener):
+        with opener() as stream:
+            return stream.read()
+
+    def _build_measurement_lookup(self, entries):
+        """{(ligne, voie, lorry): [(measurement_id, date_start, date_end)]}
+        pour toutes les dates du lot, en une seule requête."""
+        dates = [e['stats']['date'] for e in entries]
+        lignes = list({e['stats']['ligne'] for e in entries})
+        Line = self.env['rail.measurement.chariot.type.line']
+        rel = Line._fields['assigned_chariot_ids']
+        voie_rel = self.env['rail.measurement']._fields['voie_ids']
+        self.env.flush_all()
+        self.env.cr.execute(f"""
+            SELECT DISTINCT lg.name, v.name, c.serial_number, m.id, m.date_start, m.date_end
+              FROM rail_measurement m
+              JOIN leyfa_ligne lg ON lg.id = m.ligne_id
+              JOIN {voie_rel.relation} vr ON vr.{voie_rel.column1} = m.id
+              JOIN leyfa_type_voie v ON v.id = vr.{voie_rel.column2}
+              JOIN rail_measurement_chariot_type_line l ON l.measurement_id = m.id
+              JOIN {rel.relation} r ON r.{rel.column1} = l.id
+              JOIN chariot c ON c.id = r.{rel.column2}
+             WHERE lg.name = ANY(%s)
+               AND m.date_start <= %s
+               AND m.date_end >= %s
+        """, [lignes, max(dates), min(dates)])
+        lookup = {}
+        for ligne, voie, lorry, mid, start, end in self.env.cr.fetchall():
+            lookup.setdefault((ligne, voie, lorry), []).append((mid, start, end))
+        return lookup
+
+    def action_import_batch(self):
+        """Classe tous les fichiers du lot dans le planning de leur mesure.
+
+        Les entêtes sont lus en flux, les correspondances résolues sur une
+        table (ligne, voie, lorry, date) construite en une requête, et les
+        fichiers journaliers créés par paquets. Les fichiers non classés
+        sont listés dans un rapport.
+        """
+        self.ensure_one()
+        if not self.batch_file_ids:
+            raise exceptions.UserError("Veuillez ajouter au moins un fichier ou une archive .zip.")
+
+        with ExitStack() as stack:
+            return self._import_batch(stack)
+
+    def _import_batch(self, stack):
+        DayFile = self.env['rail.measurement.day.file']
+        errors = []
+        entries = []
+
+        # 1. Lecture des entêtes et synthèses
+        for name, opener in self._iter_batch_entries(stack):
+            if opener is None:
+                errors.append(f"{name} : format non pris en charge (.lx, .txt ou .zip attendu).")
+                continue
+            try:
+                with opener() as stream:
+                    stats = parse_lx(stream)
+            except LxParseError as e:
+                errors.append(f"{name} : {e}")
+                continue
+            entries.append({'name': name, 'opener': opener, 'stats': stats})
+
+        # 2. Résolution mesure puis semaine de planning
+        matched = []
+        if entries:
+            lookup = self._build_measurement_lookup(entries)
+            for entry in entries:
+                st = entry['stats']
+                candidates = {
+                    mid for mid, start, end in lookup.get((st['ligne'], st['voie'], st['lorry']), [])
+                    if start <= st['date'] <= end
+                }
+                if len(candidates) == 1:
+                    entry['measurement_id'] = candidates.pop()
+                    matched.append(entry)
+                else:
+                    reason = "aucune mesure correspondante" if not candidates else \
+                        f"{len(candidates)} mesures correspondantes, à classer manuellement"
+                    errors.append(
+                        f"{entry['name']} : {reason} "
+                        f"(Ligne {st['ligne']} | Date {st['date']:%d/%m/%Y} | Voie {st['voie']} | Lorry {st['lorry']})."
+                    )
+
+        plannings = {}
+        if matched:
+            for planning in self.env['rail.measurement.planning'].search_read(
+                [('measurement_id', 'in', list({e['measurement_id'] for e in matched}))],
+                ['measurement_id', 'date_start', 'date_end'],
+            ):
+                plannings.setdefault(planning['measurement_id'][0], []).append(planning)
+
+        day_map = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+        to_create = []
+        progress = {}
+        placed = []
+        for entry in matched:
+            st, mid = entry['stats'], entry['measurement_id']
+            week = next((
+                p for p in plannings.get(mid, [])
+                if p['date_start'] and p['date_end'] and p['date_start'] <= st['date'] <= p['date_end']
+            ), None)
+            if not week:
+                errors.append(f"{entry['name']} : le planning de la mesure n'est pas généré pour le {st['date']:%d/%m/%Y}.")
+                continue
+            entry['checksum'] = self._stream_checksum(entry['opener'])
+            entry['week'] = week
+            placed.append(entry)
+
+        # Doublons (renvois, fichier présent dans deux archives) : ignorés
+        already = DayFile._existing_checksums({(e['measurement_id'], e['checksum']) for e in placed})
+        for entry in placed:
+            st, mid, week = entry['stats'], entry['measurement_id'], entry['week']
+            key = (mid, entry['checksum'])
+            if key in already:
+                errors.append(f"{entry['name']} : déjà importé pour cette mesure, ignoré.")
+                continue
+            already.add(key)
+            # Contenu lu seulement à la création du paquet
+            to_create.append((entry['opener'], dict(
+                DayFile._lx_values(st),
+                planning_id=week['id'],
+                day=day_map[st['date'].weekday()],
+                file_name=entry['name'],
+                file_checksum=entry['checksum'],
+            )))
+            # Avancement : le relevé le plus récent de chaque mesure
+            if mid not in progress or st['date'] >= progress[mid]['date']:
+                progress[mid] = st
+
+        # 3. Création par paquets (les synthèses sont déjà calculées) ; seul le
+        # contenu du paquet en cours est en mémoire
+        for start in range(0, len(to_create), self.BATCH_CREATE_SIZE):
+            DayFile.create([
+                dict(vals, file=base64.b64encode(self._read_content(opener)))
+                for opener, vals in to_create[start:start + self.BATCH_CREATE_SIZE]
+            ])
+        for mid, st in progress.items():
+            self.env['rail.measurement'].browse(mid).write({
+                'avancement_start': st['pk_start'],
+                'avancement_end': st['pk_end'],
+            })
+        _logger.info("Import par lot : %d fichiers classés, %d en erreur", len(to_create), len(errors))
+
+        message = f"{len(to_create)} fichier(s) classé(s) dans le planning."
+        if not errors:
+            return {
+                'type': 'ir.actions.client',
+                'tag': 'display_notification',
+                'params': {
+                    'title': 'Importation réussie',
+                    'message': message,
+                    'type': 'success',
+                    'sticky': False,
+                    'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+                }
+            }
+
+        self.write({
+            'state': 'report',
+            'batch_report': message + f"\n{len(errors)} fichier(s) non classé(s) :\n\n" + "\n".join(errors),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
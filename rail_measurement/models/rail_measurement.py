@@ -7,6 +7,89 @@ from datetime import timedelta, time, datetime
 import base64, openpyxl, io
 import math, re
 
+from odoo.addons.web_widget_mermaid_field.tools import ACTIVE_CLASS_DEF, DONE_CLASS_DEF, ProcessGraph
+
+from .code_affaire import CODE_INDEX_MAX, counter_scope, format_code, split_code
+from .lx_file import LxParseError, open_binary_stream, parse_lx
+from .resource_availability import CHARIOT, EQUIPE, EXCLUDED_STATES, invalidate_busy_labels
+from .resource_booking import BookingConflictError, booking_conflict_guard
+
+# Graphes d'avancement (widget mermaid)
+MERMAID_MACRO = ProcessGraph(
+    lines=(
+        "graph LR",
+        ACTIVE_CLASS_DEF,
+        DONE_CLASS_DEF,
+        "classDef invisible fill:none,stroke:none,color:none",
+        "",
+        "  %% Ligne 1 : Flux nominal",
+        "  PRESALE[Pré-Vente] --> PROD[Planification]",
+        "  subgraph Production",
+        "  PROD --> MEASURE[Mesure]",
+        "  MEASURE --> STUDY[Études]",
+        "  end",
+        "  STUDY --> INV[Facturation]",
+        "  INV --> DONE((Fin))",
+        "",
+        "  %% Ligne 2 : Annulation",
+        "  %% ~~~ crée un lien invisible qui force CANCELLED à rester sous PRESALE",
+        "  PRESALE ~~~ EMPTY[ ]",
+        "  EMPTY -.-> CANCELLED[Annulé]",
+        "",
+        "  class EMPTY invisible",
+    ),
+    mapping={
+        'presale': 'PRESALE', 'production': 'PROD', 'measure': 'MEASURE',
+        'study': 'STUDY', 'invoicing': 'INV', 'done': 'DONE',
+    },
+    order=('presale', 'production', 'measure', 'study', 'invoicing', 'done'),
+)
+MERMAID_MACRO_CANCELLED = (
+    "  class CANCELLED active",
+    "  class PRESALE,PROD,MEASURE,STUDY,INV,DONE done",
+)
+MERMAID_SALE = ProcessGraph(
+    lines=(
+        "graph LR",
+        ACTIVE_CLASS_DEF,
+        DONE_CLASS_DEF,
+        "WAIT[Attente Devis] --> DRAFT[Devis]",
+        "DRAFT --> SENT[Envoyé]",
+        "SENT --> FINAL([Vente Confirmée])",
+    ),
+    mapping={'waiting': 'WAIT', 'draft': 'DRAFT', 'sent': 'SENT', 'confirmed_all': 'FINAL'},
+    order=('waiting', 'draft', 'sent', 'confirmed_all'),
+)
+MERMAID_PROD = ProcessGraph(
+    lines=(
+        "graph LR", ACTIVE_CLASS_DEF, DONE_CLASS_DEF,
+        "M1[Fiche Mission] --> M2{Matériel ?}", "M2 -- Non --> M2_U[Demande de matériel]", "M2_U --> M2",
+        "M2 -- Oui --> M3([Chariots réservés])", "M3 -.-> M4[Production quotidienne]",
+    ),
+    mapping={'mission': 'M1', 'material': 'M2', 'urgence': 'M2_U', 'assigned': 'M3', 'final': 'M4'},
+    order=('mission', 'material', 'urgence', 'assigned'),
+)
+MERMAID_MEASURE = ProcessGraph(
+    lines=(
+        "graph LR", ACTIVE_CLASS_DEF, DONE_CLASS_DEF,
+        "ME1[En attente] --> ME2[Repérage]", "subgraph Production quotidienne", "ME2 --> ME3[Mesure Géométrie]",
+        "ME3 --> ME4[Mesure Position]", "ME4 --> ME5[Mesure Caténaire]", "end", "ME5 --> ME6((Fin))",
+    ),
+    mapping={'waiting_prod': 'ME1', 'reperage': 'ME2', 'geometrie': 'ME3', 'position': 'ME4', 'catenaire': 'ME5', 'done': 'ME6'},
+    order=('waiting_prod', 'reperage', 'geometrie', 'position', 'catenaire', 'done'),
+)
+MERMAID_STUDY = ProcessGraph(
+    lines=(
+        "graph LR", ACTIVE_CLASS_DEF, DONE_CLASS_DEF,
+        "S1[Réception] --> S2[Analyse]", "S2 --> S3{Validation}", "S3 -- KO --> S1", "S3 -- OK --> S4((Fin))",
+    ),
+    mapping={'reception': 'S1', 'analysis': 'S2', 'validation': 'S3', 'final': 'S4'},
+    order=('reception', 'analysis', 'validation'),
+)
+
+# Taille des lots de _resync_sale_states
+RESYNC_BATCH = 1000
+
 class RailMeasurement(models.Model):
     _name = 'rail.measurement'
     _description = 'Prestation de mesure de voie ferrée'
@@ -14,6 +97,11 @@ class RailMeasurement(models.Model):
     _order = 'date_start desc'
     _inherit = ['mail.thread', 'mail.activity.mixin']
 
+    def _flush(self, fnames=None):
+        # Les triggers de rail.resource.booking s'exécutent à l'écriture en base
+        with booking_conflict_guard():
+            return super()._flush(fnames)
+
     def _compute_display_name(self):
         for record in self:
             name = record.reference or ""
@@ -32,7 +120,7 @@ class RailMeasurement(models.Model):
     )
 
     # Champs pour code affaire
-    code_affaire = fields.Char(string="Code Affaire", store=True, tracking=True,
+    code_affaire = fields.Char(string="Code Affaire", store=True, tracking=True, index=True,
                                 help="Code d'affaire de la forme ELLLTTXXX où :\n" \
                                 "E = Exercice Comptable\n" \
                                 "LLL = Ligne Ferroviaire (surnom)\n" \
@@ -122,24 +210,47 @@ class RailMeasurement(models.Model):
     # Hidden technical field to track the state and prevent "ping-pong" loops
     last_synced_code = fields.Char(readonly=True)
 
+    # Code issu de la génération automatique (et non saisi) : renuméroté à
+    # l'enregistrement si un autre planificateur a pris le même numéro entre-temps
+    code_affaire_generated = fields.Boolean(readonly=True, copy=False)
+
     def _get_next_available_code(self, prefix):
-        """Helper to find the next free number for a given prefix"""
-        # We search for the highest code starting with prefix + 3 digits
-        # We ignore the current record (self._origin.id) to avoid self-collision
-        domain = [
-            ('id', '!=', self._origin.id if hasattr(self, '_origin') else False),
-            ('code_affaire', '=like', prefix[0] + '%')
-        ]
-        existing = self.env['rail.measurement'].search(domain, order='code_affaire desc')
-        
-        logging.getLogger(__name__).info(f"Searching for next code with prefix '{prefix}' - Found existing: {[ei.code_affaire for ei in existing]}")
-        if existing:
-            indexes = [int(existing.code_affaire[-3:]) for existing in existing if existing.code_affaire]
-            try:
-                return f"{prefix}{str(max(indexes) + 1).zfill(3)}"
-            except (ValueError, TypeError):
-                return f"{prefix}001"
-        return f"{prefix}001"
+        """Prochain code libre pour ``prefix`` (lecture seule du compteur d'exercice).
+
+        Une affaire déjà enregistrée sous ce même préfixe garde son numéro :
+        revenir à son préfixe d'origine ne consomme pas de nouveau numéro.
+        """
+        origin_code = self._origin.code_affaire if self._origin else False
+        origin_prefix, origin_index = split_code(origin_code)
+        if origin_index is not None and origin_prefix == (prefix or '').strip().upper():
+            return format_code(origin_prefix, origin_index)
+        return self.env['rail.code.affaire.counter']._next_code(prefix)
+
+    def _claim_code_affaire(self):
+        """Enregistre les numéros des codes affaire auprès des compteurs.
+
+        Verrouille le compteur de chaque exercice concerné jusqu'à la fin de
+        la transaction. Un code généré dont le numéro a déjà été distribué à
+        une autre affaire reçoit le numéro suivant ; un code saisi à la main
+        est conservé tel quel (l'onchange a déjà averti de la collision).
+        """
+        Counter = self.env['rail.code.affaire.counter']
+        self.flush_model(['code_affaire'])
+        for record in self.sorted('id'):
+            prefix, index = split_code(record.code_affaire)
+            if index is None:
+                continue
+            scope = counter_scope(prefix)
+            previous = Counter._claim(scope, index)
+            if index > previous or not record.code_affaire_generated:
+                continue
+            taken = self.search_count([
+                ('code_affaire', '=', record.code_affaire),
+                ('id', '!=', record.id),
+            ], limit=1)
+            if taken:
+                code = format_code(prefix, Counter._reserve(scope))
+                super(RailMeasurement, record).write({'code_affaire': code, 'last_synced_code': code})
 
     @api.onchange('code_affaire', 'exercice_id', 'ligne_id', 'type_affaire_id', 'nature_mission')
     def _sync_leyfa_naming_logic(self):
@@ -158,32 +269,19 @@ class RailMeasurement(models.Model):
         if is_manual_code_edit and self.code_affaire:
             logger = logging.getLogger(__name__)
             self.last_synced_code = self.code_affaire
+            self.code_affaire_generated = False
             code = self.code_affaire.strip().upper()
             if len(code) >= 5:
-                # A1. Parse Exercice
-                ex = self.env['leyfa.exercice.comptable'].search([('name', '=', code[0:1])], limit=1)
-                if ex: self.exercice_id = ex
-                print(f"Parsed Exercice: {ex.name if ex else 'None'}")
-                
-                # A2. Parse Middle & Nature
-                middle = code[1:] if code[-3:].isdigit() is False else code[1:-3]
-                if middle.endswith(('R', 'E')) and not middle[-3] == 'MOE':
-                    self.nature_mission = middle[-1]
-                    middle = middle[:-1]
-                else:
-                    self.nature_mission = False
-                print(f"Parsed Middle: {middle}, Nature: {self.nature_mission}")
-                
-                # A3. Parse Ligne & Type
-                lines = self.env['leyfa.ligne'].search([])
-                for line in lines:
-                    if line.surnom and middle[0:len(line.surnom)] == line.surnom.upper():
-                        self.ligne_id = line
-                        type_code = middle[len(line.surnom):]
-                        ty = self.env['leyfa.affaire.type'].search([('code', '=', type_code)], limit=1)
-                        if ty: self.type_affaire_id = ty
-                        print(f"Parsed Ligne: {line.surnom}, Type: {type_code}")
-                        break
+                # A1-A3. Exercice, ligne, type et nature (arbres préfixes en cache)
+                parsed = self.env['rail.code.affaire.parser'].parse_code(code)
+                if parsed['exercice_id']:
+                    self.exercice_id = parsed['exercice_id']
+                if parsed['ligne_id']:
+                    self.ligne_id = parsed['ligne_id']
+                if parsed['type_affaire_id']:
+                    self.type_affaire_id = parsed['type_affaire_id']
+                    self.type_requires_nature = self.type_affaire_id.requires_nature
+                self.nature_mission = parsed['nature_mission']
 
                 # A4. On accepte le code tel quel, sans forcer le suivant disponible
                 if code[-3:].isdigit():
@@ -203,6 +301,7 @@ class RailMeasurement(models.Model):
                     # Pas de numéro à la fin → on génère le suivant
                     new_code = self._get_next_available_code(code)
                     self.code_affaire = new_code
+                    self.code_affaire_generated = True
             
             self.last_synced_code = self.code_affaire
 
@@ -224,6 +323,7 @@ class RailMeasurement(models.Model):
                     new_code = self._get_next_available_code(prefix)
                     self.code_affaire = new_code
                     self.last_synced_code = new_code
+                    self.code_affaire_generated = True
 
         # 4. Notify user if there was a collision
         if warning_msg:
@@ -239,35 +339,126 @@ class RailMeasurement(models.Model):
                 if not self.env.context.get('install_mode'):
                     raise ValidationError(_(f"Vous ne pouvez pas modifier le codage d'affaire une fois que la mesure n'est plus en brouillon."))
 
+    def _code_affaire_prefix(self):
+        """(préfixe ELLLTT[N], None) de l'affaire, ou (None, motif) s'il est incomplet."""
+        self.ensure_one()
+        if not (self.exercice_id and self.ligne_id and self.type_affaire_id):
+            return None, "Veuillez remplir l'exercice, la ligne et le type d'affaire."
+        nature_code = ""
+        if self.type_affaire_id.requires_nature:
+            if not self.nature_mission:
+                return None, f"Le type '{self.type_affaire_id.name}' nécessite de préciser la Nature (R ou E)."
+            nature_code = self.nature_mission
+        return f"{self.exercice_id.name}{self.ligne_id.surnom}{self.type_affaire_id.code}{nature_code}".upper(), None
+
     def action_generate_code_affaire(self):
         for record in self:
-            if not (record.exercice_id and record.ligne_id and record.type_affaire_id):
-                raise exceptions.UserError("Veuillez remplir l'exercice, la ligne et le type d'affaire.")
-            
-            # Determine if we need Nature
-            nature_code = ""
-            if record.type_affaire_id.requires_nature:
-                if not record.nature_mission:
-                    raise exceptions.UserError(f"Le type '{record.type_affaire_id.name}' nécessite de préciser la Nature (R ou E).")
-                nature_code = record.nature_mission
-
-            # Build the prefix
-            prefix = f"{record.exercice_id.name}{record.ligne_id.surnom}{record.type_affaire_id.code}{nature_code}"
-            
-            # Find the next available number for this specific prefix
-            existing_records = self.env['rail.measurement'].search([
-                ('code_affaire', '=like', prefix + '___') # Search for prefix + 3 digits
-            ], order='code_affaire desc', limit=1)
-
-            next_number = 1
-            if existing_records:
-                suffix = existing_records.code_affaire[len(prefix):]
-                try:
-                    next_number = int(suffix) + 1
-                except:
-                    next_number = 1
-
-            record.code_affaire = f"{prefix}{str(next_number).zfill(3)}"
+            prefix, error = record._code_affaire_prefix()
+            if error:
+                raise exceptions.UserError(error)
+
+            # Numéro réservé immédiatement sur le compteur de l'exercice
+            index = self.env['rail.code.affaire.counter']._reserve(counter_scope(prefix))
+            code = format_code(prefix, index)
+            record.write({'code_affaire': code, 'last_synced_code': code, 'code_affaire_generated': False})
+
+    def _generate_code_affaire_batch(self, dry_run=False):
+        """Attribue en masse les codes des affaires non codées (reprise d'historique).
+
+        Les affaires sont regroupées par préfixe ; chaque exercice reçoit une
+        plage contiguë de numéros, réservée en une fois sur son compteur
+        (recalé au préalable sur les codes existants), et tous les codes sont
+        écrits en un seul UPDATE. Les affaires déjà codées ne sont pas
+        renumérotées. Avec ``dry_run``, rien n'est réservé ni écrit.
+
+        Retourne un dict :
+        - ``codes`` : {id: code attribué (ou prévu)} ;
+        - ``incomplete`` : {id: motif} des affaires non codables ;
+        - ``collisions`` : {code: [ids]} des codes portés par plusieurs
+          affaires, existants ou prévus.
+        """
+        Counter = self.env['rail.code.affaire.counter']
+        report = {'codes': {}, 'incomplete': {}, 'collisions': {}}
+
+        by_prefix = {}
+        for record in self.filtered(lambda m: not m.code_affaire):
+            prefix, error = record._code_affaire_prefix()
+            if error:
+                report['incomplete'][record.id] = error
+            else:
+                by_prefix.setdefault(prefix, []).append(record.id)
+        by_scope = {}
+        for prefix in sorted(by_prefix):
+            by_scope.setdefault(counter_scope(prefix), []).append(prefix)
+
+        data_last = Counter._data_last_index(by_scope)
+        for scope, prefixes in by_scope.items():
+            if not dry_run:
+                # Verrouille le compteur jusqu'à la fin de la transaction
+                Counter._claim(scope, data_last.get(scope, 0))
+            first = max(Counter._peek(scope), data_last.get(scope, 0) + 1)
+            planned = [(prefix, mid) for prefix in prefixes for mid in sorted(by_prefix[prefix])]
+            available = max(0, CODE_INDEX_MAX - first + 1)
+            for prefix, mid in planned[available:]:
+                report['incomplete'][mid] = f"Plus de numéro libre pour l'exercice {scope}."
+            planned = planned[:available]
+            if planned and not dry_run:
+                Counter._reserve(scope, len(planned))
+            for offset, (prefix, mid) in enumerate(planned):
+                report['codes'][mid] = format_code(prefix, first + offset)
+
+        # Collisions : codes déjà présents en double, et codes prévus déjà pris
+        codes = set(self.filtered('code_affaire').mapped('code_affaire')) | set(report['codes'].values())
+        planned_ids = {code: mid for mid, code in report['codes'].items()}
+        if codes:
+            for code, ids in self.with_context(active_test=False)._read_group(
+                    [('code_affaire', 'in', list(codes))], ['code_affaire'], ['id:array_agg']):
+                if code in planned_ids:
+                    ids = ids + [planned_ids[code]]
+                if len(ids) > 1:
+                    report['collisions'][code] = sorted(ids)
+
+        if dry_run or not report['codes']:
+            return report
+        taken = sorted(code for code in report['collisions'] if code in planned_ids)
+        if taken:
+            raise exceptions.UserError(
+                "Génération annulée, codes déjà attribués :\n%s" % "\n".join(taken))
+
+        self.flush_model(['code_affaire', 'last_synced_code', 'code_affaire_generated'])
+        ids, values = zip(*report['codes'].items())
+        self.env.cr.execute("""
+            UPDATE rail_measurement m
+               SET code_affaire = v.code,
+                   last_synced_code = v.code,
+                   code_affaire_generated = FALSE
+              FROM unnest(%s::integer[], %s::varchar[]) AS v(id, code)
+             WHERE m.id = v.id
+        """, [list(ids), list(values)])
+        self.browse(ids).invalidate_recordset(['code_affaire', 'last_synced_code', 'code_affaire_generated'])
+        return report
+
+    def action_generate_code_affaire_batch(self, dry_run=False):
+        """Action de liste : génération (ou simulation) en masse des codes affaire."""
+        report = self._generate_code_affaire_batch(dry_run=dry_run)
+        lines = [
+            f"{len(report['codes'])} code(s) {'prévu(s)' if dry_run else 'attribué(s)'}, "
+            f"{len(report['incomplete'])} affaire(s) incomplète(s), "
+            f"{len(report['collisions'])} collision(s)."
+        ]
+        lines += [f"Collision {code} : affaires {', '.join(map(str, ids))}"
+                  for code, ids in sorted(report['collisions'].items())]
+        lines += [f"Affaire {mid} : {reason}" for mid, reason in sorted(report['incomplete'].items())]
+        _logger.info("Codes affaire en masse : %s", " / ".join(lines))
+        params = {
+            'title': 'Simulation des codes affaire' if dry_run else 'Codes affaire générés',
+            'message': "\n".join(lines),
+            'type': 'warning' if report['collisions'] or report['incomplete'] else 'success',
+            'sticky': dry_run,
+        }
+        if not dry_run:
+            params['next'] = {'type': 'ir.actions.client', 'tag': 'reload'}
+        return {'type': 'ir.actions.client', 'tag': 'display_notification', 'params': params}
 
     # Informations client et commande
     partner_id = fields.Many2one('res.partner', string='Client', tracking=True)
@@ -464,7 +655,12 @@ class RailMeasurement(models.Model):
 
     @api.depends('sale_order_ids.state', 'sale_order_ids.so_parent_id')
     def _compute_has_revised_quotes(self):
+        stats = self._sale_order_stats()
         for rec in self:
+            if rec.id in stats:
+                rec.has_revised_quotes = stats[rec.id]['revised']
+                continue
+            # Enregistrement non sauvegardé (onchange) : on lit le cache
             # 1. Get the IDs of all SOs that are listed as a 'parent' in this measurement
             parent_ids = rec.sale_order_ids.mapped('so_parent_id').ids
             
@@ -475,6 +671,38 @@ class RailMeasurement(models.Model):
                 for so in rec.sale_order_ids
             )
 
+    def _sale_order_stats(self):
+        """États des devis de toutes les mesures de ``self``, en deux requêtes
+        groupées au lieu d'un parcours de ``sale_order_ids`` par mesure.
+
+        Retourne {measurement_id: {'states': set, 'revised': bool}} pour les
+        mesures enregistrées ; les nouveaux enregistrements sont absents.
+        """
+        ids = [rid for rid in self.ids if isinstance(rid, int)]
+        if not ids:
+            return {}
+        SaleOrder = self.env['sale.order']
+        stats = {rid: {'states': set(), 'revised': False} for rid in ids}
+        active_ids = {}
+        for measurement, state, so_ids in SaleOrder._read_group(
+            [('measurement_id', 'in', ids)],
+            ['measurement_id', 'state'],
+            ['id:array_agg'],
+        ):
+            stats[measurement.id]['states'].add(state)
+            if state != 'cancel':
+                active_ids.setdefault(measurement.id, set()).update(so_ids)
+
+        # Devis actif ayant au moins une révision dans la même mesure
+        for measurement, parent_ids in SaleOrder._read_group(
+            [('measurement_id', 'in', ids), ('so_parent_id', '!=', False)],
+            ['measurement_id'],
+            ['so_parent_id:array_agg'],
+        ):
+            stats[measurement.id]['revised'] = bool(
+                active_ids.get(measurement.id, set()).intersection(parent_ids))
+        return stats
+
     ## Voie
     voie_ids = fields.Many2many(
         'leyfa.type.voie',           # Modèle de destination
@@ -632,14 +860,20 @@ class RailMeasurement(models.Model):
 
     @api.depends('sale_order_ids.state')
     def _compute_so_ever_confirmed(self):
+        stats = self._sale_order_stats()
         for rec in self:
-            rec.so_ever_confirmed = any(
-                so.state in ['sale', 'done'] 
-                for so in rec.sale_order_ids
-            )
+            if rec.id in stats:
+                rec.so_ever_confirmed = bool(stats[rec.id]['states'] & {'sale', 'done'})
+            else:
+                rec.so_ever_confirmed = any(
+                    so.state in ['sale', 'done'] 
+                    for so in rec.sale_order_ids
+                )
 
     @api.depends('sale_order_id.state', 'so_ever_confirmed')
     def _compute_state(self):
+        # Un seul SELECT pour les devis principaux de tout le lot
+        self.sale_order_id.fetch(['state'])
         for record in self:
             so_state = record.sale_order_id.state
 
@@ -648,7 +882,7 @@ class RailMeasurement(models.Model):
             elif so_state in ['draft', 'sent'] and not record.so_ever_confirmed:
                 record.state = 'presale'
             elif record.so_ever_confirmed:
-                if record.state not in ['production', 'planned', 'measured', 'done']:
+                if record.state not in ['production', 'measure', 'study', 'invoicing', 'done']:
                     record.state = 'production'
                     record.prod_substate = 'mission'
             else:
@@ -666,6 +900,7 @@ class RailMeasurement(models.Model):
 
     @api.depends('sale_order_id.state')
     def _compute_sale_substate(self):
+        self.sale_order_id.fetch(['state'])
         for record in self:
             if record.sale_order_id:
                 record.sale_substate = record.sale_order_id.state
@@ -706,136 +941,32 @@ class RailMeasurement(models.Model):
 
     @api.depends('state', 'prod_substate', 'measure_substate', 'study_substate', 'view_level', 'sale_order_id.state')
     def _compute_mermaid_graph(self):
+        # Rendu mémorisé par (graphe, étape) : voir web_widget_mermaid_field.tools
         for rec in self:
+            cancelled = rec.state == 'cancelled'
+            tail = ()
             if rec.view_level == 'overview':
-                rec.mermaid_graph = rec._generate_macro_graph()
+                graph, current = MERMAID_MACRO, rec.state
+                tail = MERMAID_MACRO_CANCELLED if cancelled else ("  class CANCELLED done",)
             elif rec.view_level == 'sale_detail':
-                rec.mermaid_graph = rec._generate_sale_micro()
+                graph, current = MERMAID_SALE, rec._mermaid_sale_state()
             elif rec.view_level == 'prod_detail':
-                rec.mermaid_graph = rec._generate_prod_micro()
+                graph, current = MERMAID_PROD, rec.prod_substate
             elif rec.view_level == 'measure_detail':
-                rec.mermaid_graph = rec._generate_measure_micro()
+                graph, current = MERMAID_MEASURE, rec.measure_substate
             else:
-                rec.mermaid_graph = rec._generate_study_micro()
-
-    def _generate_macro_graph(self):
-        lines = [
-            "graph LR",
-            "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-            "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-            "classDef invisible fill:none,stroke:none,color:none",
-            "",
-            "  %% Ligne 1 : Flux nominal",
-            "  PRESALE[Pré-Vente] --> PROD[Planification]",
-            "  subgraph Production",
-            "  PROD --> MEASURE[Mesure]",
-            "  MEASURE --> STUDY[Études]",
-            "  end",
-            "  STUDY --> INV[Facturation]",
-            "  INV --> DONE((Fin))",
-            "",
-            "  %% Ligne 2 : Annulation",
-            "  %% ~~~ crée un lien invisible qui force CANCELLED à rester sous PRESALE",
-            "  PRESALE ~~~ EMPTY[ ]",
-            "  EMPTY -.-> CANCELLED[Annulé]",
-            "",
-            "  class EMPTY invisible"
-        ]
-
-        mapping = {
-            'presale': 'PRESALE', 'production': 'PROD', 'measure': 'MEASURE', 
-            'study': 'STUDY', 'invoicing': 'INV', 'done': 'DONE'
-        }
-
-        # 1. Utilisation de ton helper
-        graph_content = self._apply_styles(lines, mapping, self.state, 
-                                           ['presale', 'production', 'measure', 'study', 'invoicing', 'done'])
-        
-        res_lines = graph_content.split('\n')
-        
-        # 2. Gestion de la surbrillance
-        if self.state == 'cancelled':
-            res_lines.append("  class CANCELLED active")
-            res_lines.append("  class PRESALE,PROD,MEASURE,STUDY,INV,DONE done")
-        else:
-            res_lines.append("  class CANCELLED done")
-
-        return "\n".join(res_lines)
-
-    def _generate_sale_micro(self):
-        """Graphe basé sur les états de sale.order_id, incluant l'attente et le regroupement final"""
-        lines = [
-            "graph LR", 
-            "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px", 
-            "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-            "WAIT[Attente Devis] --> DRAFT[Devis]",
-            "DRAFT --> SENT[Envoyé]",
-            "SENT --> FINAL([Vente Confirmée])"
-        ]
+                graph, current = MERMAID_STUDY, rec.study_substate
+            rec.mermaid_graph = graph.render(current, all_done=cancelled, tail=tail)
 
-        # Mapping des états techniques vers les nœuds Mermaid
-        mapping = {
-            'waiting': 'WAIT',
-            'draft': 'DRAFT',
-            'sent': 'SENT',
-            'confirmed_all': 'FINAL'
-        }
-
-        # Détermination de l'état actuel pour le graphe
+    def _mermaid_sale_state(self):
+        """Étape du graphe de vente : attente, devis, envoyé ou confirmé."""
         if not self.sale_order_id:
-            current_sale_state = 'waiting'
-        else:
-            raw_state = self.sale_order_id.state
-            # Regroupement des états finaux de vente
-            if raw_state in ['sale', 'done']:
-                current_sale_state = 'confirmed_all'
-            else:
-                current_sale_state = raw_state
-
-        # Application des styles selon l'ordre chronologique
-        return self._apply_styles(
-            lines, 
-            mapping, 
-            current_sale_state, 
-            ['waiting', 'draft', 'sent', 'confirmed_all']
-        )
+            return 'waiting'
+        # Regroupement des états finaux de vente
+        if self.sale_order_id.state in ['sale', 'done']:
+            return 'confirmed_all'
+        return self.sale_order_id.state
 
-    def _generate_prod_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-                 "M1[Fiche Mission] --> M2{Matériel ?}", "M2 -- Non --> M2_U[Demande de matériel]", "M2_U --> M2", "M2 -- Oui --> M3([Chariots réservés])", "M3 -.-> M4[Production quotidienne]"]
-        mapping = {'mission': 'M1', 'material': 'M2', 'urgence': 'M2_U', 'assigned': 'M3', 'final': 'M4'}
-        return self._apply_styles(lines, mapping, self.prod_substate, ['mission', 'material', 'urgence', 'assigned'])
-
-    def _generate_measure_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-                 "ME1[En attente] --> ME2[Repérage]", "subgraph Production quotidienne", "ME2 --> ME3[Mesure Géométrie]", "ME3 --> ME4[Mesure Position]", "ME4 --> ME5[Mesure Caténaire]", "end", "ME5 --> ME6((Fin))"]
-        mapping = {'waiting_prod': 'ME1', 'reperage': 'ME2', 'geometrie': 'ME3', 'position': 'ME4', 'catenaire': 'ME5', 'done': 'ME6'}
-        return self._apply_styles(lines, mapping, self.measure_substate, ['waiting_prod', 'reperage', 'geometrie', 'position', 'catenaire', 'done'])
-
-    def _generate_study_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-                 "S1[Réception] --> S2[Analyse]", "S2 --> S3{Validation}", "S3 -- KO --> S1", "S3 -- OK --> S4((Fin))"]
-        mapping = {'reception': 'S1', 'analysis': 'S2', 'validation': 'S3', 'final': 'S4'}
-        return self._apply_styles(lines, mapping, self.study_substate, ['reception', 'analysis', 'validation'])
-
-    def _apply_styles(self, lines, mapping, current, order):
-        if self.state == 'cancelled':
-            for node in mapping.values():
-                lines.append(f"class {node} done")
-            return "\n".join(lines)
-        
-        if current in order:
-            idx = order.index(current)
-            for i, key in enumerate(order):
-                node = mapping.get(key)
-                if node:
-                    if i < idx: lines.append(f"class {node} done")
-                    elif i == idx: lines.append(f"class {node} active")
-        return "\n".join(lines)
-    
     state_tip = fields.Html(compute='_compute_state_tip')
 
     @api.depends('state', 'sale_substate', 'prod_substate', 'measure_substate', 'study_substate')
@@ -1166,78 +1297,66 @@ class RailMeasurement(models.Model):
 
     @api.depends('date_start', 'date_end')
     def _compute_unavailable_equipe_ids(self):
+        availability = self.env['rail.resource.availability']
         for rec in self:
             if not rec.date_start or not rec.date_end:
                 rec.unavailable_equipe_ids = [(6, 0, [])]
                 continue
-            
-            # On cherche les conflits de dates sur les autres mesures
-            domain = [
-                ('id', '!=', rec._origin.id if rec._origin else rec.id),
-                ('date_start', '<', rec.date_end),
-                ('date_end', '>', rec.date_start),
-                ('state', '!=', 'cancel'),
-            ]
-            conflicts = self.env['rail.measurement'].search(domain)
-            
-            # On cumule les IDs des équipes 1 et 2 déjà prises
-            booked_ids = conflicts.mapped('equipe_id_1').ids + conflicts.mapped('equipe_id_2').ids
-            rec.unavailable_equipe_ids = [(6, 0, list(set(booked_ids)))]
 
-    @api.constrains('date_start', 'date_end', 'equipe_id_1', 'equipe_id_2', 'state')
+            # Équipes 1 et 2 déjà prises sur une autre affaire de la période
+            busy = availability.busy_resources(
+                EQUIPE, rec.date_start, rec.date_end,
+                exclude_id=rec._origin.id or None,
+            )
+            rec.unavailable_equipe_ids = [(6, 0, list(busy))]
+
+    @api.constrains('date_start', 'date_end', 'equipe_id_1', 'equipe_id_2', 'has_second_team', 'state')
     def _check_teams_availability(self):
+        # 1. Vérification : Équipe 1 ne doit pas être Équipe 2
         for rec in self:
-            # On ne vérifie que si les dates et au moins une équipe sont renseignées
-            if not rec.date_start or not rec.date_end or rec.state == 'cancel':
-                continue
-            
-            # 1. Vérification : Équipe 1 ne doit pas être Équipe 2
             if rec.has_second_team and rec.equipe_id_1 and rec.equipe_id_2:
                 if rec.equipe_id_1 == rec.equipe_id_2:
                     raise ValidationError(_("Erreur : L'équipe n°1 et l'équipe n°2 ne peuvent pas être la même."))
 
-            # 2. Préparation des équipes à vérifier
+        # 2. La contrainte d'exclusion de rail.resource.booking tranche ;
+        # on ne cherche le détail en Python que pour expliquer un refus
+        # (ou si la contrainte n'existe pas en base).
+        if self.env['rail.resource.booking']._flush_and_check():
+            return
+        self._raise_team_conflicts()
+        self.chariot_type_lines._raise_chariot_conflicts()
+
+    def _raise_team_conflicts(self):
+        requests = []
+        for rec in self:
+            # On ne vérifie que si les dates et au moins une équipe sont renseignées
+            if not rec.date_start or not rec.date_end or rec.state in EXCLUDED_STATES[EQUIPE]:
+                continue
+
             teams_to_check = []
             if rec.equipe_id_1:
                 teams_to_check.append(rec.equipe_id_1.id)
             if rec.has_second_team and rec.equipe_id_2:
                 teams_to_check.append(rec.equipe_id_2.id)
 
-            if not teams_to_check:
-                continue
-
-            # 3. Recherche de conflits sur d'autres mesures
-            domain = [
-                ('id', '!=', rec.id), # Pas la mesure actuelle
-                ('state', '!=', 'cancel'),
-                ('date_start', '<', rec.date_end), # Chevauchement de dates
-                ('date_end', '>', rec.date_start),
-                '|',
-                ('equipe_id_1', 'in', teams_to_check),
-                ('equipe_id_2', 'in', teams_to_check),
-            ]
-            
-            conflict = self.env['rail.measurement'].search(domain, limit=1)
-
-            if conflict:
-                # Identification de l'équipe qui pose problème pour un message précis
-                team_name = ""
-                if rec.equipe_id_1 and (conflict.equipe_id_1 == rec.equipe_id_1 or conflict.equipe_id_2 == rec.equipe_id_1):
-                    team_name = rec.equipe_id_1.name
-                else:
-                    team_name = rec.equipe_id_2.name
-
-                raise ValidationError(_(
-                    "Conflit de planification !\n\n"
-                    "L'équipe '%s' est déjà réservée sur l'affaire '%s' "
-                    "du %s au %s.\n\n"
-                    "Veuillez choisir une autre équipe ou modifier les dates."
-                ) % (
-                    team_name,
-                    conflict.code_affaire or conflict.name,
-                    conflict.date_start.strftime('%d/%m/%Y'),
-                    conflict.date_end.strftime('%d/%m/%Y')
-                ))
+            if teams_to_check:
+                requests.append((rec.id, rec.date_start, rec.date_end, teams_to_check))
+
+        # Recherche de conflits sur d'autres mesures (un seul chargement)
+        conflicts = self.env['rail.resource.availability'].conflicts(EQUIPE, requests)
+        if conflicts:
+            _measurement_id, team_id, booking = conflicts[0]
+            raise ValidationError(_(
+                "Conflit de planification !\n\n"
+                "L'équipe '%s' est déjà réservée sur l'affaire '%s' "
+                "du %s au %s.\n\n"
+                "Veuillez choisir une autre équipe ou modifier les dates."
+            ) % (
+                self.env['equipe.terrain'].browse(team_id).name,
+                booking['label'],
+                booking['date_start'].strftime('%d/%m/%Y'),
+                booking['date_end'].strftime('%d/%m/%Y')
+            ))
 
     @api.depends('chariot_type_lines.chariot_type_id')
     def _compute_existing_chariot_types(self):
@@ -1396,8 +1515,11 @@ class RailMeasurement(models.Model):
                 vals['reference'] = self.env['ir.sequence'].next_by_code('rail.measurement') or 'New'
             
         # 2. Création des enregistrements
-        records = super(RailMeasurement, self).create(vals_list)
+        invalidate_busy_labels(self.env)
+        with booking_conflict_guard():
+            records = super(RailMeasurement, self).create(vals_list)
         records._check_partner_consistency()
+        records.filtered('code_affaire')._claim_code_affaire()
 
         if records.sale_order_id:
             records.sale_order_id.measurement_id = records.id
@@ -1408,6 +1530,18 @@ class RailMeasurement(models.Model):
         # records.update_sale_order_line()
         return records
 
+    def _resync_sale_states(self):
+        """Recalcule en masse les états issus des devis (après une migration
+        ou un import SQL), par lots de RESYNC_BATCH mesures."""
+        fnames = ['so_ever_confirmed', 'sale_substate', 'state']
+        for start in range(0, len(self), RESYNC_BATCH):
+            batch = self[start:start + RESYNC_BATCH]
+            for fname in fnames:
+                self.env.add_to_compute(self._fields[fname], batch)
+            batch.flush_recordset(fnames + ['prod_substate'])
+            batch.invalidate_recordset()
+        return True
+
     def _check_partner_consistency(self):
         if self.sale_order_id and not self.partner_id:
             raise UserError(_('Un client doit être référencé'))
@@ -1428,11 +1562,9 @@ class RailMeasurement(models.Model):
                 'consistance_lines.maj_deb', 'consistance_lines.maj_fin',
                 'consistance_lines.voie_id')
     def _compute_description_consistance(self):
+        # 1. Regroupement des lignes de consistance par ligne ferroviaire
+        groups_by_measurement = {}
         for m in self:
-            if not m.consistance_lines:
-                m.description_consistance = ""
-                continue
-
             groups = {}
             for line in m.consistance_lines:
                 if not line.ligne_id:
@@ -1452,29 +1584,70 @@ class RailMeasurement(models.Model):
                 if line.voie_id:
                     groups[lid]['voies'].add(line.voie_id.name)
                 groups[lid]['total_length'] += (line.limite_aval - line.limite_amont)
+            groups_by_measurement[m] = sorted(groups.values(), key=lambda g: g['total_length'], reverse=True)
 
-            sorted_groups = sorted(groups.values(), key=lambda g: g['total_length'], reverse=True)
+        # 2. Gares encadrantes de toutes les fenêtres en une requête
+        windows = {
+            (g['ligne'].id, g['pkd_min'], g['pkf_max'])
+            for groups in groups_by_measurement.values()
+            for g in groups
+        }
+        gares = self._boundary_gares(windows)
 
+        # 3. Libellés
+        for m, groups in groups_by_measurement.items():
             parts = []
-            for g in sorted_groups:
-                ligne = g['ligne']
+            for g in groups:
                 pkd_min = g['pkd_min']
                 pkf_max = g['pkf_max']
-
-                gares = self.env['leyfa.gare'].search([
-                    ('ligne_id', '=', ligne.id),
-                    ('pk_metrique', '>=', pkd_min - 400),
-                    ('pk_metrique', '<=', pkf_max + 400),
-                ], order='pk_metrique asc')
-
-                gares_str = f"{gares[0].name}/{gares[-1].name}" if gares else f"{int(pkd_min)}m/{int(pkf_max)}m"
+                bounds = gares.get((g['ligne'].id, pkd_min, pkf_max))
+                gares_str = f"{bounds[0]}/{bounds[1]}" if bounds else f"{int(pkd_min)}m/{int(pkf_max)}m"
                 voies = ", ".join(sorted(g['voies']))
                 voies_str = f" ({voies})" if voies else ""
 
-                parts.append(f"{ligne.name} {gares_str}{voies_str}")
+                parts.append(f"{g['ligne'].name} {gares_str}{voies_str}")
 
             m.description_consistance = " & ".join(parts)
 
+    @api.model
+    def _boundary_gares(self, windows):
+        """Première et dernière gare (par PK) de chaque fenêtre, marge de 400 m.
+
+        ``windows`` : ensemble de (ligne_id, pk_min, pk_max). Retourne
+        {fenêtre: (nom première gare, nom dernière gare)} pour les fenêtres qui
+        contiennent au moins une gare ; deux LATERAL sur l'index
+        (ligne_id, pk_metrique) de leyfa.gare, une seule requête pour le lot.
+        """
+        if not windows:
+            return {}
+        windows = list(windows)
+        self.env['leyfa.gare'].flush_model(['name', 'ligne_id', 'pk_metrique'])
+        self.env.cr.execute("""
+            SELECT w.idx, first.name, last.name
+              FROM unnest(%s::integer[], %s::integer[], %s::float8[], %s::float8[])
+                   AS w(idx, ligne_id, pk_min, pk_max)
+              JOIN LATERAL (
+                   SELECT g.name FROM leyfa_gare g
+                    WHERE g.ligne_id = w.ligne_id
+                      AND g.pk_metrique BETWEEN w.pk_min - 400 AND w.pk_max + 400
+                    ORDER BY g.pk_metrique, g.id
+                    LIMIT 1
+                   ) first ON TRUE
+              JOIN LATERAL (
+                   SELECT g.name FROM leyfa_gare g
+                    WHERE g.ligne_id = w.ligne_id
+                      AND g.pk_metrique BETWEEN w.pk_min - 400 AND w.pk_max + 400
+                    ORDER BY g.pk_metrique DESC, g.id DESC
+                    LIMIT 1
+                   ) last ON TRUE
+        """, [
+            list(range(len(windows))),
+            [w[0] for w in windows],
+            [w[1] for w in windows],
+            [w[2] for w in windows],
+        ])
+        return {windows[idx]: (first, last) for idx, first, last in self.env.cr.fetchall()}
+
     def _get_default_description_affaire(self):
         self.ensure_one()
         self.with_context(skip_description_update=True)._compute_description_consistance()
@@ -1505,6 +1678,7 @@ class RailMeasurement(models.Model):
             })
 
     def write(self, vals):
+        invalidate_busy_labels(self.env)
         if self.env.context.get('skip_description_update'):
             return super().write(vals)
 
@@ -1517,6 +1691,8 @@ class RailMeasurement(models.Model):
 
         res = super().write(vals)
         self._check_partner_consistency()
+        if vals.get('code_affaire'):
+            self._claim_code_affaire()
 
         for m in self:
             if not m.description_affaire_manual:
@@ -1553,6 +1729,7 @@ class RailMeasurement(models.Model):
             #         'product_uom_id': self.env.ref('rail_measurement.uom_none', raise_if_not_found=False),
             #     })
             #     record.sale_order_line_etudes_id.with_context(allow_study_deletion=True).unlink()
+        invalidate_busy_labels(self.env)
         return super(RailMeasurement, self).unlink()
 
     @api.constrains('date_start', 'date_end')
@@ -1583,17 +1760,17 @@ class RailMeasurement(models.Model):
             if broken:
                 soft_errors.append(f"⚠️ Matériel indisponible : {', '.join(broken.mapped('name'))}")
 
-            # C. Vérification CONFLITS PLANNING (SOUPLE)
-            for chariot in line.assigned_chariot_ids:
-                conflicts = self.env['rail.measurement'].search([
-                    ('id', '!=', self.id),
-                    ('state', 'not in', ['draft', 'cancelled']),
-                    ('date_start', '<', self.date_end),
-                    ('date_end', '>', self.date_start),
-                    ('chariot_type_lines.assigned_chariot_ids', 'in', chariot.id)
-                ])
-                if conflicts:
-                    soft_errors.append(f"⚠️ Conflit planning pour {chariot.name} avec {conflicts[0].reference}")
+        # C. Vérification CONFLITS PLANNING (SOUPLE)
+        chariots = self.chariot_type_lines.assigned_chariot_ids
+        conflicts = self.env['rail.resource.availability'].conflicts(
+            CHARIOT, [(self.id, self.date_start, self.date_end, chariots.ids)])
+        reported = set()
+        for _measurement_id, chariot_id, booking in conflicts:
+            if chariot_id in reported:
+                continue
+            reported.add(chariot_id)
+            chariot = chariots.browse(chariot_id)
+            soft_errors.append(f"⚠️ Conflit planning pour {chariot.name} avec {booking['reference']}")
 
         # --- 2. DÉCISION FINALE ---
         if soft_errors:
@@ -1767,25 +1944,20 @@ class RailMeasurement(models.Model):
         Return (center_lat, center_lon, zoom) that fits all work zones.
         padding_factor: >1 adds padding around the bounds (1.3 = 30% padding)
         """
-        lats, lons = [], []
-
+        windows = []
         for c_line in self.consistance_lines:
             if not c_line.ligne_id:
                 continue
             work_start = min(c_line.pkd, c_line.pkf) / 1000.0
             work_end   = max(c_line.pkd, c_line.pkf) / 1000.0
+            windows.append((c_line.ligne_id.id, work_start - 0.1, work_end + 0.1))
 
-            for pk_point in c_line.ligne_id.pk_ids:
-                if (work_start - 0.1) <= pk_point.pk <= (work_end + 0.1):
-                    if pk_point.lat and pk_point.lon:
-                        lats.append(pk_point.lat)
-                        lons.append(pk_point.lon)
-
-        if not lats or not lons:
+        # Une requête de plage sur l'index (ligne_id, pk) pour toutes les zones
+        bounds = self.env['leyfa.ligne']._pk_bounds(windows)
+        if not bounds:
             return 46.5, 2.5, 6
 
-        min_lat, max_lat = min(lats), max(lats)
-        min_lon, max_lon = min(lons), max(lons)
+        min_lat, max_lat, min_lon, max_lon = bounds
 
         center_lat = (min_lat + max_lat) / 2
         center_lon = (min_lon + max_lon) / 2
@@ -1985,6 +2157,36 @@ class RailMeasurementChariotTypeLine(models.Model):
         # le filtre de date sera appliqué via l'onchange ci-dessous.
     )
 
+    def _flush(self, fnames=None):
+        # La relation ligne ↔ chariot alimente rail.resource.booking par trigger
+        with booking_conflict_guard():
+            return super()._flush(fnames)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        invalidate_busy_labels(self.env)
+        with booking_conflict_guard():
+            return super().create(vals_list)
+
+    def write(self, vals):
+        invalidate_busy_labels(self.env)
+        if 'assigned_chariot_ids' not in vals or not self.env['rail.resource.booking']._exclusion_active():
+            return super().write(vals)
+        # La relation est écrite tout de suite (pas au flush) : le trigger de
+        # réservation, donc la contrainte d'exclusion, tranche dès ici.
+        try:
+            with self.env.cr.savepoint(flush=False), booking_conflict_guard():
+                return super().write(vals)
+        except BookingConflictError:
+            # Le cache ne doit garder aucune valeur annulée par le savepoint
+            self.env.invalidate_all()
+            self._raise_requested_chariot_conflicts(vals['assigned_chariot_ids'])
+            raise
+
+    def unlink(self):
+        invalidate_busy_labels(self.env)
+        return super().unlink()
+
     # === ALGORITHME DE DÉTECTION DE CONFLIT ===
     @api.onchange('chariot_type_id')
     def _onchange_compute_allowed_chariots(self):
@@ -2007,17 +2209,11 @@ class RailMeasurementChariotTypeLine(models.Model):
         start = self.measurement_id.date_start
         end = self.measurement_id.date_end
 
-        # 1. Trouver toutes les mesures qui chevauchent la nôtre
-        # (Start A < End B) et (End A > Start B)
-        overlapping_measurements = self.env['rail.measurement'].search([
-            ('id', '!=', self.measurement_id.id.origin), # Ne pas se compter soi-même
-            ('state', 'not in', ['presale', 'cancelled']),  # Ignorer les brouillons/annulés
-            ('date_start', '<', end),
-            ('date_end', '>', start),
-        ])
-
-        # 2. Récupérer les IDs des chariots pris par ces mesures
-        busy_chariot_ids = overlapping_measurements.mapped('assigned_chariot_ids').ids
+        # 1. Chariots pris par les mesures qui chevauchent la nôtre
+        busy_chariot_ids = list(self.env['rail.resource.availability'].busy_resources(
+            CHARIOT, start, end,
+            exclude_id=self.measurement_id._origin.id or None,  # Ne pas se compter soi-même
+        ))
 
         # 3. Construire le domaine
         return {
@@ -2062,28 +2258,75 @@ class RailMeasurementChariotTypeLine(models.Model):
     # Au cas où l'utilisateur force la saisie ou change les dates après coup
     @api.constrains('assigned_chariot_ids')
     def _check_availability_conflicts(self):
-        for line in self:
-            start = line.measurement_id.date_start
-            end = line.measurement_id.date_end
-            
-            for chariot in line.assigned_chariot_ids:
-                # Chercher conflit
-                conflicts = self.env['rail.measurement'].search([
-                    ('id', '!=', line.measurement_id.id),
-                    ('state', 'not in', ['presale', 'cancelled']),
-                    ('date_start', '<', end),
-                    ('date_end', '>', start),
-                    ('assigned_chariot_ids', 'in', chariot.id)
-                ])
-                
-                if conflicts:
-                    dates = f"{conflicts[0].date_start} - {conflicts[0].date_end}"
-                    raise exceptions.ValidationError(
-                        f"Le chariot {chariot.name} est déjà réservé sur la mesure "
-                        f"{conflicts[0].reference} ({dates}).\n"
-                        f"Si aucun chariot n'est disponible, et que vous souhaitez forcer l'affectation, passez la mesure en mode 'Demande Matériel - Urgence'."
-                    )
-    
+        if self.env['rail.resource.booking']._flush_and_check():
+            return
+        self._raise_chariot_conflicts()
+        self.measurement_id._raise_team_conflicts()
+
+    def _raise_chariot_conflicts(self):
+        # Une seule requête pour toutes les lignes validées, et on remonte
+        # tous les conflits d'un coup plutôt que le premier rencontré.
+        conflicts = self.env['rail.resource.availability'].chariot_line_conflicts(self.ids)
+        if conflicts:
+            raise exceptions.ValidationError(self._chariot_conflict_message(conflicts))
+
+    @api.model
+    def _chariot_conflict_message(self, conflicts):
+        lines = [
+            f"- Le chariot {c['chariot_name']} est déjà réservé sur la mesure "
+            f"{c['reference']} ({c['date_start']} - {c['date_end']})."
+            for c in conflicts
+        ]
+        return (
+            "\n".join(lines) + "\n"
+            "Si aucun chariot n'est disponible, et que vous souhaitez forcer l'affectation, passez la mesure en mode 'Demande Matériel - Urgence'."
+        )
+
+    def _requested_chariot_ids(self, commands):
+        """Chariots de la ligne une fois les commandes ``commands`` appliquées."""
+        self.ensure_one()
+        if commands and not isinstance(commands[0], (list, tuple)):
+            return set(commands)
+        chariot_ids = set(self.assigned_chariot_ids.ids)
+        for command in commands:
+            if command[0] == Command.SET:
+                chariot_ids = set(command[2])
+            elif command[0] == Command.CLEAR:
+                chariot_ids = set()
+            elif command[0] == Command.LINK:
+                chariot_ids.add(command[1])
+            elif command[0] in (Command.UNLINK, Command.DELETE):
+                chariot_ids.discard(command[1])
+        return chariot_ids
+
+    def _raise_requested_chariot_conflicts(self, commands):
+        """Détail des conflits de ``commands`` refusées par la contrainte
+        d'exclusion, calculé sur l'état en base (la relation n'a pas été
+        écrite)."""
+        requests = [
+            (line.measurement_id.id, line.measurement_id.date_start, line.measurement_id.date_end,
+             line._requested_chariot_ids(commands))
+            for line in self
+            if line.measurement_id.state not in EXCLUDED_STATES[CHARIOT]
+        ]
+        found = self.env['rail.resource.availability'].conflicts(CHARIOT, requests)
+        if not found:
+            return
+        names = {
+            chariot.id: chariot.name
+            for chariot in self.env['chariot'].browse({rid for _mid, rid, _b in found})
+        }
+        conflicts = sorted((
+            {
+                'chariot_name': names.get(rid),
+                'reference': booking['reference'],
+                'date_start': booking['date_start'],
+                'date_end': booking['date_end'],
+            }
+            for _mid, rid, booking in found
+        ), key=lambda c: (c['chariot_name'] or '', c['date_start']))
+        raise exceptions.ValidationError(self._chariot_conflict_message(conflicts))
+
     @api.constrains('quantity')
     def _check_quantity(self):
         for record in self:
@@ -2730,12 +2973,112 @@ class RailMeasurementDayFile(models.Model):
         store=True
     )
     
+    # Pièce jointe (défaut des champs Binary) : ir.attachment range le contenu
+    # par sha1, deux fichiers identiques ne prennent qu'une place sur disque.
     file = fields.Binary(string="Fichier", required=True)
     file_name = fields.Char(string="Nom du fichier")
+    file_checksum = fields.Char(
+        string="Empreinte (sha1)", compute='_compute_file_checksum', store=True, index=True, copy=False,
+    )
     
     # Lien technique vers la mesure parente pour faciliter les recherches
     measurement_id = fields.Many2one('rail.measurement', related='planning_id.measurement_id', store=True)
 
+    _unique_file_per_measurement = models.Constraint(
+        'unique(measurement_id, file_checksum)',
+        'Ce fichier a déjà été importé pour cette mesure.'
+    )
+
+    @api.depends('file')
+    def _compute_file_checksum(self):
+        # L'empreinte est celle que ir.attachment a déjà calculée
+        checksums = {}
+        saved = [rid for rid in self.ids if isinstance(rid, int)]
+        if saved:
+            for att in self.env['ir.attachment'].sudo().search_read([
+                ('res_model', '=', self._name),
+                ('res_id', 'in', saved),
+                ('res_field', '=', 'file'),
+            ], ['res_id', 'checksum']):
+                checksums[att['res_id']] = att['checksum']
+        Attachment = self.env['ir.attachment']
+        for rec in self:
+            checksum = checksums.get(rec.id)
+            if not checksum and rec.file:
+                checksum = Attachment._compute_checksum(base64.b64decode(rec.file))
+            rec.file_checksum = checksum or False
+
+    @api.model
+    def _existing_checksums(self, pairs):
+        """Sous-ensemble des couples (measurement_id, sha1) déjà importés."""
+        if not pairs:
+            return set()
+        rows = self.search_read([
+            ('measurement_id', 'in', list({mid for mid, _checksum in pairs})),
+            ('file_checksum', 'in', list({checksum for _mid, checksum in pairs})),
+        ], ['measurement_id', 'file_checksum'])
+        return {(row['measurement_id'][0], row['file_checksum']) for row in rows} & set(pairs)
+
+    def write(self, vals):
+        # Réenvoi du même fichier : rien à écrire
+        if vals.get('file') and len(self) == 1 and self.file_checksum:
+            new_checksum = self.env['ir.attachment']._compute_checksum(base64.b64decode(vals['file']))
+            if new_checksum == self.file_checksum:
+                vals = {k: v for k, v in vals.items() if k != 'file'}
+                if not vals:
+                    return True
+        return super().write(vals)
+
+    # Synthèse du fichier (lue une fois à l'import) : les requêtes
+    # d'avancement et de couverture n'ont plus à décoder les binaires.
+    lx_date = fields.Date(string="Date du relevé", compute='_compute_lx_stats', store=True, index=True)
+    lx_ligne = fields.Char(string="Ligne (fichier)", compute='_compute_lx_stats', store=True)
+    lx_voie = fields.Char(string="Voie (fichier)", compute='_compute_lx_stats', store=True)
+    lx_lorry = fields.Char(string="Lorry", compute='_compute_lx_stats', store=True, index=True)
+    sample_count = fields.Integer(string="Échantillons", compute='_compute_lx_stats', store=True)
+    pk_start = fields.Float(string="PK début (km)", digits=(10, 3), compute='_compute_lx_stats', store=True)
+    pk_end = fields.Float(string="PK fin (km)", digits=(10, 3), compute='_compute_lx_stats', store=True)
+    pk_min = fields.Float(string="PK min (km)", digits=(10, 3), compute='_compute_lx_stats', store=True, index=True)
+    pk_max = fields.Float(string="PK max (km)", digits=(10, 3), compute='_compute_lx_stats', store=True, index=True)
+    gap_count = fields.Integer(string="Trous", compute='_compute_lx_stats', store=True)
+    gap_max = fields.Float(string="Plus grand trou (km)", digits=(10, 3), compute='_compute_lx_stats', store=True)
+    duration = fields.Float(string="Durée (s)", compute='_compute_lx_stats', store=True)
+    speed_avg = fields.Float(string="Vitesse moyenne (km/h)", digits=(6, 1), compute='_compute_lx_stats', store=True)
+    lx_error = fields.Char(string="Erreur de lecture", compute='_compute_lx_stats', store=True)
+
+    @api.model
+    def _lx_values(self, stats):
+        """Valeurs des champs de synthèse à partir du résultat de parse_lx."""
+        return {
+            'lx_date': stats.get('date', False),
+            'lx_ligne': stats.get('ligne', False),
+            'lx_voie': stats.get('voie', False),
+            'lx_lorry': stats.get('lorry', False),
+            'sample_count': stats.get('sample_count', 0),
+            'pk_start': stats.get('pk_start', 0.0),
+            'pk_end': stats.get('pk_end', 0.0),
+            'pk_min': stats.get('pk_min', 0.0),
+            'pk_max': stats.get('pk_max', 0.0),
+            'gap_count': stats.get('gap_count', 0),
+            'gap_max': stats.get('gap_max', 0.0),
+            'duration': stats.get('duration', 0.0),
+            'speed_avg': stats.get('speed_avg', 0.0),
+            'lx_error': stats.get('error', False),
+        }
+
+    @api.depends('file')
+    def _compute_lx_stats(self):
+        # bin_size : on teste la présence du fichier sans charger son contenu
+        for rec, sized in zip(self, self.with_context(bin_size=True)):
+            stats = {}
+            if sized.file:
+                try:
+                    with open_binary_stream(rec, 'file') as stream:
+                        stats = parse_lx(stream)
+                except LxParseError as e:
+                    stats = {'error': str(e)}
+            rec.update(self._lx_values(stats))
+
 class RailUrgentAssignmentWizard(models.TransientModel):
     _name = 'rail.urgent.assignment.wizard'
     _description = 'Confirmation de demande urgente'
@@ -2814,6 +3157,10 @@ class ConsistanceLine(models.Model):
             else:
                 rec.sequence_display = 0
     
+# Nombre d'erreurs de cellule affichées au plus après un import refusé
+IMPORT_MAX_ERRORS = 50
+
+
 class RailConsistanceImportWizard(models.TransientModel):
     _name = 'rail.consistance.import.wizard'
     _description = 'Wizard Import Excel (Consistance & Quais)'
@@ -2834,19 +3181,14 @@ class RailConsistanceImportWizard(models.TransientModel):
 
         data = base64.b64decode(self.file)
         try:
-            wb = openpyxl.load_workbook(io.BytesIO(data), data_only=True)
+            # Lecture en flux : les lignes ne sont jamais toutes chargées en mémoire
+            wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
         except Exception as e:
             raise UserError(_("Erreur lors de la lecture du fichier : %s") % str(e))
 
         # --- CONFIGURATION DU MAPPING ---
         # Format : 'Nom Technique Champ': (Index_Colonne_Excel, 'type', 'Optionnel_Model_M2O')
 
-        if self.replace_existing:
-            # On vide les deux tableaux liés à la mesure
-            self.measurement_id.consistance_lines.unlink()
-            self.measurement_id.quai_line_ids.unlink()
-            self.measurement_id.tunnel_line_ids.unlink()
-        
         mapping_consistance = {
             'ligne_id': (0, 'm2o', 'leyfa.ligne'),
             'voie_id': (1, 'm2o', 'leyfa.type.voie'),
@@ -2879,29 +3221,55 @@ class RailConsistanceImportWizard(models.TransientModel):
             'libelle': (3, 'char'),
         }
 
-        # --- EXECUTION ---
-        # 1. Consistance (Obligatoire)
-        self._process_sheet(wb, 'process_consistance', 'rail.measurement.consistance.line', mapping_consistance, required=True)
-        
-        # 2. Quais (Optionnel : si l'onglet n'existe pas ou est vide, on ignore)
-        if 'process_quais' in wb.sheetnames:
-            self._process_sheet(wb, 'process_quais', 'rail.measurement.quai.line', mapping_quais, required=False)
+        # --- LECTURE ---
+        # Toutes les erreurs de toutes les feuilles sont collectées avant d'écrire quoi que ce soit
+        errors = []
+        m2o_cache = {}
+        try:
+            # 1. Consistance (Obligatoire)
+            consistance_vals = self._process_sheet(wb, 'process_consistance', mapping_consistance, errors, m2o_cache, required=True)
+            # 2. Quais (Optionnel : si l'onglet n'existe pas ou est vide, on ignore)
+            quais_vals = self._process_sheet(wb, 'process_quais', mapping_quais, errors, m2o_cache)
+            # 3. Tunnels (Optionnel)
+            tunnels_vals = self._process_sheet(wb, 'process_tunnels', mapping_tunnels, errors, m2o_cache)
+            has_quais = 'process_quais' in wb.sheetnames
+            has_tunnels = 'process_tunnels' in wb.sheetnames
+        finally:
+            wb.close()
+
+        if errors:
+            shown = errors[:IMPORT_MAX_ERRORS]
+            if len(errors) > len(shown):
+                shown.append(_("… et %s autre(s) erreur(s).") % (len(errors) - len(shown)))
+            raise UserError(_("Import annulé, %s erreur(s) :\n%s") % (len(errors), "\n".join(shown)))
+
+        # --- ÉCRITURE ---
+        if self.replace_existing:
+            # On vide les tableaux liés à la mesure
+            self.measurement_id.consistance_lines.unlink()
+            self.measurement_id.quai_line_ids.unlink()
+            self.measurement_id.tunnel_line_ids.unlink()
 
+        if consistance_vals:
+            self.env['rail.measurement.consistance.line'].create(consistance_vals)
+        if quais_vals:
+            self.env['rail.measurement.quai.line'].create(quais_vals)
+        if tunnels_vals:
+            self.env['rail.measurement.tunnel.line'].create(tunnels_vals)
+
+        if has_quais:
             # Pose de cibles MT40174 dans les quais: une cible tous les 10m + 1 cible POD + 1 cible POF par quai
             if self.measurement_id.type_affaire_id.code == 'P':
                 prov_line = self.measurement_id.cible_line_ids.filtered(lambda l: l.line_type == 'cible')
                 if prov_line:
                     prov_line.qty = int(len(self.measurement_id.quai_line_ids) * 2 + sum([line.longueur/10 for line in self.measurement_id.quai_line_ids]))
 
-        if 'process_tunnels' in wb.sheetnames:
-            self._process_sheet(wb, 'process_tunnels', 'rail.measurement.tunnel.line', mapping_tunnels, required=False)
-            
+        if has_tunnels:
             # Pose de cibles PALAS tous les 10m en tunnel
             palas_line = self.measurement_id.cible_line_ids.filtered(lambda l: l.line_type == 'palas')
             if palas_line:
                 palas_line.qty = int(sum([line.longueur/10 for line in self.measurement_id.tunnel_line_ids]))
 
-
         return {
             'type': 'ir.actions.client',
             'tag': 'display_notification',
@@ -2914,18 +3282,24 @@ class RailConsistanceImportWizard(models.TransientModel):
             }
         }
 
-    def _process_sheet(self, wb, sheet_name, res_model, mapping, required=False):
-        """ Méthode générique pour traiter un onglet Excel """
+    def _process_sheet(self, wb, sheet_name, mapping, errors, m2o_cache, required=False):
+        """ Méthode générique de lecture d'un onglet Excel.
+
+        Retourne les valeurs à créer ; les erreurs de cellule sont ajoutées à
+        ``errors`` sans interrompre la lecture. ``m2o_cache`` garde, par
+        modèle, la correspondance nom → id chargée une seule fois.
+        """
         if sheet_name not in wb.sheetnames:
             if required:
                 raise UserError(_("L'onglet '%s' est requis dans le fichier Excel.") % sheet_name)
-            return
+            return []
 
         sheet = wb[sheet_name]
+        # Dimensions enregistrées parfois fausses (fichiers hors Excel) : lecture jusqu'à la fin
+        sheet.reset_dimensions()
         records_to_create = []
 
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=2), start=2):
-            cells = [cell.value for cell in row]
+        for row_idx, cells in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
             if not cells or cells[0] is None: # On saute si la 1ère colonne est vide
                 continue
 
@@ -2941,7 +3315,7 @@ class RailConsistanceImportWizard(models.TransientModel):
                 # Parsing selon le type défini
                 try:
                     if data_type == 'm2o':
-                        vals[field_name] = self._parse_m2o(config[2], val_raw, row_idx, col_idx + 1)
+                        vals[field_name] = self._parse_m2o(config[2], val_raw, row_idx, col_idx + 1, m2o_cache)
                     elif data_type == 'float':
                         vals[field_name] = self._parse_float(val_raw, row_idx, col_idx + 1)
                     elif data_type == 'int':
@@ -2949,12 +3323,11 @@ class RailConsistanceImportWizard(models.TransientModel):
                     elif data_type == 'char':
                         vals[field_name] = str(val_raw).strip() if val_raw else False
                 except Exception as e:
-                    raise UserError(_("Erreur onglet [%s] %s") % (sheet_name, str(e)))
+                    errors.append(_("Onglet [%s] %s") % (sheet_name, str(e)))
 
             records_to_create.append(vals)
 
-        if records_to_create:
-            self.env[res_model].create(records_to_create)
+        return records_to_create
 
     # --- HELPERS DE PARSING ---
 
@@ -2981,12 +3354,15 @@ class RailConsistanceImportWizard(models.TransientModel):
         except (ValueError, TypeError):
             raise UserError(_("Nombre entier invalide à la cellule %s ('%s' reçu).") % (self._get_coord(row, col), value))
 
-    def _parse_m2o(self, model, value, row, col):
+    def _parse_m2o(self, model, value, row, col, m2o_cache):
         if not value or self._is_excel_error(value):
             return False
-        name = str(value).strip()
-        record = self.env[model].search([('name', '=', name)], limit=1)
-        return record.id if record else False
+        if model not in m2o_cache:
+            # Premier enregistrement (ordre du modèle) par nom, comme search(limit=1)
+            names = m2o_cache[model] = {}
+            for rec in self.env[model].search_read([], ['name']):
+                names.setdefault(rec['name'], rec['id'])
+        return m2o_cache[model].get(str(value).strip(), False)
 
     def action_download_template(self):
         return {
@@ -0,0 +1,261 @@
+"""Disponibilité des équipes de terrain et des chariots.
+
+Un seul endroit répond à « quelles ressources sont libres sur [début, fin] »
+et « quels conflits pour cet ensemble d'affectations » : listes déroulantes,
+onchanges et contraintes passent tous par ``rail.resource.availability``.
+
+Politique d'états
+-----------------
+- Une affaire annulée (``cancelled``) ne réserve jamais rien.
+- Une équipe est réservée dès la pré-vente : l'affecter sur un devis
+  revient à la pré-positionner sur le planning.
+- L'équipe n°2 ne compte que si ``has_second_team`` est coché.
+- Un chariot n'est réservé qu'à partir de la planification : une affaire en
+  pré-vente ne bloque aucun chariot (voir EXCLUDED_STATES).
+
+Chevauchement
+-------------
+Deux affaires se chevauchent si ``début_a < fin_b`` et ``fin_a > début_b`` :
+les intervalles sont traités comme semi-ouverts [début, fin). Une affaire d'un
+seul jour (fin == début) occupe ce jour, soit [début, début + 1) : voir
+``booking_period``, appliqué à l'identique dans rail.resource.booking.
+"""
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+EQUIPE = 'equipe'
+CHARIOT = 'chariot'
+
+# États de rail.measurement qui ne réservent pas la ressource
+EXCLUDED_STATES = {
+    EQUIPE: ('cancelled',),
+    CHARIOT: ('presale', 'cancelled'),
+}
+
+# Clé de env.cr.cache des ressources occupées déjà calculées
+BUSY_CACHE_KEY = 'rail_resource_busy'
+
+
+def invalidate_busy_labels(env):
+    """Oublie les ressources occupées mémorisées par busy_labels.
+
+    Appelée à chaque écriture d'une affaire ou d'une ligne de chariots : les
+    triggers mettront à jour rail_resource_booking au prochain flush.
+    """
+    env.cr.cache.pop(BUSY_CACHE_KEY, None)
+
+
+def booking_period(start, end):
+    """Période [début, fin) réservée par une affaire du ``start`` au ``end``."""
+    return start, max(end, start + timedelta(days=1))
+
+
+class RailResourceAvailability(models.AbstractModel):
+    _name = 'rail.resource.availability'
+    _description = 'Disponibilité des équipes et chariots'
+
+    # ------------------------------------------------------------------
+    # Chargement
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _load_bookings(self, kind, start, end):
+        """Réservations chevauchant [start, end), en une requête.
+
+        Retourne une liste de (resource_id, booking) ; booking est un dict
+        décrivant l'affaire (id, dates, libellés).
+        """
+        domain = [
+            ('state', 'not in', EXCLUDED_STATES[kind]),
+            ('date_start', '!=', False),
+            ('date_end', '!=', False),
+            ('date_start', '<', end),
+            ('date_end', '>=', start),  # fin == début : l'affaire occupe son jour
+        ]
+        if kind == EQUIPE:
+            resource_fields = ['equipe_id_1', 'equipe_id_2']
+            domain += ['|', ('equipe_id_1', '!=', False), ('equipe_id_2', '!=', False)]
+        else:
+            resource_fields = ['assigned_chariot_ids']
+            domain += [('assigned_chariot_ids', '!=', False)]
+
+        rows = self.env['rail.measurement'].search_read(
+            domain,
+            ['date_start', 'date_end', 'code_affaire', 'reference', 'name', 'has_second_team']
+            + resource_fields,
+        )
+        result = []
+        for row in rows:
+            booking = {
+                'measurement_id': row['id'],
+                'date_start': row['date_start'],
+                'date_end': row['date_end'],
+                'code_affaire': row['code_affaire'],
+                'reference': row['reference'],
+                'label': row['code_affaire'] or row['name'] or "Inconnue",
+            }
+            if kind == EQUIPE:
+                teams = [row['equipe_id_1']]
+                if row['has_second_team']:
+                    teams.append(row['equipe_id_2'])
+                resource_ids = {team[0] for team in teams if team}
+            else:
+                resource_ids = row['assigned_chariot_ids']
+            for resource_id in resource_ids:
+                result.append((resource_id, booking))
+        return result
+
+    @api.model
+    def _bookings_by_resource(self, kind, start, end):
+        """{resource_id: [(début, fin, booking)]} des réservations qui
+        chevauchent [start, end), périodes normalisées par booking_period.
+
+        La requête est déjà restreinte à la fenêtre : un simple filtre suffit,
+        sans structure d'index à construire à chaque appel.
+        """
+        per_resource = {}
+        for resource_id, booking in self._load_bookings(kind, start, end):
+            b_start, b_end = booking_period(booking['date_start'], booking['date_end'])
+            if b_start < end and b_end > start:
+                per_resource.setdefault(resource_id, []).append((b_start, b_end, booking))
+        for items in per_resource.values():
+            items.sort(key=lambda item: item[0])
+        return per_resource
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    @api.model
+    def busy_resources(self, kind, start, end, exclude_id=None):
+        """{resource_id: [booking, ...]} des ressources réservées sur [start, end),
+        hors affaire ``exclude_id``."""
+        start, end = fields.Date.to_date(start), fields.Date.to_date(end)
+        if not start or not end:
+            return {}
+        start, end = booking_period(start, end)
+        busy = {}
+        for rid, items in self._bookings_by_resource(kind, start, end).items():
+            bookings = [b for _s, _e, b in items if b['measurement_id'] != exclude_id]
+            if bookings:
+                busy[rid] = bookings
+        return busy
+
+    @api.model
+    def free_resources(self, kind, start, end, candidate_ids, exclude_id=None):
+        """Sous-liste de ``candidate_ids`` libres sur [start, end)."""
+        busy = self.busy_resources(kind, start, end, exclude_id=exclude_id)
+        return [rid for rid in candidate_ids if rid not in busy]
+
+    @api.model
+    def conflicts(self, kind, requests):
+        """Conflits d'un ensemble d'affectations, en un seul chargement.
+
+        ``requests`` : itérable de (measurement_id, start, end, resource_ids).
+        Retourne une liste de (measurement_id, resource_id, booking), dans
+        l'ordre des demandes.
+        """
+        requests = [
+            (mid,) + booking_period(fields.Date.to_date(start), fields.Date.to_date(end)) + (list(rids),)
+            for mid, start, end, rids in requests
+            if start and end and rids
+        ]
+        if not requests:
+            return []
+        per_resource = self._bookings_by_resource(
+            kind,
+            min(r[1] for r in requests),
+            max(r[2] for r in requests),
+        )
+        result = []
+        for mid, start, end, resource_ids in requests:
+            for rid in resource_ids:
+                for b_start, b_end, booking in per_resource.get(rid, ()):
+                    if b_start < end and b_end > start and booking['measurement_id'] != mid:
+                        result.append((mid, rid, booking))
+        return result
+
+    @api.model
+    def chariot_line_conflicts(self, line_ids):
+        """Conflits chariots des lignes ``line_ids`` en une seule requête.
+
+        Joint la relation ligne ↔ chariot sur elle-même : deux lignes de
+        mesures différentes qui se partagent un chariot sur des dates qui se
+        chevauchent. Les deux mesures sont filtrées par EXCLUDED_STATES, comme
+        les lignes matérialisées dans rail.resource.booking.
+
+        Retourne une liste de dicts (line_id, chariot_id, chariot_name,
+        measurement_id, reference, date_start, date_end), triée par chariot.
+        """
+        if not line_ids:
+            return []
+        Line = self.env['rail.measurement.chariot.type.line']
+        Measurement = self.env['rail.measurement']
+        Line.flush_model(['measurement_id', 'assigned_chariot_ids'])
+        Measurement.flush_model(['state', 'date_start', 'date_end', 'reference'])
+        self.env['chariot'].flush_model(['name'])
+
+        rel = Line._fields['assigned_chariot_ids']
+        self.env.cr.execute(f"""
+            SELECT DISTINCT ON (l.id, r.{rel.column2}, o.id)
+                   l.id, r.{rel.column2}, c.name,
+                   o.id, o.reference, o.date_start, o.date_end
+              FROM rail_measurement_chariot_type_line l
+              JOIN rail_measurement m ON m.id = l.measurement_id
+              JOIN {rel.relation} r ON r.{rel.column1} = l.id
+              JOIN {rel.relation} r2 ON r2.{rel.column2} = r.{rel.column2}
+                                    AND r2.{rel.column1} != l.id
+              JOIN rail_measurement_chariot_type_line l2 ON l2.id = r2.{rel.column1}
+              JOIN rail_measurement o ON o.id = l2.measurement_id
+              JOIN chariot c ON c.id = r.{rel.column2}
+             WHERE l.id = ANY(%s)
+               AND o.id != m.id
+               AND m.state NOT IN %s
+               AND o.state NOT IN %s
+               AND o.date_start < GREATEST(m.date_end, m.date_start + 1)
+               AND GREATEST(o.date_end, o.date_start + 1) > m.date_start
+             ORDER BY l.id, r.{rel.column2}, o.id
+        """, [list(line_ids), tuple(EXCLUDED_STATES[CHARIOT]), tuple(EXCLUDED_STATES[CHARIOT])])
+        keys = ('line_id', 'chariot_id', 'chariot_name',
+                'measurement_id', 'reference', 'date_start', 'date_end')
+        conflicts = [dict(zip(keys, row)) for row in self.env.cr.fetchall()]
+        conflicts.sort(key=lambda c: (c['chariot_name'] or '', c['date_start']))
+        return conflicts
+
+    @api.model
+    def busy_labels(self, kind, start, end, exclude_id=None):
+        """{resource_id: libellé de l'affaire} des ressources occupées.
+
+        Chemin rapide des listes déroulantes (name_search / read avec
+        ``check_avail_*`` dans le contexte) : un seul agrégat SQL sur
+        rail_resource_booking, mémorisé par (type, début, fin, affaire
+        exclue) le temps de la requête dans ``env.cr.cache``. Le cache est
+        vidé à chaque écriture d'une affaire ou d'une ligne de chariots et dès
+        qu'une réservation est vérifiée (voir invalidate_busy_labels).
+        """
+        start, end = fields.Date.to_date(start), fields.Date.to_date(end)
+        if not start or not end:
+            return {}
+        start, end = booking_period(start, end)
+        cache = self.env.cr.cache.setdefault(BUSY_CACHE_KEY, {})
+        key = (kind, start, end, exclude_id or 0)
+        if key not in cache:
+            # Les triggers alimentent la table au flush
+            self.env['rail.measurement'].flush_model([
+                'date_start', 'date_end', 'state', 'equipe_id_1', 'equipe_id_2', 'has_second_team',
+            ])
+            self.env['rail.measurement.chariot.type.line'].flush_model(['assigned_chariot_ids'])
+            self.env.cr.execute("""
+                SELECT b.resource_id,
+                       (ARRAY_AGG(COALESCE(m.code_affaire, m.name) ORDER BY b.date_start DESC))[1]
+                  FROM rail_resource_booking b
+                  JOIN rail_measurement m ON m.id = b.measurement_id
+                 WHERE b.resource_type = %s
+                   AND daterange(b.date_start, b.date_end, '[)') && daterange(%s, %s, '[)')
+                   AND b.measurement_id != %s
+                 GROUP BY b.resource_id
+            """, [kind, start, end, exclude_id or 0])
+            cache[key] = {rid: label or "Inconnue" for rid, label in self.env.cr.fetchall()}
+        return cache[key]
@@ -0,0 +1,204 @@
+"""Réservations matérialisées des équipes et chariots.
+
+``rail_resource_booking`` contient une ligne par (affaire, ressource) qui
+réserve effectivement la ressource selon EXCLUDED_STATES. Elle est tenue à
+jour par des triggers PostgreSQL sur ``rail_measurement`` et sur la relation
+ligne ↔ chariot : aucun chemin d'écriture (ORM, état recalculé, SQL) ne peut
+la désynchroniser.
+
+Une contrainte d'exclusion GiST (btree_gist) interdit deux réservations qui
+se chevauchent pour la même ressource : la garantie tient même entre deux
+planificateurs qui enregistrent en même temps. Si l'extension n'est pas
+disponible (ou si l'historique contient déjà des doublons), la table reste
+alimentée mais les contraintes Python prennent le relais.
+"""
+
+import logging
+from contextlib import contextmanager
+
+from psycopg2 import errors
+
+from odoo import api, fields, models, tools
+from odoo.exceptions import ValidationError
+
+from .resource_availability import CHARIOT, EQUIPE, EXCLUDED_STATES, invalidate_busy_labels
+
+_logger = logging.getLogger(__name__)
+
+BOOKING_EXCLUSION = 'rail_resource_booking_no_overlap'
+
+# Refus de la contrainte d'exclusion sans conflit visible : l'autre affaire
+# est en cours d'enregistrement dans une transaction concurrente.
+BOOKING_CONFLICT_MESSAGE = (
+    "Conflit de planification !\n\n"
+    "Une autre affaire vient de réserver cette ressource sur la même période. "
+    "Veuillez recharger la fiche puis choisir une autre ressource ou modifier les dates."
+)
+
+
+class BookingConflictError(ValidationError):
+    """Chevauchement refusé par la contrainte d'exclusion des réservations."""
+
+
+@contextmanager
+def booking_conflict_guard():
+    """Traduit le refus de la contrainte d'exclusion en erreur utilisateur.
+
+    À placer autour des flushs qui déclenchent les triggers de réservation
+    (rail.measurement et relation ligne ↔ chariot) : quel que soit le chemin
+    d'écriture, l'utilisateur ne voit jamais l'erreur psycopg2 brute.
+    """
+    try:
+        yield
+    except errors.ExclusionViolation as e:
+        if e.diag.constraint_name != BOOKING_EXCLUSION:
+            raise
+        raise BookingConflictError(BOOKING_CONFLICT_MESSAGE) from e
+
+
+def _sql_states(states):
+    return ", ".join("'%s'" % state for state in states)
+
+
+class RailResourceBooking(models.Model):
+    _name = 'rail.resource.booking'
+    _description = 'Réservation d\'équipe ou de chariot'
+    _log_access = False
+
+    measurement_id = fields.Many2one('rail.measurement', required=True, ondelete='cascade', index=True)
+    # Renseignée pour les chariots : supprimer la ligne libère ses chariots
+    line_id = fields.Many2one('rail.measurement.chariot.type.line', ondelete='cascade', index=True)
+    resource_type = fields.Selection([
+        (EQUIPE, 'Équipe'),
+        (CHARIOT, 'Chariot'),
+    ], required=True)
+    resource_id = fields.Integer(required=True)
+    # Période [date_start, date_end) : voir booking_period
+    date_start = fields.Date(required=True)
+    date_end = fields.Date(required=True)
+
+    def init(self):
+        cr = self.env.cr
+        Line = self.env['rail.measurement.chariot.type.line']
+        rel = Line._fields['assigned_chariot_ids']
+        if not tools.sql.table_exists(cr, rel.relation):
+            return
+
+        cr.execute(f"""
+            CREATE OR REPLACE FUNCTION rail_resource_booking_refresh(mids integer[])
+            RETURNS void AS $$
+            BEGIN
+                DELETE FROM rail_resource_booking WHERE measurement_id = ANY(mids);
+                INSERT INTO rail_resource_booking
+                       (measurement_id, line_id, resource_type, resource_id, date_start, date_end)
+                SELECT m.id, NULL, '{EQUIPE}', t.team_id, m.date_start,
+                       GREATEST(m.date_end, m.date_start + 1)
+                  FROM rail_measurement m
+                 CROSS JOIN LATERAL (VALUES (m.equipe_id_1),
+                                            (CASE WHEN m.has_second_team THEN m.equipe_id_2 END)
+                                    ) AS t(team_id)
+                 WHERE m.id = ANY(mids)
+                   AND t.team_id IS NOT NULL
+                   AND m.date_start IS NOT NULL
+                   AND m.date_end >= m.date_start
+                   AND m.state NOT IN ({_sql_states(EXCLUDED_STATES[EQUIPE])})
+                UNION
+                SELECT m.id, l.id, '{CHARIOT}', r.{rel.column2}, m.date_start,
+                       GREATEST(m.date_end, m.date_start + 1)
+                  FROM rail_measurement m
+                  JOIN rail_measurement_chariot_type_line l ON l.measurement_id = m.id
+                  JOIN {rel.relation} r ON r.{rel.column1} = l.id
+                 WHERE m.id = ANY(mids)
+                   AND m.date_start IS NOT NULL
+                   AND m.date_end >= m.date_start
+                   AND m.state NOT IN ({_sql_states(EXCLUDED_STATES[CHARIOT])});
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION rail_resource_booking_on_measurement()
+            RETURNS trigger AS $$
+            BEGIN
+                PERFORM rail_resource_booking_refresh(ARRAY[NEW.id]);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION rail_resource_booking_on_chariot_rel()
+            RETURNS trigger AS $$
+            DECLARE
+                line integer;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    line := OLD.{rel.column1};
+                ELSE
+                    line := NEW.{rel.column1};
+                END IF;
+                PERFORM rail_resource_booking_refresh(ARRAY(
+                    SELECT measurement_id FROM rail_measurement_chariot_type_line WHERE id = line
+                ));
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS rail_resource_booking_measurement ON rail_measurement;
+            CREATE TRIGGER rail_resource_booking_measurement
+                AFTER INSERT OR UPDATE OF date_start, date_end, state,
+                                          equipe_id_1, equipe_id_2, has_second_team
+                ON rail_measurement
+                FOR EACH ROW EXECUTE FUNCTION rail_resource_booking_on_measurement();
+
+            DROP TRIGGER IF EXISTS rail_resource_booking_chariot_rel ON {rel.relation};
+            CREATE TRIGGER rail_resource_booking_chariot_rel
+                AFTER INSERT OR DELETE ON {rel.relation}
+                FOR EACH ROW EXECUTE FUNCTION rail_resource_booking_on_chariot_rel();
+        """)
+
+        # Rattrapage complet : la table reflète l'existant avant d'être contrainte
+        cr.execute("SELECT rail_resource_booking_refresh(ARRAY(SELECT id FROM rail_measurement))")
+
+        if tools.sql.constraint_definition(cr, self._table, BOOKING_EXCLUSION):
+            return
+        try:
+            with cr.savepoint(flush=False):
+                cr.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+                cr.execute(f"""
+                    ALTER TABLE rail_resource_booking
+                      ADD CONSTRAINT {BOOKING_EXCLUSION}
+                      EXCLUDE USING gist (
+                          resource_type WITH =,
+                          resource_id WITH =,
+                          daterange(date_start, date_end, '[)') WITH &&,
+                          measurement_id WITH <>
+                      )
+                """)
+        except Exception as e:
+            _logger.warning(
+                "Contrainte d'exclusion %s non créée (%s) : "
+                "les conflits de planification restent vérifiés en Python.",
+                BOOKING_EXCLUSION, e,
+            )
+        self.env.registry.clear_cache()
+
+    @api.model
+    @tools.ormcache()
+    def _exclusion_active(self):
+        return bool(tools.sql.constraint_definition(self.env.cr, self._table, BOOKING_EXCLUSION))
+
+    @api.model
+    def _flush_and_check(self):
+        """Envoie en base les écritures qui alimentent les réservations.
+
+        Retourne True si la contrainte d'exclusion garantit l'absence de
+        chevauchement, None si elle n'est pas en place (vérification Python
+        nécessaire). Un conflit lève BookingConflictError depuis le flush
+        (voir booking_conflict_guard) : pas de savepoint ici, un retour en
+        arrière laisserait dans le cache des valeurs marquées comme écrites.
+        """
+        invalidate_busy_labels(self.env)
+        if not self._exclusion_active():
+            return None
+        self.env['rail.measurement'].flush_model([
+            'date_start', 'date_end', 'state', 'equipe_id_1', 'equipe_id_2', 'has_second_team',
+        ])
+        self.env['rail.measurement.chariot.type.line'].flush_model(['measurement_id', 'assigned_chariot_ids'])
+        return True
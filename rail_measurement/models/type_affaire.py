@@ -24,4 +24,22 @@ class TypeAffaire(models.Model):
     @api.depends('name', 'code')
     def _compute_display_name(self):
         for record in self:
-            record.display_name = f"[{record.code}] {record.name}"
\ No newline at end of file
+            record.display_name = f"[{record.code}] {record.name}"
+
+    # Référentiel du code affaire : voir rail.code.affaire.parser
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if not vals.keys().isdisjoint(('code', 'requires_nature', 'active')):
+            self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['rail.code.affaire.parser']._invalidate_code_tries()
+        return res
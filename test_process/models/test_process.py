@@ -1,4 +1,30 @@
 from odoo import models, fields, api
+from odoo.addons.web_widget_mermaid_field.tools import ACTIVE_CLASS_DEF, DONE_CLASS_DEF, ProcessGraph
+
+MERMAID_MACRO = ProcessGraph(
+    lines=("graph LR", ACTIVE_CLASS_DEF, DONE_CLASS_DEF,
+           "PROD[Production] --> MEASURE[Mesure]", "MEASURE --> STUDY[Études]", "STUDY --> DONE((Fin))"),
+    mapping={'production': 'PROD', 'measure': 'MEASURE', 'study': 'STUDY', 'done': 'DONE'},
+    order=('production', 'measure', 'study', 'done'),
+)
+MERMAID_PROD = ProcessGraph(
+    lines=("graph LR", ACTIVE_CLASS_DEF,
+           "M1(Mission) --> M2[Équipe]", "M2 --> M3{Matériel?}", "M3 -- Non --> M3_U[Urgence]", "M3_U --> M4[Chariots]", "M3 -- Oui --> M4", "M4 --> M5((Prêt))"),
+    mapping={'mission': 'M1', 'team': 'M2', 'material': 'M3', 'assigned': 'M4'},
+    order=('mission', 'team', 'material', 'assigned'),
+)
+MERMAID_MEASURE = ProcessGraph(
+    lines=("graph LR", ACTIVE_CLASS_DEF,
+           "ME1[Terrain] --> ME2{Fini?}", "ME2 -- Non --> ME1", "ME2 -- Oui --> ME3[Fichiers]", "ME3 --> ME4((OK))"),
+    mapping={'daily': 'ME1', 'checking': 'ME2', 'files': 'ME3'},
+    order=('daily', 'checking', 'files'),
+)
+MERMAID_STUDY = ProcessGraph(
+    lines=("graph LR", ACTIVE_CLASS_DEF,
+           "S1[Réception] --> S2[Analyse]", "S2 --> S3{Validation}", "S3 -- KO --> S1", "S3 -- OK --> S4((Fin))"),
+    mapping={'reception': 'S1', 'analysis': 'S2', 'validation': 'S3'},
+    order=('reception', 'analysis', 'validation'),
+)
 
 class TestProcess(models.Model):
     _name = 'test.process'
@@ -49,43 +75,14 @@ class TestProcess(models.Model):
     def _compute_mermaid_graph(self):
         for rec in self:
             if rec.view_level == 'overview':
-                rec.mermaid_graph = rec._generate_macro_graph()
+                graph, current = MERMAID_MACRO, rec.state
             elif rec.view_level == 'prod_detail':
-                rec.mermaid_graph = rec._generate_prod_micro()
+                graph, current = MERMAID_PROD, rec.prod_substate
             elif rec.view_level == 'measure_detail':
-                rec.mermaid_graph = rec._generate_measure_micro()
+                graph, current = MERMAID_MEASURE, rec.measure_substate
             else:
-                rec.mermaid_graph = rec._generate_study_micro()
-
-    def _generate_macro_graph(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px", "classDef done fill:#e2e2e2,color:#999,stroke:#ccc",
-                 "PROD[Production] --> MEASURE[Mesure]", "MEASURE --> STUDY[Études]", "STUDY --> DONE((Fin))"]
-        return self._apply_styles(lines, {'production': 'PROD', 'measure': 'MEASURE', 'study': 'STUDY', 'done': 'DONE'}, self.state, ['production', 'measure', 'study', 'done'])
-
-    def _generate_prod_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "M1(Mission) --> M2[Équipe]", "M2 --> M3{Matériel?}", "M3 -- Non --> M3_U[Urgence]", "M3_U --> M4[Chariots]", "M3 -- Oui --> M4", "M4 --> M5((Prêt))"]
-        return self._apply_styles(lines, {'mission': 'M1', 'team': 'M2', 'material': 'M3', 'assigned': 'M4'}, self.prod_substate, ['mission', 'team', 'material', 'assigned'])
-
-    def _generate_measure_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "ME1[Terrain] --> ME2{Fini?}", "ME2 -- Non --> ME1", "ME2 -- Oui --> ME3[Fichiers]", "ME3 --> ME4((OK))"]
-        return self._apply_styles(lines, {'daily': 'ME1', 'checking': 'ME2', 'files': 'ME3'}, self.measure_substate, ['daily', 'checking', 'files'])
-
-    def _generate_study_micro(self):
-        lines = ["graph LR", "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px",
-                 "S1[Réception] --> S2[Analyse]", "S2 --> S3{Validation}", "S3 -- KO --> S1", "S3 -- OK --> S4((Fin))"]
-        return self._apply_styles(lines, {'reception': 'S1', 'analysis': 'S2', 'validation': 'S3'}, self.study_substate, ['reception', 'analysis', 'validation'])
-
-    def _apply_styles(self, lines, mapping, current, order):
-        if current in order:
-            idx = order.index(current)
-            for i, key in enumerate(order):
-                node = mapping.get(key)
-                if node:
-                    if i < idx: lines.append(f"class {node} done")
-                    elif i == idx: lines.append(f"class {node} active")
-        return "\n".join(lines)
+                graph, current = MERMAID_STUDY, rec.study_substate
+            rec.mermaid_graph = graph.render(current)
 
     def action_next(self):
         if self.state == 'production':
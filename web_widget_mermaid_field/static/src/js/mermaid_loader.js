@@ -0,0 +1,79 @@
+import { loadBundle } from "@web/core/assets";
+import { uniqueId } from "@web/core/utils/functions";
+
+/**
+ * Accès partagé à mermaid.js pour tous les widgets de la page.
+ *
+ * - la librairie (plusieurs Mo) n'est chargée qu'au premier rendu, jamais
+ *   pour un formulaire sans champ mermaid ;
+ * - les rendus sont sérialisés : mermaid.initialize() est global, deux
+ *   configurations différentes ne peuvent pas se rendre en même temps ;
+ * - chaque rendu attend un moment d'inactivité du navigateur ;
+ * - le résultat est mémorisé par (configuration, source) : un graphe déjà
+ *   rendu est resservi sans repasser par mermaid.
+ */
+
+const CACHE_SIZE = 100;
+
+let mermaidPromise = null;
+let currentConfigKey = null;
+let queue = Promise.resolve();
+const cache = new Map();
+
+export function loadMermaid() {
+    if (!mermaidPromise) {
+        mermaidPromise = loadBundle("web_widget_mermaid_field.mermaid_lib").then(() => window.mermaid);
+    }
+    return mermaidPromise;
+}
+
+function whenIdle() {
+    return new Promise((resolve) => {
+        if (window.requestIdleCallback) {
+            window.requestIdleCallback(() => resolve(), { timeout: 200 });
+        } else {
+            setTimeout(resolve, 0);
+        }
+    });
+}
+
+function remember(key, value) {
+    cache.delete(key);
+    cache.set(key, value);
+    if (cache.size > CACHE_SIZE) {
+        cache.delete(cache.keys().next().value);
+    }
+}
+
+/**
+ * Rend ``source`` avec ``config`` ; résout { svg, chartId }.
+ */
+export function renderMermaid(source, config) {
+    const configKey = JSON.stringify(config);
+    const key = `${configKey}\n${source}`;
+    const cached = cache.get(key);
+    if (cached) {
+        remember(key, cached);
+        return Promise.resolve(cached);
+    }
+    const result = queue.then(async () => {
+        // Rendu identique demandé pendant l'attente
+        if (cache.has(key)) {
+            return cache.get(key);
+        }
+        const mermaid = await loadMermaid();
+        await whenIdle();
+        if (currentConfigKey !== configKey) {
+            mermaid.initialize(config);
+            currentConfigKey = configKey;
+        }
+        const chartId = uniqueId("mermaid_chart_");
+        const { svg } = await mermaid.render(chartId, source);
+        const value = { svg, chartId };
+        remember(key, value);
+        return value;
+    });
+    // Une erreur de rendu ne bloque pas les suivants
+    queue = result.catch(() => {});
+    return result;
+}
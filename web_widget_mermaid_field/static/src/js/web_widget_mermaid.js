@@ -1,8 +1,7 @@
-import { Component, useState, onWillStart, onPatched, onMounted, markup } from "@odoo/owl";
+import { Component, useState, onPatched, onMounted, onWillUnmount, markup } from "@odoo/owl";
 import { TextField } from "@web/views/fields/text/text_field";
 import { registry } from "@web/core/registry";
-import { loadBundle } from "@web/core/assets";
-import { uniqueId } from "@web/core/utils/functions";
+import { renderMermaid } from "./mermaid_loader";
 
 export class MermaidField extends Component {
     static template = 'web_widget_mermaid_field.MermaidField';
@@ -31,6 +30,11 @@ export class MermaidField extends Component {
             startOnLoad: false,
         }, mermaidConfig);
 
+        this.isDestroyed = false;
+        onWillUnmount(() => {
+            this.isDestroyed = true;
+        });
+
         this.state = useState({
             style: mermaid_scroll_x ? 'overflow-x: auto;' : '',
             subStyle: this.subStyle,
@@ -38,17 +42,18 @@ export class MermaidField extends Component {
             chartId: "",
             data: "",
         });
-
-        onWillStart(async () => {
-            await loadBundle("web_widget_mermaid_field.mermaid_lib");
-        });
     }
 
     async renderMermaid() {
+        const source = this.props.record.data[this.props.name];
+        // Marqué tout de suite : onPatched ne relance pas le même rendu
+        this.state.data = source;
         try {
-            const chartId = uniqueId("mermaid_chart_");
-            const { svg } = await mermaid.render(chartId, this.props.record.data[this.props.name]);
-            const svgElement = new DOMParser().parseFromString(svg, "image/svg+xml").documentElement;
+            const { svg, chartId } = await renderMermaid(source, this.config);
+            // Le champ a changé (ou le widget a disparu) pendant le rendu
+            if (this.isDestroyed || this.state.data !== source) {
+                return;
+            }
             const maxWidthRegex = /max-width:\s*([\d.]+)px;/;
             const match = svg.match(maxWidthRegex);
             let maxWidth = match ? parseFloat(match[1]) : 0;
@@ -59,8 +64,10 @@ export class MermaidField extends Component {
             this.state.subStyle = `width: ${maxWidth}px;`;
             this.state.mermaidSvg = markup(svg);
             this.state.chartId = chartId;
-            this.state.data = this.props.record.data[this.props.name];
         } catch (e) {
+            if (this.isDestroyed || this.state.data !== source) {
+                return;
+            }
             this.state.mermaidSvg = markup(`<pre>${e.message || e.str}</pre>`);
         }
     }
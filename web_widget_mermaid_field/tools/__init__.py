@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from .mermaid import ProcessGraph, ACTIVE_CLASS_DEF, DONE_CLASS_DEF
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Graphes Mermaid d'avancement d'un processus.
+
+Un graphe est décrit une fois (lignes Mermaid, nœud de chaque étape, ordre
+des étapes) ; son rendu ne dépend plus que de l'étape courante. Le résultat
+est mémorisé par ``functools.lru_cache`` : une vue liste ou kanban qui
+affiche le graphe de centaines d'enregistrements ne construit qu'une chaîne
+par combinaison (graphe, étape).
+
+    GRAPH = ProcessGraph(
+        lines=("graph LR", ACTIVE_CLASS_DEF, "A[Début] --> B[Fin]"),
+        mapping={'start': 'A', 'end': 'B'},
+        order=('start', 'end'),
+    )
+    record.mermaid_graph = GRAPH.render(record.state)
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+
+ACTIVE_CLASS_DEF = "classDef active fill:#714B67,color:#fff,stroke:#333,stroke-width:2px"
+DONE_CLASS_DEF = "classDef done fill:#e2e2e2,color:#999,stroke:#ccc"
+
+
+@dataclass(frozen=True)
+class ProcessGraph:
+    lines: tuple
+    mapping: tuple
+    order: tuple
+
+    def __post_init__(self):
+        # Tout doit être hachable pour servir de clé de cache
+        mapping = self.mapping.items() if isinstance(self.mapping, dict) else self.mapping
+        object.__setattr__(self, 'lines', tuple(self.lines))
+        object.__setattr__(self, 'mapping', tuple(mapping))
+        object.__setattr__(self, 'order', tuple(self.order))
+
+    def render(self, current, all_done=False, tail=()):
+        """Source Mermaid avec les étapes passées en ``done`` et l'étape
+        ``current`` en ``active``.
+
+        ``all_done`` grise tous les nœuds (processus annulé) ; ``tail`` est
+        ajouté tel quel à la fin.
+        """
+        return _render(self, current or False, bool(all_done), tuple(tail))
+
+
+@lru_cache(maxsize=512)
+def _render(graph, current, all_done, tail):
+    lines = list(graph.lines)
+    mapping = dict(graph.mapping)
+    if all_done:
+        lines.extend(f"class {node} done" for node in mapping.values())
+    elif current in graph.order:
+        idx = graph.order.index(current)
+        for i, key in enumerate(graph.order):
+            node = mapping.get(key)
+            if node:
+                if i < idx:
+                    lines.append(f"class {node} done")
+                elif i == idx:
+                    lines.append(f"class {node} active")
+    lines.extend(tail)
+    return "\n".join(lines)